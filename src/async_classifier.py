@@ -0,0 +1,482 @@
+"""An asyncio server for the classifier's routes: ``/health``, ``/whoami`` and ``/classify``.
+
+The event loop only parses HTTP and moves JSON around. Password checks that
+miss the credential cache run on a thread, and k-NN work runs on a process
+pool, so a slow request never holds up the others. Idle keep-alive
+connections cost a coroutine each, so one node can hold thousands.
+
+Run with ``python -m src.async_classifier [--host HOST] [--port PORT] [--workers N]``.
+It reads the same configuration as ``classifier.app``.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import concurrent.futures
+from http import HTTPStatus
+import json
+import os
+from typing import Any, Optional
+
+import numpy as np
+
+from src.ch6_model import Hyperparameter, TrainingData
+from src.classifier import (
+    Batch,
+    Classifier,
+    InvalidSample,
+    MODEL_CONFIG,
+    NotAuthorized,
+    Role,
+    User,
+    app,
+    authorized_user,
+    diagnostics,
+    health_status,
+    sample_features,
+    users,
+)
+
+
+# Set in each pool process by _load_model().
+_model: Optional[tuple[TrainingData, Hyperparameter]] = None
+
+
+def _load_model(config: dict[str, Any]) -> None:
+    global _model
+    _model = Classifier.model(config)
+
+
+def _classify(features: np.ndarray) -> list[str]:
+    if _model is None:
+        raise RuntimeError("Worker has no model")
+    training_data, hyperparameter = _model
+    return hyperparameter.classify_many(features).tolist()  # type: ignore[no-any-return]
+
+
+class Overloaded(Exception):
+    status_code = 503
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"message": "Too many requests waiting, try again"}
+
+
+class AsyncBatcher:
+    """Coalesces queued requests into one process-pool call per batch.
+
+    A dispatcher takes the oldest request, then collects more until
+    ``max_size`` samples are waiting or ``max_wait_ms`` has passed. There is
+    one dispatcher per pool process. At most ``max_pending`` requests can
+    wait; past that, ``submit()`` raises Overloaded right away instead of
+    letting latency grow without bound.
+    """
+
+    def __init__(
+        self,
+        pool: concurrent.futures.Executor,
+        dispatchers: int,
+        max_wait_ms: float = 2.0,
+        max_size: int = 64,
+        max_pending: int = 1024,
+    ) -> None:
+        self.pool = pool
+        self.max_wait = max_wait_ms / 1000
+        self.max_size = max_size
+        self.queue: asyncio.Queue[tuple[np.ndarray, asyncio.Future[list[str]]]] = (
+            asyncio.Queue(max_pending)
+        )
+        self.tasks = [asyncio.create_task(self.dispatch()) for _ in range(dispatchers)]
+        self.batches = self.samples = 0
+
+    async def submit(self, features: np.ndarray) -> list[str]:
+        future: asyncio.Future[list[str]] = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((features, future))
+        except asyncio.QueueFull:
+            raise Overloaded()
+        return await future
+
+    async def dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = Batch(await self.queue.get())
+            deadline = loop.time() + self.max_wait
+            while not batch.full(self.max_size):
+                timeout = max(0.0, deadline - loop.time())
+                try:
+                    batch.add(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.classify(batch)
+
+    async def classify(self, batch: Batch) -> None:
+        try:
+            species = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _classify, batch.features()
+            )
+        except Exception as error:
+            for single in batch.split(error):
+                await self.classify(single)
+            return
+        self.batches += 1
+        self.samples += len(species)
+        batch.resolve(species)
+
+
+class Server:
+    """A minimal HTTP/1.1 server with keep-alive, answering with JSON."""
+
+    def __init__(
+        self, batcher: AsyncBatcher, keepalive: float = 75.0, max_body: int = 2**20
+    ) -> None:
+        self.batcher = batcher
+        self.keepalive = keepalive
+        self.max_body = max_body
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while await self.exchange(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def exchange(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        """Answer one request; True if the connection stays open for another."""
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), self.keepalive
+            )
+        except (
+            asyncio.TimeoutError,
+            asyncio.LimitOverrunError,
+            asyncio.IncompleteReadError,
+        ):
+            return False
+        lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+        request_line, *header_lines = lines
+        try:
+            method, target, version = request_line.split(" ", 2)
+            headers = {
+                name.strip().lower(): value.strip()
+                for name, _, value in (line.partition(":") for line in header_lines)
+            }
+            length = int(headers.get("content-length", "0"))
+            if length < 0:
+                raise ValueError(f"Content-Length {length}")
+        except ValueError:
+            self.respond(
+                writer, HTTPStatus.BAD_REQUEST, {"message": "Bad request"}, False
+            )
+            return False
+        if length > self.max_body:
+            self.respond(
+                writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"message": "Too big"}, False
+            )
+            return False
+        try:
+            body = (
+                await asyncio.wait_for(reader.readexactly(length), self.keepalive)
+                if length
+                else b""
+            )
+        except asyncio.TimeoutError:
+            return False
+        keep_alive = (
+            version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        )
+        extra: dict[str, str] = {}
+        try:
+            status, document = await self.route(
+                method, target.partition("?")[0], headers, body
+            )
+        except (NotAuthorized, InvalidSample, Overloaded) as error:
+            status, document = HTTPStatus(error.status_code), error.to_dict()
+            if isinstance(error, Overloaded):
+                extra["Retry-After"] = "1"
+        except Exception as error:
+            app.logger.exception(f"{method} {target} failed")
+            status, document = HTTPStatus.INTERNAL_SERVER_ERROR, {"message": str(error)}
+        self.respond(writer, status, document, keep_alive, extra)
+        await writer.drain()
+        return keep_alive
+
+    async def route(
+        self, method: str, path: str, headers: dict[str, str], body: bytes
+    ) -> tuple[HTTPStatus, dict[str, Any]]:
+        if path == "/ready":
+            status = await self.health(headers, body)
+            ready = HTTPStatus.OK if status["ready"] else HTTPStatus.SERVICE_UNAVAILABLE
+            return ready, status
+        routes = {
+            "/health": ("GET", self.health),
+            "/diagnostics": ("GET", self.diagnostics),
+            "/whoami": ("GET", self.who_am_i),
+            "/classify": ("POST", self.classify),
+        }
+        if path not in routes:
+            return HTTPStatus.NOT_FOUND, {"message": "Not found"}
+        allowed, view = routes[path]
+        if method != allowed:
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"message": f"Use {allowed}"}
+        return HTTPStatus.OK, await view(headers, body)
+
+    async def authenticate(self, headers: dict[str, str]) -> User:
+        authorization = headers.get("authorization", "")
+        # The password hash is deliberately slow, and even a cached lookup may
+        # wait on the user file's lock; keep both off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, authorized_user, authorization
+        )
+
+    async def health(self, headers: dict[str, str], body: bytes) -> dict[str, Any]:
+        # The model lives in the pool processes; it's loaded once a batch is back.
+        response = health_status()
+        response["model_loaded"] = self.batcher.batches > 0
+        response["ready"] = users.ready and response["model_loaded"]
+        return response
+
+    async def diagnostics(
+        self, headers: dict[str, str], body: bytes
+    ) -> dict[str, Any]:
+        await self.authenticate(headers)
+        response = diagnostics()
+        response.update(await self.health(headers, body))
+        response["batcher"] = {
+            "batches": self.batcher.batches,
+            "samples": self.batcher.samples,
+            "waiting": self.batcher.queue.qsize(),
+        }
+        return response
+
+    async def who_am_i(self, headers: dict[str, str], body: bytes) -> dict[str, Any]:
+        user = await self.authenticate(headers)
+        return {"status": "OK", "user": user.asdict()}
+
+    async def classify(self, headers: dict[str, str], body: bytes) -> dict[str, Any]:
+        user = await self.authenticate(headers)
+        if user.role not in (Role.BOTANIST, Role.RESEARCHER):
+            raise NotAuthorized("Not allowed to classify", status_code=403)
+        try:
+            document = json.loads(body)
+        except ValueError:
+            raise InvalidSample("Expected a JSON sample or list of samples")
+        species = await self.batcher.submit(sample_features(document))
+        return {
+            "status": "OK",
+            "species": species if isinstance(document, list) else species[0],
+        }
+
+    @staticmethod
+    def respond(
+        writer: asyncio.StreamWriter,
+        status: HTTPStatus,
+        document: dict[str, Any],
+        keep_alive: bool,
+        extra: Optional[dict[str, str]] = None,
+    ) -> None:
+        body = json.dumps(document).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(body)),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **(extra or {}),
+        }
+        head = f"HTTP/1.1 {status.value} {status.phrase}\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in headers.items()
+        )
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+
+
+async def warm_up(batcher: AsyncBatcher) -> None:
+    """Load the users and the model now, rather than on the first request.
+
+    A failure is logged and left for /ready to report; it doesn't stop the server.
+    """
+    try:
+        await asyncio.gather(
+            asyncio.get_running_loop().run_in_executor(None, users.load),
+            batcher.submit(np.zeros((1, 4))),
+        )
+    except Exception:
+        app.logger.exception("Warm-up failed")
+
+
+async def serve(host: str, port: int, workers: int) -> None:
+    config = app.config
+    config.setdefault("ASYNC_MAX_PENDING", 1024)
+    config.setdefault("ASYNC_KEEPALIVE_SECONDS", 75.0)
+    model_config = {name: config[name] for name in MODEL_CONFIG}
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=_load_model, initargs=(model_config,)
+    ) as pool:
+        batcher = AsyncBatcher(
+            pool,
+            workers,
+            config["BATCH_MAX_WAIT_MS"],
+            config["BATCH_MAX_SIZE"],
+            config["ASYNC_MAX_PENDING"],
+        )
+        server = Server(batcher, config["ASYNC_KEEPALIVE_SECONDS"])
+        # The loop only keeps a weak reference to the task.
+        warming = asyncio.create_task(warm_up(batcher))
+        listener = await asyncio.start_server(server.handle, host, port, backlog=4096)
+        async with listener:
+            await listener.serve_forever()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve the classifier with asyncio.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port, args.workers))
+
+
+test_server = """
+A fake connection: the requests arrive all at once, and the writer keeps
+what the server sends back.
+
+>>> import base64
+>>> class Writer:
+...     def __init__(self):
+...         self.data = b""
+...     def write(self, data):
+...         self.data += data
+...     async def drain(self):
+...         pass
+...     def close(self):
+...         pass
+>>> def request(method, path, body=b"", **headers):
+...     lines = [f"{method} {path} HTTP/1.1"]
+...     lines += [f"{name.replace('_', '-')}: {value}" for name, value in headers.items()]
+...     if body and "Content_Length" not in headers:
+...         lines.append(f"Content-Length: {len(body)}")
+...     return ("\\r\\n".join(lines) + "\\r\\n\\r\\n").encode("latin-1") + body
+>>> def responses(data):
+...     while data:
+...         head, _, data = data.partition(b"\\r\\n\\r\\n")
+...         status, *fields = head.decode("latin-1").split("\\r\\n")
+...         headers = dict(field.split(": ", 1) for field in fields)
+...         length = int(headers["Content-Length"])
+...         body, data = data[:length], data[length:]
+...         yield status, headers["Connection"], headers.get("Retry-After"), json.loads(body)
+>>> async def talk(server, *raw):
+...     reader = asyncio.StreamReader()
+...     for data in raw:
+...         reader.feed_data(data)
+...     reader.feed_eof()
+...     writer = Writer()
+...     await server.handle(reader, writer)
+...     return list(responses(writer.data))
+>>> async def serving(connections, dispatchers=1, max_pending=8, max_body=2**20, prefill=0):
+...     with concurrent.futures.ThreadPoolExecutor(1) as pool:
+...         batcher = AsyncBatcher(pool, dispatchers, 50.0, 64, max_pending)
+...         for _ in range(prefill):
+...             waiting = asyncio.get_running_loop().create_future()
+...             batcher.queue.put_nowait((np.zeros((1, 4)), waiting))
+...         server = Server(batcher, keepalive=1.0, max_body=max_body)
+...         answers = await asyncio.gather(*(talk(server, *raw) for raw in connections))
+...         for task in batcher.tasks:
+...             task.cancel()
+...         return answers
+
+A model whose radius finds nothing near a far sample, so that sample fails,
+and two users, one of whom may classify.
+
+>>> td = TrainingData("test")
+>>> td.load([
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 4.9, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... ])
+>>> import sys
+>>> from src.classifier import FEATURES
+>>> module = sys.modules[Server.__module__]
+>>> module._model = (td, Hyperparameter(1, Classifier.distances["Euclidean"](), td, radius=1.0))
+>>> saved = users.users, users.from_file
+>>> users.users, users.from_file = {}, False
+>>> for name, role in ("botanist", Role.BOTANIST), ("guest", Role.UNDEFINED):
+...     user = User(name, f"{name}@example.com", name.title(), role)
+...     user.set_password("secret")
+...     users.add_user(user)
+>>> def basic(username):
+...     return "Basic " + base64.b64encode(f"{username}:secret".encode()).decode()
+>>> near = json.dumps(dict(zip(FEATURES, [5.0, 3.4, 1.5, 0.2]))).encode()
+>>> far = json.dumps([dict(zip(FEATURES, [9, 9, 9, 9]))]).encode()
+
+Keep-alive answers each request in turn, until one says ``Connection: close``.
+
+>>> [answers] = asyncio.run(serving([[
+...     request("GET", "/health"),
+...     request("GET", "/health", Connection="close"),
+...     request("GET", "/health"),
+... ]]))
+>>> [(status, connection) for status, connection, _, _ in answers]
+[('HTTP/1.1 200 OK', 'keep-alive'), ('HTTP/1.1 200 OK', 'close')]
+
+A bad Content-Length is a 400, a body over ``max_body`` a 413; either closes.
+
+>>> answers = asyncio.run(serving([
+...     [request("POST", "/classify", Content_Length="many")],
+...     [request("POST", "/classify", Content_Length="-1")],
+...     [request("POST", "/classify", near)],
+... ], max_body=16))
+>>> for [(status, connection, _, document)] in answers:
+...     print(status, connection, document)
+HTTP/1.1 400 Bad Request close {'message': 'Bad request'}
+HTTP/1.1 400 Bad Request close {'message': 'Bad request'}
+HTTP/1.1 413 Request Entity Too Large close {'message': 'Too big'}
+
+Routes check the method and the user's role.
+
+>>> answers = asyncio.run(serving([[
+...     request("GET", "/nowhere"),
+...     request("GET", "/classify"),
+...     request("POST", "/classify", near, Authorization=basic("guest")),
+...     request("POST", "/classify", b"{", Authorization=basic("botanist")),
+... ]]))
+>>> for status, _, _, document in answers[0]:
+...     print(status, document)
+HTTP/1.1 404 Not Found {'message': 'Not found'}
+HTTP/1.1 405 Method Not Allowed {'message': 'Use POST'}
+HTTP/1.1 403 Forbidden {'message': 'Not allowed to classify'}
+HTTP/1.1 400 Bad Request {'message': 'Expected a JSON sample or list of samples'}
+
+Two requests batched together: the one that fails is retried alone and
+gets the error; the other still gets its answer.
+
+>>> answers = asyncio.run(serving([
+...     [request("POST", "/classify", near, Authorization=basic("botanist"))],
+...     [request("POST", "/classify", far, Authorization=basic("botanist"))],
+... ]))
+>>> for [(status, _, _, document)] in answers:
+...     print(status, document)
+HTTP/1.1 200 OK {'status': 'OK', 'species': 'Iris-setosa'}
+HTTP/1.1 500 Internal Server Error {'message': 'No training samples within 1.0 of [9.0, 9.0, 9.0, 9.0]'}
+
+With the queue full, a request is turned away at once, with Retry-After.
+
+>>> [[answer]] = asyncio.run(serving(
+...     [[request("POST", "/classify", near, Authorization=basic("botanist"))]],
+...     dispatchers=0, max_pending=1, prefill=1,
+... ))
+>>> answer
+('HTTP/1.1 503 Service Unavailable', 'keep-alive', '1', {'message': 'Too many requests waiting, try again'})
+
+>>> from src.classifier import verified
+>>> module._model = None
+>>> verified.entries.clear()
+>>> users.users, users.from_file = saved
+"""
+
+__test__ = {name: case for name, case in globals().items() if name.startswith("test_")}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""Measurements of the four classifier implementations.
+
+``ch6_model`` (slotted classes over arrays), ``model`` (dataclasses),
+``model_f`` (frozen dataclasses) and ``model_t`` (NamedTuples) are each
+loaded with the same synthetic iris-like rows and timed with every
+Distance. The report is JSON, so runs from different commits can be diffed.
+
+Run with ``python -m src.benchmark [--sizes 1000 10000 ...] [--output FILE]``.
+"""
+from __future__ import annotations
+import abc
+import argparse
+import datetime
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import weakref
+from pathlib import Path
+from typing import Callable, Any, Iterable, Optional, Sequence, Type
+
+import numpy as np
+
+from src import model, model_f, model_t
+from src.ch6_model import (
+    Chebyshev,
+    Distance,
+    Euclidean,
+    Hyperparameter,
+    KnownSample,
+    Manhattan,
+    Minkowski_2,
+    Purpose,
+    SampleArrays,
+    SampleViews,
+    Sorensen,
+    SpeciesCodes,
+    TrainingData,
+    UnknownSample,
+)
+
+
+SPECIES = ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+FEATURES = ["sepal_length", "sepal_width", "petal_length", "petal_width"]
+
+
+class CD(Minkowski_2):
+    """Chebyshev again, by way of the generic Minkowski_2."""
+
+    m = 1
+    reduction = max
+
+
+DISTANCES: list[Type[Distance]] = [Euclidean, Manhattan, Chebyshev, Sorensen, CD]
+
+
+def synthetic_rows(count: int, seed: int = 42) -> np.ndarray:
+    """Iris-like measurements, rounded to one decimal place like bezdekIris.data."""
+    rng = np.random.default_rng(seed)
+    means = np.array([5.8, 3.0, 3.8, 1.2])
+    spread = np.array([0.8, 0.4, 1.8, 0.8])
+    return np.round(np.abs(rng.normal(means, spread, (count, 4))), 1)
+
+
+def synthetic_dataset(count: int, seed: int = 42) -> list[dict[str, Any]]:
+    """``synthetic_rows()`` as ``SampleDict``-style rows with random species."""
+    labels = np.random.default_rng(seed + 1).integers(len(SPECIES), size=count)
+    return [
+        dict(zip(FEATURES, row), species=SPECIES[label])
+        for row, label in zip(synthetic_rows(count, seed).tolist(), labels.tolist())
+    ]
+
+
+def allocated(build: Callable[[], Any]) -> int:
+    """Bytes still allocated by ``build()``'s result once it returns."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def known_samples(rows: np.ndarray, species: list[str]) -> list[KnownSample]:
+    return [
+        KnownSample(*row, purpose=Purpose.Training, species=name)
+        for row, name in zip(rows.tolist(), species)
+    ]
+
+
+def sample_arrays(rows: np.ndarray, labels: np.ndarray) -> SampleViews:
+    arrays = SampleArrays(len(rows))
+    arrays.extend(rows, labels)
+    return SampleViews(arrays, SpeciesCodes(SPECIES), Purpose.Training)
+
+
+def memory_per_sample(count: int) -> dict[str, float]:
+    """Bytes per sample for a list of KnownSample and for SampleArrays."""
+    rows = synthetic_rows(count)
+    labels = np.random.default_rng(7).integers(len(SPECIES), size=count)
+    species = [SPECIES[label] for label in labels.tolist()]
+    return {
+        "KnownSample list": allocated(lambda: known_samples(rows, species)) / count,
+        "SampleArrays": allocated(lambda: sample_arrays(rows, labels)) / count,
+    }
+
+
+def training_rows(rows: list[dict[str, Any]]) -> Iterable[dict[str, Any]]:
+    """The rows ``ch6_model.TrainingData.load()`` keeps for training."""
+    return (row for n, row in enumerate(rows) if n % 5 != 0)
+
+
+class Variant(abc.ABC):
+    """How one model module loads training data and classifies a sample."""
+
+    name: str
+
+    @abc.abstractmethod
+    def load(self, rows: list[dict[str, Any]]) -> Any:
+        ...
+
+    @abc.abstractmethod
+    def hyperparameter(self, training: Any, k: int, algorithm: Distance) -> Any:
+        ...
+
+    @abc.abstractmethod
+    def unknown(self, row: dict[str, Any]) -> Any:
+        ...
+
+    def classify(self, parameter: Any, unknown: Any) -> str:
+        return parameter.classify(unknown)  # type: ignore[no-any-return]
+
+    def classify_batch(self, parameter: Any, unknowns: list[Any]) -> list[str]:
+        return [parameter.classify(unknown) for unknown in unknowns]
+
+
+class Ch6Variant(Variant):
+    name = "ch6_model"
+
+    def load(self, rows: list[dict[str, Any]]) -> TrainingData:
+        training_data = TrainingData("benchmark")
+        training_data.load(rows)
+        return training_data
+
+    def hyperparameter(
+        self, training: TrainingData, k: int, algorithm: Distance
+    ) -> Hyperparameter:
+        return Hyperparameter(k=k, algorithm=algorithm, training=training)
+
+    def unknown(self, row: dict[str, Any]) -> UnknownSample:
+        return UnknownSample(*(row[name] for name in FEATURES))
+
+    def classify_batch(
+        self, parameter: Hyperparameter, unknowns: list[UnknownSample]
+    ) -> list[str]:
+        return list(parameter.classify_many(unknowns))
+
+
+class DataclassVariant(Variant):
+    name = "model"
+
+    def load(self, rows: list[dict[str, Any]]) -> model.TrainingData:
+        return model.TrainingData(
+            testing=[],
+            training=[model.TrainingKnownSample(**row) for row in training_rows(rows)],
+            tuning=[],
+        )
+
+    def hyperparameter(
+        self, training: model.TrainingData, k: int, algorithm: Distance
+    ) -> model.Hyperparameter:
+        return model.Hyperparameter(k, algorithm, weakref.ref(training))  # type: ignore[arg-type]
+
+    def unknown(self, row: dict[str, Any]) -> model.UnknownSample:
+        return model.UnknownSample(*(row[name] for name in FEATURES))
+
+
+class FrozenVariant(Variant):
+    name = "model_f"
+
+    def load(self, rows: list[dict[str, Any]]) -> model_f.TrainingData:
+        return model_f.TrainingData(
+            testing=[],
+            training=[
+                model_f.TrainingKnownSample(model_f.KnownSample(**row))
+                for row in training_rows(rows)
+            ],
+            tuning=[],
+        )
+
+    def hyperparameter(
+        self, training: model_f.TrainingData, k: int, algorithm: Distance
+    ) -> model_f.Hyperparameter:
+        return model_f.Hyperparameter(k, algorithm, weakref.ref(training))  # type: ignore[arg-type]
+
+    def unknown(self, row: dict[str, Any]) -> model_f.Sample:
+        return model_f.Sample(*(row[name] for name in FEATURES))
+
+
+class NamedTupleDistance(Distance):
+    """A ch6 Distance for model_t, whose KnownSample wraps a Sample."""
+
+    def __init__(self, algorithm: Distance) -> None:
+        self.algorithm = algorithm
+
+    def distance(self, s1: Any, s2: Any) -> float:
+        return self.algorithm.distance(s1, s2.sample)
+
+
+class NamedTupleVariant(Variant):
+    name = "model_t"
+
+    def load(self, rows: list[dict[str, Any]]) -> model_t.TrainingData:
+        training_data = model_t.TrainingData()
+        training_data.training = [
+            model_t.TrainingKnownSample(
+                model_t.KnownSample(
+                    model_t.Sample(*(row[name] for name in FEATURES)), row["species"]
+                )
+            )
+            for row in training_rows(rows)
+        ]
+        return training_data
+
+    def hyperparameter(
+        self, training: model_t.TrainingData, k: int, algorithm: Distance
+    ) -> model_t.Hyperparameter:
+        return model_t.Hyperparameter(k, NamedTupleDistance(algorithm), training)  # type: ignore[arg-type]
+
+    def unknown(self, row: dict[str, Any]) -> model_t.Sample:
+        return model_t.Sample(*(row[name] for name in FEATURES))
+
+
+VARIANTS: list[Type[Variant]] = [
+    Ch6Variant,
+    DataclassVariant,
+    FrozenVariant,
+    NamedTupleVariant,
+]
+
+
+def percentile_ms(seconds: Sequence[float], q: float) -> float:
+    return float(np.percentile(np.array(seconds) * 1e3, q))
+
+
+def measure(
+    variant: Variant, size: int, queries: int, k: int, memory: bool
+) -> dict[str, Any]:
+    """Load time, memory and per-Distance timings for one variant at one size."""
+    rows = synthetic_dataset(size)
+    # A query through the object variants costs about a second at 10**6 rows.
+    query_count = max(5, min(queries, queries * 10_000 // size))
+    unknowns = [variant.unknown(row) for row in synthetic_dataset(query_count, seed=7)]
+    gc.collect()
+    start = time.perf_counter()
+    training = variant.load(rows)
+    load_seconds = time.perf_counter() - start
+    result: dict[str, Any] = {
+        "variant": variant.name,
+        "size": size,
+        "load_seconds": load_seconds,
+        "bytes_per_sample": (
+            allocated(lambda: variant.load(rows)) / size if memory else None
+        ),
+        "queries": query_count,
+        "distances": {},
+    }
+    for distance_class in DISTANCES:
+        parameter = variant.hyperparameter(training, k, distance_class())
+        variant.classify(parameter, unknowns[0])  # Builds any lazy index first.
+        latencies = []
+        for unknown in unknowns:
+            start = time.perf_counter()
+            variant.classify(parameter, unknown)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        variant.classify_batch(parameter, unknowns)
+        batch_seconds = time.perf_counter() - start
+        result["distances"][distance_class.__name__] = {
+            "latency_p50_ms": percentile_ms(latencies, 50),
+            "latency_p99_ms": percentile_ms(latencies, 99),
+            "batch_samples_per_second": query_count / batch_seconds,
+        }
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    sizes: Iterable[int],
+    variants: Iterable[Type[Variant]] = VARIANTS,
+    queries: int = 100,
+    k: int = 5,
+    memory: bool = True,
+) -> dict[str, Any]:
+    """Measure every variant at every size; the JSON-ready report."""
+    sizes = list(sizes)
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "k": k,
+        "results": [
+            measure(variant_class(), size, queries, k, memory)
+            for size in sizes
+            for variant_class in variants
+        ],
+        # How ch6_model holds the samples, apart from any model module.
+        "memory_per_sample": (
+            {str(size): memory_per_sample(size) for size in sizes} if memory else None
+        ),
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the classifier models.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6]
+    )
+    parser.add_argument(
+        "--variants",
+        nargs="+",
+        choices=[v.name for v in VARIANTS],
+        default=[v.name for v in VARIANTS],
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the tracemalloc pass"
+    )
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args(argv)
+    variants = [v for v in VARIANTS if v.name in args.variants]
+    report = run(args.sizes, variants, args.queries, args.k, not args.no_memory)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
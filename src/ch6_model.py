@@ -1,20 +1,37 @@
 import abc
+import csv
+import enum
+import functools
+import itertools
+import json
 import math
+from math import isclose
 import random
+import time
+import weakref
 import datetime
 import collections
 import collections.abc
+import concurrent.futures
+import contextlib
+from multiprocessing import shared_memory
+from pathlib import Path
 from typing import (
-    Optional, Iterable, Union, Counter, 
-    TypedDict, List, overload, Tuple
+    Any, Mapping, Optional, Iterable, Iterator, Sequence, Union, Counter, Protocol,
+    TypedDict, List, Literal, NamedTuple, overload, Tuple, cast, Hashable
 )
 
+import numpy as np
+from numpy.typing import NDArray
+
 from src.model import Sample
 
 
 class Sample:
     """Abstract superclass for all samples."""
 
+    __slots__ = ("sepal_length", "sepal_width", "petal_length", "petal_width")
+
     def __init__(
         self,
         sepal_length: float,
@@ -27,6 +44,16 @@ class Sample:
         self.petal_length = petal_length
         self.petal_width = petal_width
 
+    @property
+    def features(self) -> tuple[float, float, float, float]:
+        """The four measurements, in the order of the feature matrix columns."""
+        return (
+            self.sepal_length,
+            self.sepal_width,
+            self.petal_length,
+            self.petal_width,
+        )
+
     def __eq__(self, other: Any) -> bool:
         if type(other) != type(self):
             return False
@@ -66,6 +93,8 @@ class KnownSample(Sample):
     The purpose determines if it can or cannot be classified.
     """
 
+    __slots__ = ("purpose", "species", "_classification")
+
     def __init__(
         self,
         sepal_length: float,
@@ -120,6 +149,8 @@ class KnownSample(Sample):
 class UnknownSample(Sample):
     """A sample provided by a User, to be classified."""
 
+    __slots__ = ("_classification",)
+
     def __init__(
         self,
         sepal_length: float,
@@ -150,11 +181,238 @@ class UnknownSample(Sample):
         return f"{self.__class__.__name__}({attrs})"
 
 
+class SampleView(KnownSample):
+    """One row of a SampleArrays, with the attribute API of KnownSample.
+
+    A view holds only the arrays, the species table and a row number; the
+    measurements, species and classification are read from, and written to,
+    the arrays' columns.
+    """
+
+    __slots__ = ("_arrays", "_codes", "_row")
+
+    def __init__(
+        self,
+        arrays: "SampleArrays",
+        codes: "SpeciesCodes",
+        row: int,
+        purpose: Purpose,
+    ) -> None:
+        self._arrays = arrays
+        self._codes = codes
+        self._row = row
+        self.purpose = purpose
+
+    @property  # type: ignore[override]
+    def sepal_length(self) -> float:
+        return float(self._arrays.features[self._row, 0])
+
+    @property  # type: ignore[override]
+    def sepal_width(self) -> float:
+        return float(self._arrays.features[self._row, 1])
+
+    @property  # type: ignore[override]
+    def petal_length(self) -> float:
+        return float(self._arrays.features[self._row, 2])
+
+    @property  # type: ignore[override]
+    def petal_width(self) -> float:
+        return float(self._arrays.features[self._row, 3])
+
+    @property
+    def features(self) -> tuple[float, float, float, float]:
+        return cast(
+            tuple[float, float, float, float],
+            tuple(self._arrays.features[self._row].tolist()),
+        )
+
+    @property  # type: ignore[override]
+    def species(self) -> str:
+        return self._codes.names[self._arrays.labels[self._row]]
+
+    @property  # type: ignore[override]
+    def _classification(self) -> Optional[str]:
+        code = self._arrays.classified[self._row]
+        return None if code < 0 else self._codes.names[code]
+
+    @_classification.setter
+    def _classification(self, value: str) -> None:
+        self._arrays.classified[self._row] = self._codes.code(value)
+
+    def detach(self) -> KnownSample:
+        """A standalone KnownSample with this row's values."""
+        return KnownSample(*self.features, purpose=self.purpose, species=self.species)
+
+
+class SampleViews(collections.abc.Sequence):  # type: ignore[type-arg]
+    """The rows of a SampleArrays as a sequence of SampleView, made on access.
+
+    With ``rows``, an array of row numbers, only those rows, in that order.
+    """
+
+    def __init__(
+        self,
+        arrays: "SampleArrays",
+        codes: "SpeciesCodes",
+        purpose: Purpose,
+        rows: Optional[NDArray[np.intp]] = None,
+    ) -> None:
+        self.arrays = arrays
+        self.codes = codes
+        self.purpose = purpose
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.arrays) if self.rows is None else len(self.rows)
+
+    @property
+    def features(self) -> NDArray[np.float64]:
+        """The (N, 4) features of these rows; a copy only when ``rows`` picks some."""
+        if self.rows is None:
+            return self.arrays.features
+        return self.arrays.features[self.rows]
+
+    @property
+    def labels(self) -> NDArray[np.intp]:
+        if self.rows is None:
+            return self.arrays.labels
+        return self.arrays.labels[self.rows]
+
+    @overload
+    def __getitem__(self, index: int) -> SampleView:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[SampleView]:
+        ...
+
+    def __getitem__(
+        self, index: Union[int, slice]
+    ) -> Union[SampleView, list[SampleView]]:
+        if isinstance(index, slice):
+            return [self[row] for row in range(len(self))[index]]
+        row = range(len(self))[index]
+        if self.rows is not None:
+            row = int(self.rows[row])
+        return SampleView(self.arrays, self.codes, row, self.purpose)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+def parameter_key(value: Any) -> Hashable:
+    """``value`` as something hashable that's equal for equal values.
+
+    Arrays, lists and tuples compare by their contents; anything else
+    unhashable only equals itself.
+    """
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        return tuple(parameter_key(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        return id(value)
+    return cast(Hashable, value)
+
+
 class Distance:
-    """A distance computation"""
+    """A distance computation
+
+    A subclass defines :meth:`distance`, :meth:`array_distance` or both;
+    each has a default built on the other. Every search (brute-force
+    blocks, KDTree, IVFIndex, tuning and cross-validation) goes through the
+    array methods, so a Distance with only ``distance()`` works with all of
+    them, at the speed of one Python call per pair.
+
+    Two Distances are equal when they're the same class with equal
+    parameters, their instance attributes. Neighbor tables are cached per
+    Distance, so ``Manhattan()`` and another ``Manhattan()`` share one, but
+    differently weighted instances of one class don't.
+    """
+
+    # True when the distance only depends on the per-feature differences and
+    # never shrinks as one of them grows. The distance to a bounding box is then
+    # a lower bound for every point inside it, which is what a KDTree prunes on.
+    monotone = False
+
+    def _parameters(self) -> tuple[tuple[str, Hashable], ...]:
+        return tuple(
+            sorted(
+                (name, parameter_key(value))
+                for name, value in getattr(self, "__dict__", {}).items()
+            )
+        )
+
+    def __eq__(self, other: Any) -> bool:
+        if type(other) != type(self):
+            return False
+        return self._parameters() == cast(Distance, other)._parameters()
+
+    def __hash__(self) -> int:
+        return hash((type(self), self._parameters()))
 
     def distance(self, s1: Sample, s2: Sample) -> float:
-        raise NotImplementedError
+        if not has_array_distance(self):
+            raise NotImplementedError
+        return float(
+            self.array_distance(np.array(s1.features), np.array(s2.features))
+        )
+
+    def array_distance(
+        self, query: NDArray[np.float64], reference: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        """Distances between the rows of two feature arrays, broadcast against each other.
+
+        Both are (..., 4); e.g. one query vector against an (N, 4) matrix
+        gives N distances. This default calls :meth:`distance` for each
+        pair, with one Sample per distinct row.
+        """
+        query = np.asarray(query, dtype=np.float64)
+        reference = np.asarray(reference, dtype=np.float64)
+        shape = np.broadcast_shapes(query.shape[:-1], reference.shape[:-1])
+        queries = [UnknownSample(*row) for row in query.reshape(-1, 4).tolist()]
+        references = [UnknownSample(*row) for row in reference.reshape(-1, 4).tolist()]
+        query_rows = np.arange(len(queries)).reshape(query.shape[:-1])
+        reference_rows = np.arange(len(references)).reshape(reference.shape[:-1])
+        pairs = zip(
+            np.broadcast_to(query_rows, shape).flat,
+            np.broadcast_to(reference_rows, shape).flat,
+        )
+        distance = self.distance
+        return np.fromiter(
+            (distance(queries[q], references[r]) for q, r in pairs),
+            dtype=np.float64,
+            count=math.prod(shape),
+        ).reshape(shape)
+
+    def distances(
+        self,
+        query_matrix: Union[Iterable[Sample], NDArray[np.float64]],
+        reference_matrix: Union[Iterable[Sample], NDArray[np.float64]],
+    ) -> NDArray[np.float64]:
+        """The (M, N) distances from each of M query rows to each of N reference rows.
+
+        Either argument may also be samples. The brute-force searches get
+        their distance matrices here, so a subclass with a faster way to
+        compute a whole matrix can override this alone.
+        """
+        return self.array_distance(
+            as_feature_matrix(query_matrix)[:, np.newaxis, :],
+            as_feature_matrix(reference_matrix),
+        )
+
+
+def feature_differences(
+    query: NDArray[np.float64], reference: NDArray[np.float64]
+) -> list[NDArray[np.float64]]:
+    """``|query - reference|`` for each feature, one broadcast column at a time.
+
+    Working per column keeps every intermediate a contiguous (M, N) array,
+    rather than the strided (M, N, 4) array ``query - reference`` would give.
+    """
+    return [np.abs(query[..., j] - reference[..., j]) for j in range(4)]
 
 
 class Chebyshev(Distance):
@@ -177,33 +435,44 @@ class Chebyshev(Distance):
 
     """
 
+    monotone = True
+
     def distance(self, s1: Sample, s2: Sample) -> float:
         return max(
-            [
-                abs(s1.sepal_length - s2.sepal_length),
-                abs(s1.sepal_width - s2.sepal_width),
-                abs(s1.petal_length - s2.petal_length),
-                abs(s1.petal_width - s2.petal_width),
-            ]
+            abs(s1.sepal_length - s2.sepal_length),
+            abs(s1.sepal_width - s2.sepal_width),
+            abs(s1.petal_length - s2.petal_length),
+            abs(s1.petal_width - s2.petal_width),
         )
 
+    def array_distance(
+        self, query: NDArray[np.float64], reference: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        return functools.reduce(np.maximum, feature_differences(query, reference))
+
 
 class Minkowski(Distance):
     """An abstraction to provide a way to implement Manhattan and Euclidean."""
 
     m: int
+    monotone = True
 
     def distance(self, s1: Sample, s2: Sample) -> float:
+        m = self.m
         return (
-            sum(
-                [
-                    abs(s1.sepal_length - s2.sepal_length) ** self.m,
-                    abs(s1.sepal_width - s2.sepal_width) ** self.m,
-                    abs(s1.petal_length - s2.petal_length) ** self.m,
-                    abs(s1.petal_width - s2.petal_width) ** self.m,
-                ]
-            )
-            ** (1 / self.m)
+            abs(s1.sepal_length - s2.sepal_length) ** m
+            + abs(s1.sepal_width - s2.sepal_width) ** m
+            + abs(s1.petal_length - s2.petal_length) ** m
+            + abs(s1.petal_width - s2.petal_width) ** m
+        ) ** (1 / m)
+
+    def array_distance(
+        self, query: NDArray[np.float64], reference: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        # Same left-to-right sum as the scalar version; numpy's power and sqrt
+        # are correctly rounded, so the two can differ from libm pow by an ulp.
+        return sum(d ** self.m for d in feature_differences(query, reference)) ** (
+            1 / self.m
         )
 
 
@@ -217,20 +486,23 @@ class Manhattan(Minkowski):
 
 class Sorensen(Distance):
     def distance(self, s1: Sample, s2: Sample) -> float:
-        return sum(
-            [
-                abs(s1.sepal_length - s2.sepal_length),
-                abs(s1.sepal_width - s2.sepal_width),
-                abs(s1.petal_length - s2.petal_length),
-                abs(s1.petal_width - s2.petal_width),
-            ]
-        ) / sum(
-            [
-                s1.sepal_length + s2.sepal_length,
-                s1.sepal_width + s2.sepal_width,
-                s1.petal_length + s2.petal_length,
-                s1.petal_width + s2.petal_width,
-            ]
+        return (
+            abs(s1.sepal_length - s2.sepal_length)
+            + abs(s1.sepal_width - s2.sepal_width)
+            + abs(s1.petal_length - s2.petal_length)
+            + abs(s1.petal_width - s2.petal_width)
+        ) / (
+            (s1.sepal_length + s2.sepal_length)
+            + (s1.sepal_width + s2.sepal_width)
+            + (s1.petal_length + s2.petal_length)
+            + (s1.petal_width + s2.petal_width)
+        )
+
+    def array_distance(
+        self, query: NDArray[np.float64], reference: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        return sum(feature_differences(query, reference)) / sum(
+            query[..., j] + reference[..., j] for j in range(4)
         )
 
 
@@ -268,6 +540,10 @@ class Minkowski_2(Distance):
     m: int
     reduction: Reduce_Function
 
+    @property
+    def monotone(self) -> bool:  # type: ignore[override]
+        return self.reduction in (sum, max, min)
+
     def distance(self, s1: Sample, s2: Sample) -> float:
         # Required to prevent Python from passing `self` as the first argument.
         summarize = self.reduction
@@ -283,147 +559,2008 @@ class Minkowski_2(Distance):
             ** (1 / self.m)
         )
 
+    def array_distance(
+        self, query: NDArray[np.float64], reference: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        d = [diff ** self.m for diff in feature_differences(query, reference)]
+        summarize = self.reduction
+        if summarize is sum:
+            reduced = sum(d)
+        elif summarize is max:
+            reduced = functools.reduce(np.maximum, d)
+        elif summarize is min:
+            reduced = functools.reduce(np.minimum, d)
+        else:
+            # An arbitrary reduction has to see each row as a list.
+            reduced = np.apply_along_axis(
+                lambda row: summarize(list(row)), -1, np.stack(d, axis=-1)
+            )
+        return reduced ** (1 / self.m)
+
+
+BLOCK_BYTES = 4 * 2**20
+
+
+def as_feature_matrix(
+    samples: Union[Iterable[Sample], NDArray[np.float64]]
+) -> NDArray[np.float64]:
+    """An (M, 4) float64 matrix from samples or anything array-like."""
+    if isinstance(samples, SampleViews):
+        return samples.features
+    if isinstance(samples, np.ndarray):
+        return np.ascontiguousarray(samples, dtype=np.float64).reshape(-1, 4)
+    return np.array([s.features for s in samples], dtype=np.float64).reshape(-1, 4)
+
+
+def k_smallest(distances: NDArray[np.float64], k: int) -> NDArray[np.intp]:
+    """Indices of the k smallest distances, nearest first, in O(N).
+
+    Ties are broken by training index, so the result is the same as
+    ``np.argsort(distances, kind="stable")[:k]`` without the full sort.
+    """
+    if k >= len(distances):
+        return np.argsort(distances, kind="stable")
+    kth = distances[np.argpartition(distances, k - 1)[k - 1]]
+    candidates = np.flatnonzero(distances <= kth)
+    order = np.argsort(distances[candidates], kind="stable")[:k]
+    return candidates[order]
+
+
+def k_smallest_rows(distances: NDArray[np.float64], k: int) -> NDArray[np.intp]:
+    """:func:`k_smallest` applied to every row of a (M, N) distance matrix."""
+    if k >= distances.shape[1]:
+        return np.argsort(distances, axis=1, kind="stable")
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1 : k]
+    below = distances < kth
+    tied = distances == kth
+    # Fill each row up to k with the lowest-indexed samples tied at the k-th distance.
+    room = k - below.sum(axis=1, keepdims=True)
+    chosen = below | (tied & (np.cumsum(tied, axis=1) <= room))
+    nearest = np.nonzero(chosen)[1].reshape(-1, k)
+    order = np.argsort(
+        np.take_along_axis(distances, nearest, axis=1), axis=1, kind="stable"
+    )
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def class_votes(
+    labels: NDArray[np.intp],
+    classes: int,
+    weights: Optional[NDArray[np.float64]] = None,
+) -> NDArray[np.float64]:
+    """Each class's vote total in each row of a (M, k) label array, a (M, classes) array.
+
+    With ``weights``, shaped like ``labels``, each neighbor's vote counts that much.
+    """
+    is_class = labels[..., np.newaxis] == np.arange(classes)
+    if weights is None:
+        return is_class.sum(axis=1).astype(np.float64)
+    return (is_class * weights[..., np.newaxis]).sum(axis=1)
+
+
+def distance_weights(distances: NDArray[np.float64]) -> NDArray[np.float64]:
+    """Inverse-distance vote weights for each row of neighbor distances.
+
+    Exact matches, at distance 0, share all of their row's weight.
+    """
+    exact = distances == 0
+    with np.errstate(divide="ignore"):
+        inverse = 1 / distances
+    return np.where(exact.any(axis=-1, keepdims=True), exact, inverse)
+
+
+def majority_vote(
+    labels: NDArray[np.intp],
+    classes: int,
+    weights: Optional[NDArray[np.float64]] = None,
+) -> NDArray[np.intp]:
+    """The most common label in each row of a (M, k) array, nearest first.
+
+    With ``weights``, the label with the largest total weight.
+    Equal vote counts go to the label seen first, as ``Counter.most_common()`` does.
+    """
+    is_class = labels[..., np.newaxis] == np.arange(classes)
+    votes = class_votes(labels, classes, weights)
+    first_seen = np.where(is_class.any(axis=1), is_class.argmax(axis=1), labels.shape[1])
+    first_seen[votes < votes.max(axis=1, keepdims=True)] = labels.shape[1] + 1
+    return first_seen.argmin(axis=1)
+
+
+def distance_blocks(
+    algorithm: Distance,
+    features: NDArray[np.float64],
+    queries: NDArray[np.float64],
+    block_size: Optional[int] = None,
+) -> Iterator[tuple[slice, NDArray[np.float64]]]:
+    """(block, N) distance matrices for ``queries``, a block of rows at a time.
+
+    By default the block is sized so each matrix stays under ``BLOCK_BYTES``.
+    """
+    if block_size is None:
+        block_size = max(1, BLOCK_BYTES // (8 * max(1, len(features))))
+    for start in range(0, len(queries), block_size):
+        rows = slice(start, start + block_size)
+        yield rows, algorithm.distances(queries[rows], features)
+
+
+def nearest_blocks(
+    algorithm: Distance,
+    k: int,
+    features: NDArray[np.float64],
+    queries: NDArray[np.float64],
+    block_size: Optional[int] = None,
+) -> Iterator[tuple[slice, NDArray[np.intp]]]:
+    """Brute-force k nearest training rows of ``queries``, a block at a time."""
+    for rows, distances in distance_blocks(algorithm, features, queries, block_size):
+        yield rows, k_smallest_rows(distances, k)
+
+
+def knn_predict(
+    algorithm: Distance,
+    k: int,
+    features: NDArray[np.float64],
+    labels: NDArray[np.intp],
+    classes: int,
+    queries: NDArray[np.float64],
+    block_size: Optional[int] = None,
+) -> NDArray[np.intp]:
+    """Brute-force k-NN label for every row of ``queries``."""
+    predicted = np.empty(len(queries), dtype=np.intp)
+    for rows, nearest in nearest_blocks(algorithm, k, features, queries, block_size):
+        predicted[rows] = majority_vote(labels[nearest], classes)
+    return predicted
+
+
+def knn_table(
+    algorithm: Distance,
+    k: int,
+    features: NDArray[np.float64],
+    queries: NDArray[np.float64],
+    block_size: Optional[int] = None,
+) -> NDArray[np.intp]:
+    """The (M, k) table of nearest training rows for every query, nearest first."""
+    table = np.empty((len(queries), min(k, len(features))), dtype=np.intp)
+    for rows, nearest in nearest_blocks(algorithm, k, features, queries, block_size):
+        table[rows] = nearest
+    return table
+
+
+def score_table(
+    table: NDArray[np.intp],
+    labels: NDArray[np.intp],
+    expected: NDArray[np.intp],
+    classes: int,
+    ks: Iterable[int],
+) -> list[float]:
+    """Quality for each k, voting with the first k columns of a neighbor table."""
+    return [
+        float(np.mean(majority_vote(labels[table[:, :k]], classes) == expected))
+        for k in ks
+    ]
+
+
+def has_array_distance(algorithm: Distance) -> bool:
+    """True when ``algorithm`` has its own, vectorized, ``array_distance()``."""
+    return type(algorithm).array_distance is not Distance.array_distance
+
+
+class KDTree:
+    """A k-d tree over a feature matrix, for a ``monotone`` Distance.
+
+    The matrix is split at the median of its widest feature until each leaf
+    holds at most ``leaf_size`` rows. Rows are reordered so that each leaf is a
+    contiguous slice of ``points``; ``index`` maps them back to rows of the
+    original matrix. Only the leaves' bounding boxes are kept: a query bounds
+    every leaf at once with one vectorized distance computation, which in numpy
+    is far cheaper than walking the interior nodes one at a time.
+
+    The tree can follow a changing matrix without being rebuilt: ``insert()``
+    keeps new rows in ``extra``, which every query scans by brute force,
+    ``remove()`` marks a row dead, and ``move()`` renumbers one. ``stale``
+    counts those changes so the owner can decide when a rebuild pays off.
+    """
+
+    def __init__(self, features: NDArray[np.float64], leaf_size: int = 128) -> None:
+        self.leaf_size = leaf_size
+        self.index = np.arange(len(features))
+        leaves: list[tuple[int, int]] = []
+        self._split(features, 0, len(features), leaves)
+        self.start = np.array([start for start, end in leaves], dtype=np.intp)
+        self.end = np.array([end for start, end in leaves], dtype=np.intp)
+        self.points = features[self.index]
+        boxes = [self.points[start:end] for start, end in leaves]
+        self.lower = np.array([box.min(axis=0, initial=np.inf) for box in boxes])
+        self.upper = np.array([box.max(axis=0, initial=-np.inf) for box in boxes])
+        self._unchanged()
+
+    # The arrays that define a tree; save them to rebuild it with from_arrays().
+    arrays = ("index", "start", "end", "points", "lower", "upper")
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: dict[str, NDArray[Any]], leaf_size: int = 128
+    ) -> "KDTree":
+        """A tree from another tree's ``arrays``, e.g. memory-mapped from a snapshot."""
+        tree = cls.__new__(cls)
+        tree.leaf_size = leaf_size
+        for name in cls.arrays:
+            setattr(tree, name, arrays[name])
+        tree._unchanged()
+        return tree
+
+    def _unchanged(self) -> None:
+        # What remove() and move() need per row is only allocated on first use,
+        # so a read-only tree costs nothing beyond its arrays.
+        self.position: Optional[NDArray[np.intp]] = None
+        self.leaf: Optional[NDArray[np.intp]] = None
+        self.live: Optional[NDArray[np.bool_]] = None
+        self.live_count = self.end - self.start
+        # Rows inserted since the tree was built; their labels are row numbers.
+        self.extra = SampleArrays()
+        self.extra_slot: dict[int, int] = {}
+        self.stale = 0
+
+    def _track(self) -> tuple[NDArray[np.intp], NDArray[np.intp], NDArray[np.bool_]]:
+        if self.position is None or self.leaf is None or self.live is None:
+            if not self.index.flags.writeable:
+                self.index = self.index.copy()
+            self.position = np.empty(len(self.index), dtype=np.intp)
+            self.position[self.index] = np.arange(len(self.index))
+            self.leaf = np.repeat(np.arange(len(self.start)), self.end - self.start)
+            self.live = np.ones(len(self.index), dtype=bool)
+        return self.position, self.leaf, self.live
+
+    def insert(self, rows: NDArray[np.intp], features: NDArray[np.float64]) -> None:
+        """Add new rows, which are searched by brute force until a rebuild."""
+        first = len(self.extra)
+        self.extra_slot.update(zip(rows.tolist(), range(first, first + len(rows))))
+        self.extra.extend(features, rows)
+        self.stale += len(rows)
+
+    def remove(self, row: int) -> None:
+        """Drop a row from every later query."""
+        if row in self.extra_slot:
+            slot = self.extra_slot.pop(row)
+            last = len(self.extra) - 1
+            if slot != last:
+                self.extra_slot[int(self.extra.labels[last])] = slot
+            self.extra.swap_remove(slot)
+        else:
+            positions, leaf, live = self._track()
+            position = positions[row]
+            live[position] = False
+            self.live_count[leaf[position]] -= 1
+        self.stale += 1
+
+    def move(self, source: int, target: int) -> None:
+        """Renumber row ``source`` as ``target``, which must not be in use."""
+        if source in self.extra_slot:
+            slot = self.extra_slot.pop(source)
+            self.extra_slot[target] = slot
+            self.extra.labels[slot] = target
+        else:
+            positions, leaf, live = self._track()
+            position = positions[source]
+            self.index[position] = target
+            positions[target] = position
+
+    def _split(
+        self,
+        features: NDArray[np.float64],
+        start: int,
+        end: int,
+        leaves: list[tuple[int, int]],
+    ) -> None:
+        if end - start <= self.leaf_size:
+            leaves.append((start, end))
+            return
+        segment = self.index[start:end]
+        box = features[segment]
+        axis = int(np.argmax(np.ptp(box, axis=0)))
+        mid = (start + end) // 2
+        self.index[start:end] = segment[np.argpartition(box[:, axis], mid - start)]
+        self._split(features, start, mid, leaves)
+        self._split(features, mid, end, leaves)
+
+    def _rows(self, leaves: NDArray[np.intp]) -> NDArray[np.intp]:
+        return np.concatenate(
+            [np.arange(self.start[leaf], self.end[leaf]) for leaf in leaves.tolist()]
+            or [np.empty(0, dtype=np.intp)]
+        )
+
+    def query(
+        self, algorithm: Distance, query: NDArray[np.float64], k: int
+    ) -> NDArray[np.intp]:
+        """Rows of the k nearest samples, nearest first, ties broken by row."""
+        return self.nearest(algorithm, query, k)[0]
+
+    def nearest(
+        self, algorithm: Distance, query: NDArray[np.float64], k: int
+    ) -> tuple[NDArray[np.intp], NDArray[np.float64]]:
+        """Rows of the k nearest samples and their distances, like ``query()``."""
+        bounds = self._bounds(algorithm, query)
+        order = np.argsort(bounds, kind="stable")
+        # The closest leaves holding k rows put a ceiling on the k-th distance;
+        # no leaf whose box is farther than that can contribute.
+        sizes = np.cumsum(self.live_count[order])
+        first = self._live_rows(order[: np.searchsorted(sizes, k) + 1])
+        kth = np.inf
+        if len(first) >= k:
+            kth = np.partition(algorithm.array_distance(query, self.points[first]), k - 1)[k - 1]
+        leaves = order[: np.searchsorted(bounds[order], kth, side="right")]
+        rows, distances = self._search(algorithm, query, leaves, kth)
+        return rows[:k], distances[:k]
+
+    def within(
+        self, algorithm: Distance, query: NDArray[np.float64], radius: float
+    ) -> tuple[NDArray[np.intp], NDArray[np.float64]]:
+        """Rows of every sample no farther than ``radius`` and their distances, nearest first.
+
+        Only leaves whose boxes reach the radius are scanned, in one pass,
+        with no k-th distance to find first.
+        """
+        bounds = self._bounds(algorithm, query)
+        return self._search(algorithm, query, np.flatnonzero(bounds <= radius), radius)
+
+    def _bounds(
+        self, algorithm: Distance, query: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        """The least distance from ``query`` to anything in each leaf."""
+        gaps = np.maximum(0.0, np.maximum(self.lower - query, query - self.upper))
+        return algorithm.array_distance(np.zeros(4), gaps)
+
+    def _live_rows(self, leaves: NDArray[np.intp]) -> NDArray[np.intp]:
+        rows = self._rows(leaves)
+        if self.live is not None:
+            rows = rows[self.live[rows]]
+        return rows
+
+    def _search(
+        self,
+        algorithm: Distance,
+        query: NDArray[np.float64],
+        leaves: NDArray[np.intp],
+        limit: float,
+    ) -> tuple[NDArray[np.intp], NDArray[np.float64]]:
+        """Rows in ``leaves`` and ``extra`` no farther than ``limit``, nearest first."""
+        rows = self._live_rows(leaves)
+        distances = algorithm.array_distance(query, self.points[rows])
+        original = self.index[rows]
+        if len(self.extra):
+            distances = np.concatenate(
+                [distances, algorithm.array_distance(query, self.extra.features)]
+            )
+            original = np.concatenate([original, self.extra.labels])
+        inside = distances <= limit
+        original, distances = original[inside], distances[inside]
+        order = np.lexsort((original, distances))
+        return original[order], distances[order]
+
+
+def nearest_centroids(
+    features: NDArray[np.float64], centroids: NDArray[np.float64]
+) -> NDArray[np.intp]:
+    """The (Euclidean) nearest centroid of each row, a block of rows at a time."""
+    assignment = np.empty(len(features), dtype=np.intp)
+    squared = (centroids**2).sum(axis=1)
+    block_size = max(1, BLOCK_BYTES // (8 * max(1, len(centroids))))
+    for start in range(0, len(features), block_size):
+        block = features[start : start + block_size]
+        # |x - c|^2 less the |x|^2 every centroid shares.
+        assignment[start : start + block_size] = np.argmin(
+            squared - 2 * block @ centroids.T, axis=1
+        )
+    return assignment
+
+
+def kmeans_centroids(
+    features: NDArray[np.float64],
+    count: int,
+    iterations: int = 10,
+    seed: Optional[int] = 0,
+    sample_size: int = 64,
+) -> NDArray[np.float64]:
+    """``count`` centroids from Lloyd's k-means on up to ``sample_size * count`` rows."""
+    rng = np.random.default_rng(seed)
+    count = max(1, min(count, len(features)))
+    size = min(len(features), sample_size * count)
+    sample = features[np.sort(rng.choice(len(features), size, replace=False))]
+    centroids = sample[rng.choice(len(sample), count, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(sample, centroids)
+        sizes = np.bincount(assignment, minlength=count)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = sizes == 0
+        centroids[~empty] = sums[~empty] / sizes[~empty, np.newaxis]
+        # An empty cluster starts again from a random row.
+        centroids[empty] = sample[rng.choice(len(sample), np.count_nonzero(empty))]
+    return centroids
+
+
+class IVFIndex:
+    """An inverted-file index for approximate nearest-neighbor search.
+
+    The rows are grouped into lists around ``lists`` k-means centroids. A
+    query ranks the centroids by distance and scans only the rows in the
+    ``probes`` closest lists, about probes/lists of the training set. A
+    true neighbor in a list that isn't probed is missed, so more probes buy
+    recall with time; probing every list is an exact search.
+
+    Each list is padded out to the longest in one (lists, longest) table of
+    rows, with a copy of their features alongside, so a block of queries
+    gathers all its candidates with one fancy index. A query that finds
+    fewer than k rows in its probed lists is answered by a brute-force scan
+    instead.
+    """
+
+    def __init__(
+        self,
+        features: NDArray[np.float64],
+        lists: int,
+        centroids: Optional[NDArray[np.float64]] = None,
+        seed: Optional[int] = 0,
+    ) -> None:
+        self.features = features
+        self.centroids = (
+            kmeans_centroids(features, lists, seed=seed) if centroids is None else centroids
+        )
+        assignment = nearest_centroids(features, self.centroids)
+        self.sizes = np.bincount(assignment, minlength=len(self.centroids))
+        order = np.argsort(assignment, kind="stable")
+        grouped = assignment[order]
+        starts = np.cumsum(self.sizes) - self.sizes
+        self.table = np.full(
+            (len(self.centroids), max(1, int(self.sizes.max(initial=0)))), -1, dtype=np.intp
+        )
+        self.table[grouped, np.arange(len(order)) - starts[grouped]] = order
+        # Each list's rows side by side, one feature at a time, so a probe
+        # copies contiguous blocks and distances read contiguous columns.
+        padded = features[np.maximum(self.table, 0)]
+        self.columns = np.ascontiguousarray(np.moveaxis(padded, -1, 0))
+
+    def nearest_blocks(
+        self,
+        algorithm: Distance,
+        queries: NDArray[np.float64],
+        k: int,
+        probes: int,
+        block_size: Optional[int] = None,
+    ) -> Iterator[tuple[slice, NDArray[np.intp], NDArray[np.float64]]]:
+        """The approximate k nearest rows of a block of queries, and their distances."""
+        k = min(k, len(self.features))
+        probes = min(probes, len(self.centroids))
+        if probes * self.table.shape[1] < k:
+            probes = len(self.centroids)
+        width = probes * self.table.shape[1]
+        if block_size is None:
+            block_size = max(1, BLOCK_BYTES // (8 * max(width, len(self.centroids))))
+        for start in range(0, len(queries), block_size):
+            block = slice(start, start + block_size)
+            query = queries[block, np.newaxis, :]
+            lists = k_smallest_rows(algorithm.array_distance(query, self.centroids), probes)
+            candidates = self.table[lists].reshape(len(lists), -1)
+            found = candidates >= 0
+            points = self.columns[:, lists].reshape(4, len(lists), -1)
+            distances = algorithm.array_distance(query, np.moveaxis(points, 0, -1))
+            distances[~found] = np.inf
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            chosen = np.take_along_axis(distances, nearest, axis=1)
+            kth = chosen.max(axis=1, keepdims=True)
+            # As in an exact search, ties at the k-th distance go to the lowest
+            # rows. Only queries with more tied candidates than room are sorted.
+            unsettled = np.flatnonzero(
+                (distances == kth).sum(axis=1) > (chosen == kth).sum(axis=1)
+            )
+            if len(unsettled):
+                by_row = np.argsort(candidates[unsettled], axis=1)
+                tied = np.take_along_axis(distances[unsettled], by_row, axis=1)
+                nearest[unsettled] = np.take_along_axis(
+                    by_row, k_smallest_rows(tied, k), axis=1
+                )
+            rows = np.take_along_axis(candidates, nearest, axis=1)
+            distances = np.take_along_axis(distances, nearest, axis=1)
+            order = np.lexsort((rows, distances), axis=1)
+            rows = np.take_along_axis(rows, order, axis=1)
+            distances = np.take_along_axis(distances, order, axis=1)
+            short = np.flatnonzero(found.sum(axis=1) < k)
+            if len(short):
+                everything = algorithm.array_distance(query[short], self.features)
+                rows[short] = k_smallest_rows(everything, k)
+                distances[short] = np.take_along_axis(everything, rows[short], axis=1)
+            yield block, rows, distances
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    maxsize: int
+
+
+PredictionKey = tuple[
+    tuple[float, ...], int, type[Distance], str, Optional[float], Optional[int]
+]
+
+
+class PredictionCache:
+    """A bounded map from a query to its species, evicting the least recently used.
+
+    Entries belong to one ``version`` of the training data; ``check()`` with
+    any other version empties the cache.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.version: Optional[int] = None
+        self._entries: collections.OrderedDict[Hashable, str] = (
+            collections.OrderedDict()
+        )
+        self.hits = self.misses = self.evictions = 0
+
+    def check(self, version: int) -> None:
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key: Hashable) -> Optional[str]:
+        species = self._entries.get(key)
+        if species is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return species
+
+    def put(self, key: Hashable, species: str) -> None:
+        self._entries[key] = species
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self.hits, self.misses, self.evictions, len(self._entries), self.maxsize
+        )
+
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+
+class Prediction(NamedTuple):
+    """Species for each query, with the probability of each class in ``classes``."""
+
+    species: NDArray[np.str_]
+    probabilities: NDArray[np.float64]
+    classes: list[str]
+
 
 class Hyperparameter:
-    """A hyperparameter value and the overall quality of the classification."""
+    """A hyperparameter value and the overall quality of the classification.
+
+    By default the k nearest neighbors each get one vote. With
+    ``weights="distance"`` a neighbor's vote counts 1/distance. With
+    ``radius``, the neighbors are every training sample within that distance
+    rather than the k nearest; a sample with none is classified as
+    ``outlier``, or raises ValueError if that's None. ``predict()`` returns the
+    vote shares as per-class probabilities along with the species.
+
+    With ``probes``, the k nearest come from ``TrainingData.ivf_index``,
+    scanning that many of its lists: faster, but approximate. See
+    ``TrainingData.evaluate_approximation()`` to choose a value.
+
+    Samples passed to the public methods are scaled like the training data
+    (see ``TrainingData.scaler``); the underscored methods take scaled ones.
 
-    def __init__(self, k: int, algorithm: "Distance", training: "TrainingData") -> None:
+    With ``cache_size``, ``classify()`` and ``classify_many()`` remember up to
+    that many predictions, keyed by the sample's features and the voting
+    settings. The cache empties itself when the training data changes.
+    """
+
+    def __init__(
+        self,
+        k: int,
+        algorithm: "Distance",
+        training: "TrainingData",
+        cache_size: int = 0,
+        weights: Literal["uniform", "distance"] = "uniform",
+        radius: Optional[float] = None,
+        outlier: Optional[str] = None,
+        probes: Optional[int] = None,
+    ) -> None:
+        if weights not in ("uniform", "distance"):
+            raise ValueError(f"Unknown weights {weights!r}")
+        if probes is not None and radius is not None:
+            raise ValueError("An approximate search finds the k nearest; use radius=None")
         self.k = k
         self.algorithm = algorithm
         self.data: weakref.ReferenceType["TrainingData"] = weakref.ref(training)
         self.quality: float
+        self.cache = PredictionCache(cache_size) if cache_size else None
+        self.weights = weights
+        self.radius = radius
+        self.outlier = outlier
+        self.probes = probes
+
+    @property
+    def majority(self) -> bool:
+        """True for a plain majority vote of the exact k nearest."""
+        return self.weights == "uniform" and self.radius is None and self.probes is None
+
+    def _cache_key(self, features: Iterable[float]) -> PredictionKey:
+        return (
+            tuple(features),
+            self.k,
+            type(self.algorithm),
+            self.weights,
+            self.radius,
+            self.probes,
+        )
+
+    def _use_index(self, training_data: "TrainingData") -> bool:
+        return (
+            self.algorithm.monotone
+            and len(training_data.training) >= training_data.index_threshold
+        )
 
     def test(self) -> None:
         """Run the entire test suite."""
         training_data: Optional["TrainingData"] = self.data()
         if not training_data:
             raise RuntimeError("Broken Weak Reference")
-        pass_count, fail_count = 0, 0
-        for sample in training_data.testing:
-            sample.classification = self.classify(sample)
-            if sample.matches():
-                pass_count += 1
-            else:
-                fail_count += 1
-        self.quality = pass_count / (pass_count + fail_count)
+        if not self.majority:
+            prediction = self._predict(
+                training_data, training_data.testing_arrays.features, None
+            )
+            predicted = training_data.species_labels(prediction.species)
+        else:
+            nearest = training_data.neighbors(self.algorithm, self.k)
+            classes = len(training_data.species_codes)
+            predicted = majority_vote(training_data.labels[nearest], classes)
+        self.quality = training_data.record_classification(predicted)
 
     def classify(self, sample: Sample) -> str:
         """The k-NN algorithm"""
         training_data = self.data()
         if not training_data:
             raise RuntimeError("No TrainingData object")
-        distances: list[tuple[float, KnownSample]] = sorted(
-            (self.algorithm.distance(sample, known), known)
-            for known in training_data.training
-        )
-        k_nearest = (known.species for d, known in distances[: self.k])
+        if self.cache is None:
+            return self._classify(training_data, training_data.scaled_sample(sample))
+        self.cache.check(training_data.version)
+        key = self._cache_key(sample.features)
+        species = self.cache.get(key)
+        if species is None:
+            species = self._classify(training_data, training_data.scaled_sample(sample))
+            self.cache.put(key, species)
+        return species
+
+    def _classify(self, training_data: "TrainingData", sample: Sample) -> str:
+        if not self.majority:
+            species = self._predict(training_data, as_feature_matrix([sample]), None)
+            return str(species.species[0])
+        k_nearest = self._k_nearest_array(training_data, sample)
         frequency: Counter[str] = collections.Counter(k_nearest)
         best_fit, *others = frequency.most_common()
         species, votes = best_fit
         return species
 
+    def classify_many(
+        self,
+        samples: Union[Iterable[Sample], NDArray[np.float64]],
+        block_size: Optional[int] = None,
+    ) -> NDArray[np.str_]:
+        """Classify many samples at once; returns the species of each one.
+
+        ``samples`` is an iterable of samples or an (M, 4) feature matrix.
+        Distances are computed for ``block_size`` queries at a time; by default
+        the block is sized so each (block, N) distance matrix stays under
+        ``BLOCK_BYTES``.
+        """
+        training_data = self.data()
+        if not training_data:
+            raise RuntimeError("No TrainingData object")
+        queries = as_feature_matrix(samples)
+        if self.cache is None:
+            return self._classify_many(
+                training_data, training_data.scaled(queries), block_size
+            )
+        self.cache.check(training_data.version)
+        keys = [self._cache_key(row) for row in queries.tolist()]
+        cached = [self.cache.get(key) for key in keys]
+        missing = [n for n, species in enumerate(cached) if species is None]
+        if missing:
+            predicted = self._classify_many(
+                training_data, training_data.scaled(queries[missing]), block_size
+            ).tolist()
+            for n, species in zip(missing, predicted):
+                self.cache.put(keys[n], species)
+                cached[n] = species
+        return np.array(cached, dtype=np.str_)
+
+    def _classify_many(
+        self,
+        training_data: "TrainingData",
+        queries: NDArray[np.float64],
+        block_size: Optional[int],
+    ) -> NDArray[np.str_]:
+        if not self.majority:
+            return self._predict(training_data, queries, block_size).species
+        codes = np.array(training_data.species_codes)
+        if self._use_index(training_data):
+            # Past the threshold, one tree query per row beats a brute-force block.
+            index = training_data.index
+            nearest = np.array(
+                [index.query(self.algorithm, row, self.k) for row in queries],
+                dtype=np.intp,
+            ).reshape(len(queries), min(self.k, len(training_data.training)))
+            return codes[majority_vote(training_data.labels[nearest], len(codes))]
+        labels = knn_predict(
+            self.algorithm,
+            self.k,
+            training_data.features,
+            training_data.labels,
+            len(codes),
+            queries,
+            block_size,
+        )
+        return codes[labels]
 
-class TrainingData:
-    """A set of training data and testing data with methods to load and test the samples."""
-
-    def __init__(self, name: str) -> None:
-        self.name = name
-        self.uploaded: datetime.datetime
-        self.tested: datetime.datetime
-        self.training: list[KnownSample] = []
-        self.testing: list[KnownSample] = []
-        self.tuning: list[Hyperparameter] = []
+    def predict(
+        self,
+        samples: Union[Iterable[Sample], NDArray[np.float64]],
+        block_size: Optional[int] = None,
+    ) -> Prediction:
+        """Species and per-class probabilities for many samples, in one pass.
+
+        A sample's probability for a class is that class's share of its
+        (weighted) votes; with ``radius``, an outlier's are all zero.
+        Predictions made here aren't cached.
+        """
+        training_data = self.data()
+        if not training_data:
+            raise RuntimeError("No TrainingData object")
+        queries = training_data.scaled(as_feature_matrix(samples))
+        return self._predict(training_data, queries, block_size)
 
-    def load(self, raw_data_iter: Iterable[dict[str, str]]) -> None:
-        """Extract TestingKnownSample and TrainingKnownSample from raw data"""
-        for n, row in enumerate(raw_data_iter):
-            purpose = Purpose.Testing if n % 5 == 0 else Purpose.Training
-            sample = KnownSample(
-                sepal_length=float(row["sepal_length"]),
-                sepal_width=float(row["sepal_width"]),
-                petal_length=float(row["petal_length"]),
-                petal_width=float(row["petal_width"]),
-                purpose=purpose,
-                species=row["species"],
+    def _predict(
+        self,
+        training_data: "TrainingData",
+        queries: NDArray[np.float64],
+        block_size: Optional[int],
+    ) -> Prediction:
+        classes = list(training_data.species_codes)
+        if self.radius is None:
+            votes, winners = self._nearest_votes(training_data, queries, block_size)
+        else:
+            votes = self._radius_votes(training_data, queries, block_size)
+            winners = votes.argmax(axis=1)
+        totals = votes.sum(axis=1, keepdims=True)
+        probabilities = np.divide(
+            votes, totals, out=np.zeros_like(votes), where=totals > 0
+        )
+        species = [classes[winner] for winner in winners.tolist()]
+        for n in np.flatnonzero(totals[:, 0] == 0).tolist():
+            if self.outlier is None:
+                raise ValueError(
+                    f"No training samples within {self.radius} of {queries[n].tolist()}"
+                )
+            species[n] = self.outlier
+        return Prediction(np.array(species, dtype=np.str_), probabilities, classes)
+
+    def _vote_weights(self, distances: NDArray[np.float64]) -> NDArray[np.float64]:
+        if self.weights == "distance":
+            return distance_weights(distances)
+        return np.ones_like(distances)
+
+    def _nearest_blocks(
+        self,
+        training_data: "TrainingData",
+        queries: NDArray[np.float64],
+        block_size: Optional[int],
+    ) -> Iterator[tuple[slice, NDArray[np.intp], NDArray[np.float64]]]:
+        """The k nearest rows of a block of queries, and their distances."""
+        if self.probes is not None:
+            yield from training_data.ivf_index.nearest_blocks(
+                self.algorithm, queries, self.k, self.probes, block_size
             )
-            if sample.purpose == Purpose.Testing:
-                self.testing.append(sample)
-            else:
-                self.training.append(sample)
-        self.uploaded = datetime.datetime.now(tz=datetime.timezone.utc)
+            return
+        if self._use_index(training_data):
+            index = training_data.index
+            for n, query in enumerate(queries):
+                rows, distances = index.nearest(self.algorithm, query, self.k)
+                yield slice(n, n + 1), rows[np.newaxis], distances[np.newaxis]
+            return
+        for rows, distances in distance_blocks(
+            self.algorithm, training_data.features, queries, block_size
+        ):
+            nearest = k_smallest_rows(distances, self.k)
+            yield rows, nearest, np.take_along_axis(distances, nearest, axis=1)
+
+    def _nearest_votes(
+        self,
+        training_data: "TrainingData",
+        queries: NDArray[np.float64],
+        block_size: Optional[int],
+    ) -> tuple[NDArray[np.float64], NDArray[np.intp]]:
+        """Class vote totals of each query's k nearest, and the winning classes."""
+        classes = len(training_data.species_codes)
+        labels = training_data.labels
+        votes = np.zeros((len(queries), classes))
+        winners = np.empty(len(queries), dtype=np.intp)
+        for rows, nearest, distances in self._nearest_blocks(
+            training_data, queries, block_size
+        ):
+            weights = self._vote_weights(distances)
+            votes[rows] = class_votes(labels[nearest], classes, weights)
+            winners[rows] = majority_vote(labels[nearest], classes, weights)
+        return votes, winners
+
+    def _radius_votes(
+        self,
+        training_data: "TrainingData",
+        queries: NDArray[np.float64],
+        block_size: Optional[int],
+    ) -> NDArray[np.float64]:
+        """Class vote totals of the training samples within ``radius`` of each query.
+
+        Equal totals go to the class listed first in ``species_codes``.
+        """
+        assert self.radius is not None
+        classes = len(training_data.species_codes)
+        labels = training_data.labels
+        votes = np.zeros((len(queries), classes))
+        if self._use_index(training_data):
+            index = training_data.index
+            for n, query in enumerate(queries):
+                rows, distances = index.within(self.algorithm, query, self.radius)
+                votes[n] = np.bincount(
+                    labels[rows], self._vote_weights(distances), classes
+                )
+            return votes
+        one_hot = (labels[:, np.newaxis] == np.arange(classes)).astype(np.float64)
+        for rows, distances in distance_blocks(
+            self.algorithm, training_data.features, queries, block_size
+        ):
+            inside = distances <= self.radius
+            weights = self._vote_weights(np.where(inside, distances, np.inf))
+            votes[rows] = np.where(inside, weights, 0.0) @ one_hot
+        return votes
+
+    def _k_nearest_array(
+        self, training_data: "TrainingData", sample: Sample
+    ) -> list[str]:
+        """One distance computation over the training feature matrix."""
+        query = np.array(sample.features, dtype=np.float64)
+        if self._use_index(training_data):
+            nearest = training_data.index.query(self.algorithm, query, self.k)
+        else:
+            distances = self.algorithm.array_distance(query, training_data.features)
+            nearest = k_smallest(distances, self.k)
+        codes = training_data.species_codes
+        return [codes[label] for label in training_data.labels[nearest]]
 
-    def test(self, parameter: Hyperparameter) -> None:
-        """Test this hyperparamater value."""
-        parameter.test()
-        self.tuning.append(parameter)
-        self.tested = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    def classify(self, parameter: Hyperparameter, sample: UnknownSample) -> str:
-        return parameter.classify(sample)
-    
-class TrainingKnownSample():
-    ...
+SNAPSHOT_FORMAT = 1
 
-class BadSampleRow(ValueError):
-    pass
 
+class SpeciesCodes(dict[str, int]):
+    """Species names and their integer codes, numbered in order of appearance."""
 
-class SampleReader:
-    """See iris.names for attribute ordering in bezdekIris.data file"""
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        super().__init__()
+        self.names: list[str] = []
+        for name in names:
+            self.code(name)
 
-    target_class = Sample
-    header = ["sepal_length", "sepal_width", "petal_length", "petal_width", "class"]
+    def code(self, name: str) -> int:
+        """The code for ``name``, assigning the next one if it's new."""
+        if name not in self:
+            self[name] = len(self.names)
+            self.names.append(name)
+        return self[name]
 
-    def __init__(self, source: Path) -> None:
-        self.source = source
 
-    def sample_iter(self) -> Iterator[Sample]:
-        target_class = self.target_class
-        with self.source.open() as source_file:
-            reader = csv.DictReader(source_file, self.header)
-            for row in reader:
-                try:
-                    sample = target_class(
-                        sepal_length=float(row["sepal_length"]),
-                        sepal_width=float(row["sepal_width"]),
-                        petal_length=float(row["petal_length"]),
-                        petal_width=float(row["petal_width"]),
-                    )
-                except ValueError as ex:
-                    raise BadSampleRow(f"Invalid {row!r}") from ex
-                yield sample
+class SampleArrays:
+    """A growable (N, 4) feature matrix with a species-label vector.
 
-class TestingKnownSample():
-    ...
-    
+    Rows are appended into preallocated buffers that double when full, so
+    loading a large file chunk by chunk costs amortized O(1) per row.
+    """
 
-class SampleDict(TypedDict):
-    sepal_length: float
-    sepal_width: float
-    petal_length: float
-    petal_width: float
-    species: str
+    def __init__(self, capacity: int = 0) -> None:
+        self._features = np.empty((capacity, 4), dtype=np.float64)
+        self._labels = np.empty(capacity, dtype=np.intp)
+        self._classified: Optional[NDArray[np.intp]] = None
+        self.size = 0
 
-class SamplePartition(List[SampleDict], abc.ABC): #추상클래스로 선언/ 리스트를 상속받음
-    @overload
-    def __init__(self, *, training_subsset: float = 0.80) -> None:   # *은 파티션 역할
-        ...
+    @classmethod
+    def wrap(
+        cls, features: NDArray[np.float64], labels: NDArray[np.intp]
+    ) -> "SampleArrays":
+        """Use existing arrays, e.g. memory maps, without copying them.
 
-    @overload
-    def __init__(
-            self, 
-            iterable: Optional[Iterable[SampleDict]] = None,
-            *,
-            training_subset: float = 0.80
-    )-> None:
-            ...
+        They're only copied if rows are appended later.
+        """
+        arrays = cls()
+        arrays._features, arrays._labels = features, labels
+        arrays.size = len(features)
+        return arrays
 
-    def __init__(
-            self, 
-            iterable: Optional[Iterable[SampleDict]] = None,
-            *,
-            training_subset: float = 0.80
-    ) -> None:
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def features(self) -> NDArray[np.float64]:
+        return self._features[: self.size]
+
+    @property
+    def labels(self) -> NDArray[np.intp]:
+        return self._labels[: self.size]
+
+    @property
+    def classified(self) -> NDArray[np.intp]:
+        """The species code each row was classified as, -1 if it hasn't been."""
+        if self._classified is None:
+            self._classified = np.full(len(self._labels), -1, dtype=np.intp)
+        return self._classified[: self.size]
+
+    def extend(self, features: NDArray[np.float64], labels: NDArray[np.intp]) -> None:
+        if not len(features):
+            return
+        end = self.size + len(features)
+        if end > len(self._features):
+            capacity = max(end, 2 * len(self._features))
+            grown = SampleArrays(capacity)
+            grown._features[: self.size] = self.features
+            grown._labels[: self.size] = self.labels
+            if self._classified is not None:
+                grown.classified[: self.size] = self.classified
+            self._features, self._labels = grown._features, grown._labels
+            self._classified = grown._classified
+        self._features[self.size : end] = features
+        self._labels[self.size : end] = labels
+        if self._classified is not None:
+            self._classified[self.size : end] = -1
+        self.size = end
+
+    def swap_remove(self, row: int) -> None:
+        """Drop one row in O(1) by moving the last row into its place."""
+        if not self._features.flags.writeable:
+            # Memory-mapped snapshot arrays are read-only.
+            self._features = self._features.copy()
+            self._labels = self._labels.copy()
+        last = self.size - 1
+        self._features[row] = self._features[last]
+        self._labels[row] = self._labels[last]
+        if self._classified is not None:
+            self._classified[row] = self._classified[last]
+        self.size = last
+
+
+def sample_dict_arrays(
+    rows: Iterable[Mapping[str, Any]], species: "SpeciesCodes"
+) -> tuple[NDArray[np.float64], NDArray[np.intp]]:
+    """Features and species codes of ``SampleDict``-style rows, as arrays."""
+    features: list[tuple[float, float, float, float]] = []
+    labels: list[int] = []
+    for row in rows:
+        features.append(
+            (
+                float(row["sepal_length"]),
+                float(row["sepal_width"]),
+                float(row["petal_length"]),
+                float(row["petal_width"]),
+            )
+        )
+        labels.append(species.code(row["species"]))
+    return (
+        np.array(features, dtype=np.float64).reshape(-1, 4),
+        np.array(labels, dtype=np.intp),
+    )
+
+
+class FeatureScaler:
+    """Per-feature statistics, gathered a block of rows at a time, and the scaling they define.
+
+    ``method`` is "standard", subtracting each feature's mean and dividing by
+    its standard deviation, or "minmax", mapping each feature's range onto
+    [0, 1]. ``update()`` folds in a block with Chan's parallel variance update,
+    so the statistics stream in with the data. ``freeze()`` fixes ``offset``
+    and ``scale``; until then ``fitted`` is False and nothing is scaled.
+    """
+
+    methods = ("standard", "minmax")
+
+    def __init__(self, method: str = "standard") -> None:
+        if method not in self.methods:
+            raise ValueError(f"Unknown scaling {method!r}, expected one of {self.methods}")
+        self.method = method
+        self.count = 0
+        self.mean = np.zeros(4)
+        self.m2 = np.zeros(4)
+        self.minimum = np.full(4, np.inf)
+        self.maximum = np.full(4, -np.inf)
+        self.offset: Optional[NDArray[np.float64]] = None
+        self.scale: Optional[NDArray[np.float64]] = None
+
+    @property
+    def fitted(self) -> bool:
+        return self.offset is not None
+
+    def update(self, features: NDArray[np.float64]) -> None:
+        """Fold an (M, 4) block of rows into the statistics."""
+        if not len(features):
+            return
+        count = len(features)
+        mean = features.mean(axis=0)
+        m2 = ((features - mean) ** 2).sum(axis=0)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.minimum = np.minimum(self.minimum, features.min(axis=0))
+        self.maximum = np.maximum(self.maximum, features.max(axis=0))
+
+    def freeze(self) -> None:
+        """Fix ``offset`` and ``scale`` from the rows seen so far, if there were any."""
+        if not self.count:
+            return
+        if self.method == "standard":
+            offset, scale = self.mean, np.sqrt(self.m2 / self.count)
+        else:
+            offset, scale = self.minimum, self.maximum - self.minimum
+        self.offset = offset
+        # A constant feature is only shifted.
+        self.scale = np.where(scale > 0, scale, 1.0)
+
+    def transform(
+        self,
+        features: NDArray[np.float64],
+        out: Optional[NDArray[np.float64]] = None,
+    ) -> NDArray[np.float64]:
+        """``features`` scaled; pass ``out=features`` to scale them in place."""
+        if self.offset is None or self.scale is None:
+            raise RuntimeError("FeatureScaler hasn't been fitted")
+        scaled = np.subtract(features, self.offset, out=out)
+        scaled /= self.scale
+        return scaled
+
+    def inverse(self, features: NDArray[np.float64]) -> NDArray[np.float64]:
+        """Scaled features back in the original units, as a new array."""
+        if self.offset is None or self.scale is None:
+            raise RuntimeError("FeatureScaler hasn't been fitted")
+        return features * self.scale + self.offset
+
+    def asdict(self) -> dict[str, Any]:
+        return {
+            "method": self.method,
+            "count": self.count,
+            "offset": None if self.offset is None else self.offset.tolist(),
+            "scale": None if self.scale is None else self.scale.tolist(),
+        }
+
+    @classmethod
+    def fromdict(cls, state: dict[str, Any]) -> "FeatureScaler":
+        scaler = cls(state["method"])
+        scaler.count = state["count"]
+        if state["offset"] is not None:
+            scaler.offset = np.array(state["offset"])
+            scaler.scale = np.array(state["scale"])
+        return scaler
+
+
+class TrainingData:
+    """A set of training data and testing data with methods to load and test the samples.
+
+    Each of ``training`` and ``testing`` is held either as a list of
+    KnownSample objects or as SampleArrays, and the other form is derived
+    on demand. Assigning a list makes the list authoritative. ``load()`` and
+    ``load_csv()`` append straight into the arrays, after which ``training``
+    and ``testing`` are SampleViews over them: no object per sample exists
+    until one is looked at.
+
+    ``version`` goes up whenever the training samples change, so anything
+    derived from them can tell when it's stale.
+
+    With ``scaling``, "standard" or "minmax", a FeatureScaler gathers
+    statistics from the training rows as ``load()`` or ``load_csv()`` reads
+    them. At the end of the load they're fixed, and the training and testing
+    arrays are scaled in place. Later rows are scaled with the same
+    statistics as they arrive, and ``Hyperparameter`` scales each query the
+    same way, so the samples seen through ``training`` and ``testing`` are
+    in scaled units. A list assigned to ``training`` is scaled when its
+    arrays are built.
+    """
+
+    # Below this many training samples a brute-force scan beats the KDTree.
+    index_threshold = 16_384
+    # Lists in the IVFIndex; None for about the square root of the training size.
+    ivf_lists: Optional[int] = None
+
+    def __init__(self, name: str, scaling: Optional[str] = None) -> None:
+        self.name = name
+        self.uploaded: datetime.datetime
+        self.tested: datetime.datetime
+        self._species = SpeciesCodes()
+        self.scaler = FeatureScaler(scaling) if scaling else None
+        self.version = 0
+        self.training: list[KnownSample] = []
+        self.testing: list[KnownSample] = []
+        self.tuning: list[Hyperparameter] = []
+
+    @property
+    def training(self) -> Sequence[KnownSample]:
+        if self._training is None:
+            return SampleViews(self.training_arrays, self._species, Purpose.Training)
+        return self._training
+
+    @training.setter
+    def training(self, samples: list[KnownSample]) -> None:
+        self._training: Optional[list[KnownSample]] = samples
+        self._training_arrays: Optional[SampleArrays] = None
+        self._index: Optional[KDTree] = None
+        self._ivf: Optional[IVFIndex] = None
+        self.neighbor_tables: dict[Distance, NDArray[np.intp]] = {}
+        self.version += 1
+
+    @property
+    def testing(self) -> Sequence[KnownSample]:
+        if self._testing is None:
+            return SampleViews(self.testing_arrays, self._species, Purpose.Testing)
+        return self._testing
+
+    @testing.setter
+    def testing(self, samples: list[KnownSample]) -> None:
+        self._testing: Optional[list[KnownSample]] = samples
+        self._testing_arrays: Optional[SampleArrays] = None
+        self.neighbor_tables = {}
+
+    def invalidate(self) -> None:
+        """Drop derived arrays; call after changing ``training`` or ``testing`` in place."""
+        if self._training is not None:
+            self.training = self._training
+        if self._testing is not None:
+            self.testing = self._testing
+
+    def _arrays(self, samples: list[KnownSample]) -> SampleArrays:
+        arrays = SampleArrays(len(samples))
+        arrays.extend(
+            np.array([s.features for s in samples], dtype=np.float64).reshape(-1, 4),
+            np.array([self._species.code(s.species) for s in samples], dtype=np.intp),
+        )
+        return arrays
+
+    @property
+    def training_arrays(self) -> SampleArrays:
+        if self._training_arrays is None:
+            arrays = self._arrays(cast(list[KnownSample], self._training))
+            if self.scaler is not None and not self.scaler.fitted:
+                self.scaler.update(arrays.features)
+                self.scaler.freeze()
+            self._training_arrays = self._scale(arrays)
+        return self._training_arrays
+
+    @property
+    def testing_arrays(self) -> SampleArrays:
+        if self._testing_arrays is None:
+            if self.scaler is not None:
+                self.training_arrays  # Fits the scaler.
+            arrays = self._arrays(cast(list[KnownSample], self._testing))
+            self._testing_arrays = self._scale(arrays)
+        return self._testing_arrays
+
+    def _scale(self, arrays: SampleArrays) -> SampleArrays:
+        """Scale freshly built arrays in place, once the scaler is fitted."""
+        if self.scaler is not None and self.scaler.fitted:
+            self.scaler.transform(arrays.features, out=arrays.features)
+        return arrays
+
+    def scaled(self, features: NDArray[np.float64]) -> NDArray[np.float64]:
+        """Query features in the units of ``features``; a new array if they're scaled."""
+        if self.scaler is None or not self.scaler.fitted:
+            return features
+        return self.scaler.transform(features)
+
+    def scaled_sample(self, sample: Sample) -> Sample:
+        """``sample`` in the units of ``features``, for classification."""
+        if self.scaler is None or not self.scaler.fitted:
+            return sample
+        return UnknownSample(*self.scaled(np.array(sample.features)).tolist())
+
+    @property
+    def features(self) -> NDArray[np.float64]:
+        """The training samples as a contiguous (N, 4) float64 matrix."""
+        return self.training_arrays.features
+
+    @property
+    def labels(self) -> NDArray[np.intp]:
+        """Species of each training row, as indices into ``species_codes``."""
+        return self.training_arrays.labels
+
+    @property
+    def species_codes(self) -> list[str]:
+        """Species names, indexed by the values in ``labels``."""
+        self.training_arrays
+        return self._species.names
+
+    @property
+    def index(self) -> KDTree:
+        """A KDTree over ``features``, built on first use.
+
+        ``add_samples()`` and ``remove_samples()`` patch the tree in place;
+        it's rebuilt once those patches amount to a quarter of the rows, so
+        each change costs amortized O(log N).
+        """
+        if self._index is None or self._index.stale > len(self.features) // 4:
+            self._index = KDTree(self.features)
+        return self._index
+
+    @property
+    def index_built(self) -> bool:
+        return self._index is not None
+
+    @property
+    def ivf_index(self) -> IVFIndex:
+        """An IVFIndex over ``features``, for approximate searches, built on first use.
+
+        When the training samples change, the rows are regrouped around the
+        same centroids; a load trains new ones.
+        """
+        if self._ivf is None:
+            lists = self.ivf_lists or max(1, math.isqrt(len(self.features)))
+            self._ivf = IVFIndex(self.features, lists)
+            self._ivf_version = self.version
+        elif self._ivf_version != self.version:
+            self._ivf = IVFIndex(self.features, 0, self._ivf.centroids)
+            self._ivf_version = self.version
+        return self._ivf
+
+    def neighbors(self, algorithm: Distance, k: int) -> NDArray[np.intp]:
+        """Training rows nearest each testing sample, nearest first.
+
+        The table is computed once per Distance and kept in
+        ``neighbor_tables``; any smaller k is a slice of it, so a sweep over k
+        costs one distance computation. When a larger k is asked for, the
+        table is rebuilt at least twice as wide, so an increasing sweep only
+        rebuilds it a few times.
+        """
+        table = self.neighbor_tables.get(algorithm)
+        if table is None or table.shape[1] < min(k, len(self.training)):
+            width = max(k, 2 * table.shape[1] if table is not None else 16)
+            table = knn_table(
+                algorithm, width, self.features, self.testing_arrays.features
+            )
+            self.neighbor_tables[algorithm] = table
+        return table[:, :k]
+
+    def add_samples(self, samples: Iterable[KnownSample]) -> None:
+        """Append training samples, updating the arrays, index and neighbor tables.
+
+        Each sample costs amortized O(1) for the arrays and O(log N) for the
+        index. Cached neighbor tables only need the new rows folded in.
+        """
+        added = [
+            sample.detach() if isinstance(sample, SampleView) else sample
+            for sample in samples
+        ]
+        if not added:
+            return
+        features = self.scaled(as_feature_matrix(added))
+        labels = self.species_labels(sample.species for sample in added)
+        first = len(self.training)
+        if self._training is not None:
+            self._training.extend(added)
+        if self._training_arrays is not None:
+            self._training_arrays.extend(features, labels)
+        if self._index is not None:
+            self._index.insert(np.arange(first, first + len(added)), features)
+        if self.neighbor_tables:
+            self._merge_neighbors(first)
+        self.version += 1
+
+    def remove_samples(self, rows: Iterable[int]) -> None:
+        """Remove the training samples at these positions in ``training``.
+
+        Each removal is O(1): the last sample moves into the gap, so samples
+        after the lowest removed position may be renumbered.
+        """
+        size = len(self.training)
+        for row in sorted(set(rows), reverse=True):
+            if not 0 <= row < size:
+                raise IndexError(f"training row {row} out of range")
+            size -= 1
+            if self._training is not None:
+                self._training[row] = self._training[size]
+                self._training.pop()
+            if self._training_arrays is not None:
+                self._training_arrays.swap_remove(row)
+            if self._index is not None:
+                self._index.remove(row)
+                if row != size:
+                    self._index.move(size, row)
+        self.neighbor_tables = {}
+        self.version += 1
+
+    def _merge_neighbors(self, first: int) -> None:
+        """Fold training rows from ``first`` on into each cached neighbor table."""
+        queries = self.testing_arrays.features[:, np.newaxis, :]
+        added = np.arange(first, len(self.training))
+        for algorithm, table in self.neighbor_tables.items():
+            # Existing entries come first, so ties still go to the lower row.
+            candidates = np.concatenate(
+                [table, np.broadcast_to(added, (len(table), len(added)))], axis=1
+            )
+            distances = algorithm.array_distance(queries, self.features[candidates])
+            nearest = k_smallest_rows(distances, table.shape[1])
+            self.neighbor_tables[algorithm] = np.take_along_axis(
+                candidates, nearest, axis=1
+            )
+
+    def species_labels(self, species: Iterable[str]) -> NDArray[np.intp]:
+        """Species names as indices into ``species_codes``."""
+        return np.array([self._species.code(s) for s in species], dtype=np.intp)
+
+    def record_classification(self, predicted: NDArray[np.intp]) -> float:
+        """Set each testing sample's classification; return the fraction correct."""
+        if self._testing is None:
+            self.testing_arrays.classified[:] = predicted
+        else:
+            codes = self._species.names
+            for sample, label in zip(self._testing, predicted.tolist()):
+                sample.classification = codes[label]
+        pass_count = int(np.count_nonzero(predicted == self.expected_labels()))
+        return pass_count / len(predicted)
+
+    def expected_labels(self) -> NDArray[np.intp]:
+        """Species of each testing sample, as indices into ``species_codes``."""
+        return self.testing_arrays.labels
+
+    def load(
+        self,
+        raw_data_iter: Iterable[dict[str, str]],
+        partitioner: Optional["StratifiedPartitioner"] = None,
+        chunk_size: int = 65_536,
+    ) -> None:
+        """Extract TestingKnownSample and TrainingKnownSample from raw data
+
+        Rows are read ``chunk_size`` at a time, so the feed may be a generator
+        of any length. Every fifth row is for testing, unless a
+        ``partitioner`` deals them.
+        """
+        loaded = 0
+        iterator = iter(raw_data_iter)
+        while chunk := list(itertools.islice(iterator, chunk_size)):
+            features, labels = sample_dict_arrays(chunk, self._species)
+            self._append(features, labels, loaded, partitioner)
+            loaded += len(chunk)
+        self._fit_scaler()
+        self.uploaded = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def load_csv(
+        self,
+        source: Path,
+        chunk_size: int = 65_536,
+        partitioner: Optional["StratifiedPartitioner"] = None,
+    ) -> list["BadSampleRow"]:
+        """Append the rows of a bezdekIris.data-style file, parsed in chunks.
+
+        Every fifth good row is a testing sample, as in ``load()``, unless a
+        ``partitioner`` deals them. Rows go
+        straight into ``training_arrays`` and ``testing_arrays`` without a
+        KnownSample per row. Unparseable rows are skipped and returned.
+        """
+        bad_rows: list[BadSampleRow] = []
+        loaded = 0
+        reader = SampleReader(source)
+        for chunk in reader.chunk_iter(chunk_size, self._species):
+            self._append(chunk.features, chunk.labels, loaded, partitioner)
+            loaded += len(chunk.features)
+            bad_rows.extend(chunk.bad_rows)
+        self._fit_scaler()
+        self.uploaded = datetime.datetime.now(tz=datetime.timezone.utc)
+        return bad_rows
+
+    def _append(
+        self,
+        features: NDArray[np.float64],
+        labels: NDArray[np.intp],
+        first: int = 0,
+        partitioner: Optional["StratifiedPartitioner"] = None,
+    ) -> None:
+        """Add rows; every fifth one, counting from ``first``, is for testing.
+
+        A ``partitioner`` decides instead, and may keep only a sample of them.
+
+        Until the scaler is fitted, the training rows feed its statistics and
+        are stored as they are; ``_fit_scaler()`` scales them all at the end.
+        """
+        if partitioner is None:
+            testing = np.arange(first, first + len(features)) % 5 == 0
+        else:
+            testing = partitioner.deal(labels)
+        training = ~testing
+        training_arrays, testing_arrays = self.training_arrays, self.testing_arrays
+        if self.scaler is not None:
+            if self.scaler.fitted:
+                self.scaler.transform(features, out=features)
+            else:
+                self.scaler.update(features[training])
+        if partitioner is None:
+            training_arrays.extend(features[training], labels[training])
+            testing_arrays.extend(features[testing], labels[testing])
+        else:
+            partitioner.keep(
+                features[training], labels[training], training_arrays, Purpose.Training
+            )
+            partitioner.keep(
+                features[testing], labels[testing], testing_arrays, Purpose.Testing
+            )
+        self._training = self._testing = None
+        self._index = None
+        self._ivf = None
+        self.neighbor_tables = {}
+        self.version += 1
+
+    def _fit_scaler(self) -> None:
+        """Fix the streamed statistics and scale the loaded rows in place."""
+        if self.scaler is None or self.scaler.fitted:
+            return
+        self.scaler.freeze()
+        self._scale(self.training_arrays)
+        self._scale(self.testing_arrays)
+        self._index = None
+        self._ivf = None
+        self.neighbor_tables = {}
+        self.version += 1
+
+    def save(self, directory: Path, index: bool = False) -> None:
+        """Write a binary snapshot that ``from_snapshot()`` can memory-map.
+
+        Each array is a separate ``.npy`` file; ``snapshot.json`` holds the
+        name, upload time, species vocabulary, partition sizes and any
+        scaling statistics; the arrays are saved already scaled. It is
+        written last, so a directory with it is complete. With ``index``, the
+        KDTree's arrays are saved too, so readers needn't each build one.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        arrays = {"training": self.training_arrays, "testing": self.testing_arrays}
+        for purpose, sample_arrays in arrays.items():
+            np.save(directory / f"{purpose}_features.npy", sample_arrays.features)
+            np.save(directory / f"{purpose}_labels.npy", sample_arrays.labels)
+        leaf_size = None
+        if index:
+            tree = self._index
+            if tree is None or tree.stale:
+                tree = KDTree(self.features)
+            for name in KDTree.arrays:
+                np.save(directory / f"index_{name}.npy", getattr(tree, name))
+            leaf_size = tree.leaf_size
+        uploaded = getattr(self, "uploaded", None)
+        metadata = {
+            "format": SNAPSHOT_FORMAT,
+            "name": self.name,
+            "uploaded": uploaded.isoformat() if uploaded else None,
+            "species": self._species.names,
+            "partition": {purpose: len(a) for purpose, a in arrays.items()},
+            "index_leaf_size": leaf_size,
+            "scaling": self.scaler.asdict() if self.scaler else None,
+        }
+        partial = directory / "snapshot.json.partial"
+        partial.write_text(json.dumps(metadata, indent=2))
+        partial.replace(directory / "snapshot.json")
+
+    @classmethod
+    def from_snapshot(cls, directory: Path, mmap: bool = True) -> "TrainingData":
+        """Open a snapshot written by ``save()``.
+
+        With ``mmap``, the arrays are read-only memory maps, so processes that
+        open the same snapshot share one copy of its pages through the OS
+        page cache, and nothing is parsed at start-up.
+        """
+        metadata = json.loads((directory / "snapshot.json").read_text())
+        if metadata["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported snapshot format {metadata['format']!r}")
+        training_data = cls(metadata["name"])
+        if metadata["uploaded"]:
+            training_data.uploaded = datetime.datetime.fromisoformat(
+                metadata["uploaded"]
+            )
+        training_data._species = SpeciesCodes(metadata["species"])
+        mmap_mode: Optional[Literal["r"]] = "r" if mmap else None
+        for purpose in "training", "testing":
+            arrays = SampleArrays.wrap(
+                np.load(directory / f"{purpose}_features.npy", mmap_mode=mmap_mode),
+                np.load(directory / f"{purpose}_labels.npy", mmap_mode=mmap_mode),
+            )
+            if len(arrays) != metadata["partition"][purpose]:
+                raise ValueError(f"Incomplete snapshot: {purpose} size mismatch")
+            setattr(training_data, f"_{purpose}_arrays", arrays)
+            setattr(training_data, f"_{purpose}", None)
+        if metadata.get("scaling"):
+            training_data.scaler = FeatureScaler.fromdict(metadata["scaling"])
+        if metadata.get("index_leaf_size"):
+            training_data._index = KDTree.from_arrays(
+                {
+                    name: np.load(directory / f"index_{name}.npy", mmap_mode=mmap_mode)
+                    for name in KDTree.arrays
+                },
+                metadata["index_leaf_size"],
+            )
+        return training_data
+
+    def test(self, parameter: Hyperparameter) -> None:
+        """Test this hyperparamater value."""
+        parameter.test()
+        self.tuning.append(parameter)
+        self.tested = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def tune(
+        self, grid: Iterable[tuple[int, Distance]], workers: Optional[int] = None
+    ) -> None:
+        """Test every (k, algorithm) pair of ``grid`` across a process pool.
+
+        Each distinct Distance is one task: its worker builds the neighbor table
+        for the largest k once and scores every k from it. The table comes back
+        into ``neighbor_tables``, and Distances already there are scored here.
+        The training and testing arrays are copied into shared memory once;
+        each worker attaches to them when it starts, so tasks only carry the
+        algorithm and its ks. ``tuning`` ends up sorted by quality, best first.
+        Distances without an array implementation are tested in this process.
+        """
+        parameters = [
+            Hyperparameter(k=k, algorithm=algorithm, training=self)
+            for k, algorithm in grid
+        ]
+        sweeps: dict[Distance, list[Hyperparameter]] = {}
+        for parameter in parameters:
+            if has_array_distance(parameter.algorithm):
+                sweeps.setdefault(parameter.algorithm, []).append(parameter)
+            else:
+                parameter.test()
+        expected = self.expected_labels()
+        classes = len(self.species_codes)
+        pending = []
+        for algorithm, sweep in sweeps.items():
+            widest = min(max(p.k for p in sweep), len(self.training))
+            table = self.neighbor_tables.get(algorithm)
+            if table is not None and table.shape[1] >= widest:
+                qualities = score_table(
+                    table, self.labels, expected, classes, [p.k for p in sweep]
+                )
+                for parameter, quality in zip(sweep, qualities):
+                    parameter.quality = quality
+            else:
+                pending.append(sweep)
+        if pending:
+            arrays = {
+                "features": self.features,
+                "labels": self.labels,
+                "testing": self.testing_arrays.features,
+                "expected": expected,
+            }
+            with shared_arrays(arrays) as specs, concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_attach_tuning_arrays, initargs=(specs, classes)
+            ) as pool:
+                tasks = [
+                    (sweep[0].algorithm, [p.k for p in sweep]) for sweep in pending
+                ]
+                for sweep, (table, qualities) in zip(
+                    pending, pool.map(_tuning_sweep, tasks)
+                ):
+                    self.neighbor_tables[sweep[0].algorithm] = table
+                    for parameter, quality in zip(sweep, qualities):
+                        parameter.quality = quality
+        self.tuning.extend(parameters)
+        self.tuning.sort(key=lambda p: p.quality, reverse=True)
+        self.tested = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def classify(self, parameter: Hyperparameter, sample: UnknownSample) -> str:
+        return parameter.classify(sample)
+
+    def classify_many(
+        self,
+        parameter: Hyperparameter,
+        samples: Union[Iterable[UnknownSample], NDArray[np.float64]],
+        block_size: Optional[int] = None,
+    ) -> NDArray[np.str_]:
+        return parameter.classify_many(samples, block_size)
+
+    def cross_validate(
+        self,
+        grid: Iterable[tuple[int, Distance]],
+        folds: int = 5,
+        repeats: int = 1,
+        seed: int = 0,
+        workers: Optional[int] = None,
+        assignments: Optional[NDArray[np.intp]] = None,
+    ) -> list["CrossValidation"]:
+        """Score every (k, algorithm) pair of ``grid`` by repeated k-fold cross-validation.
+
+        The training samples are dealt into ``folds`` folds, shuffled afresh
+        for each of ``repeats`` repeats (see ``fold_assignments()``), and each
+        fold is classified by the others. A fold is only a fold number per
+        row; nothing is copied per fold. As in ``tune()``, the arrays go into
+        shared memory once, and each (repeat, fold, Distance) is one
+        process-pool task that scores every k from one neighbor table.
+        Distances are told apart by their parameters, not just their class.
+        The same ``seed`` gives the same folds and so the same qualities.
+        Results are sorted by mean quality, best first.
+
+        ``assignments``, e.g. a partition's, overrides ``folds``, ``repeats``
+        and ``seed``: one row per repeat, giving each training sample's fold.
+        """
+        parameters = [
+            Hyperparameter(k=k, algorithm=algorithm, training=self)
+            for k, algorithm in grid
+        ]
+        sweeps: dict[Distance, list[Hyperparameter]] = {}
+        for parameter in parameters:
+            sweeps.setdefault(parameter.algorithm, []).append(parameter)
+        if assignments is None:
+            assignments = fold_assignments(len(self.training), folds, repeats, seed)
+        if assignments.shape[1] != len(self.training):
+            raise ValueError("Need a fold for every training sample")
+        repeats, folds = len(assignments), int(assignments.max()) + 1
+        classes = len(self.species_codes)
+        splits = [(repeat, fold) for repeat in range(repeats) for fold in range(folds)]
+        # For each Distance, a list per split of the quality of each k.
+        qualities: dict[Distance, list[list[float]]] = {}
+        vectorized = [algorithm for algorithm in sweeps if has_array_distance(algorithm)]
+        if vectorized:
+            arrays = {"features": self.features, "labels": self.labels, "folds": assignments}
+            with shared_arrays(arrays) as specs, concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_attach_tuning_arrays, initargs=(specs, classes)
+            ) as pool:
+                tasks = [
+                    (repeat, fold, algorithm, [p.k for p in sweeps[algorithm]])
+                    for algorithm in vectorized
+                    for repeat, fold in splits
+                ]
+                scored = iter(pool.map(_fold_sweep, tasks))
+                for algorithm in vectorized:
+                    qualities[algorithm] = [next(scored) for _ in splits]
+        for algorithm, sweep in sweeps.items():
+            if algorithm not in qualities:
+                # Distances without their own array_distance() run in this
+                # process; the user's class may not pickle.
+                qualities[algorithm] = [
+                    fold_qualities(
+                        algorithm,
+                        [p.k for p in sweep],
+                        self.features,
+                        self.labels,
+                        assignments[repeat] == fold,
+                        classes,
+                    )
+                    for repeat, fold in splits
+                ]
+        results = []
+        for algorithm, sweep in sweeps.items():
+            table = np.array(qualities[algorithm])
+            results.extend(
+                CrossValidation(parameter, table[:, n]) for n, parameter in enumerate(sweep)
+            )
+        results.sort(key=lambda result: result.mean, reverse=True)
+        return results
+
+    def evaluate_approximation(
+        self,
+        parameter: Hyperparameter,
+        probes: Iterable[int],
+        samples: Union[Iterable[Sample], NDArray[np.float64], None] = None,
+    ) -> list["ApproximationQuality"]:
+        """Compare approximate searches, one per number of ``probes``, with the exact one.
+
+        The queries are ``samples``, or by default the testing samples. Each
+        result has the share of the exact k nearest the search found (a
+        neighbor as near as the exact k-th counts, so ties don't matter), the
+        share of queries classified as the exact search classifies them, and
+        the seconds each took to classify them all. Besides the search, the
+        Hyperparameters compared are ``parameter`` with its k, distance and
+        weights.
+        """
+        if samples is None:
+            queries = self.testing_arrays.features
+        else:
+            queries = self.scaled(as_feature_matrix(samples))
+        exact = Hyperparameter(
+            parameter.k, parameter.algorithm, self, weights=parameter.weights
+        )
+        kth = np.empty(len(queries))
+        for rows, nearest, distances in exact._nearest_blocks(self, queries, None):
+            kth[rows] = distances[:, -1]
+        start = time.perf_counter()
+        expected = exact._classify_many(self, queries, None)
+        exact_seconds = time.perf_counter() - start
+        self.ivf_index
+        results = []
+        for count in probes:
+            approximate = Hyperparameter(
+                parameter.k, parameter.algorithm, self, weights=parameter.weights, probes=count
+            )
+            start = time.perf_counter()
+            species = approximate._classify_many(self, queries, None)
+            seconds = time.perf_counter() - start
+            found = 0
+            for rows, nearest, distances in approximate._nearest_blocks(self, queries, None):
+                found += np.count_nonzero(distances <= kth[rows, np.newaxis])
+            results.append(
+                ApproximationQuality(
+                    count,
+                    float(found / max(1, kth.size * min(parameter.k, len(self.training)))),
+                    float(np.mean(species == expected)) if len(queries) else 1.0,
+                    seconds,
+                    exact_seconds,
+                )
+            )
+        return results
+
+
+class ApproximationQuality(NamedTuple):
+    """How an approximate search with ``probes`` compares with the exact search."""
+
+    probes: int
+    recall: float
+    agreement: float
+    seconds: float
+    exact_seconds: float
+
+    @property
+    def speedup(self) -> float:
+        return self.exact_seconds / self.seconds if self.seconds else math.inf
+
+
+class CrossValidation(NamedTuple):
+    """One Hyperparameter's quality on every fold, repeat by repeat."""
+
+    parameter: Hyperparameter
+    qualities: NDArray[np.float64]
+
+    @property
+    def mean(self) -> float:
+        return float(self.qualities.mean())
+
+    @property
+    def std(self) -> float:
+        return float(self.qualities.std())
+
+
+def fold_assignments(
+    count: int, folds: int, repeats: int = 1, seed: int = 0
+) -> NDArray[np.intp]:
+    """The fold of each of ``count`` rows, one row of the result per repeat.
+
+    Each repeat deals a fresh permutation of the rows into ``folds`` folds,
+    so fold sizes differ by at most one. The permutations come from
+    ``seed`` and the repeat number alone.
+    """
+    if not 2 <= folds <= count:
+        raise ValueError(f"Can't make {folds} folds of {count} samples")
+    assignments = np.empty((repeats, count), dtype=np.intp)
+    for repeat in range(repeats):
+        order = np.random.default_rng([seed, repeat]).permutation(count)
+        assignments[repeat, order] = np.arange(count) % folds
+    return assignments
+
+
+def fold_qualities(
+    algorithm: Distance,
+    ks: list[int],
+    features: NDArray[np.float64],
+    labels: NDArray[np.intp],
+    testing: NDArray[np.bool_],
+    classes: int,
+    block_size: Optional[int] = None,
+) -> list[float]:
+    """Quality for each k when the ``testing`` rows are classified by the others.
+
+    The held-out rows' distances are set to infinity rather than copying the
+    other rows out, so neighbors are numbered as in ``features``.
+    """
+    queries = np.flatnonzero(testing)
+    widest = min(max(ks), len(features) - len(queries))
+    table = np.empty((len(queries), widest), dtype=np.intp)
+    for rows, distances in distance_blocks(
+        algorithm, features, features[queries], block_size
+    ):
+        distances[:, testing] = np.inf
+        table[rows] = k_smallest_rows(distances, widest)
+    return score_table(table, labels, labels[queries], classes, ks)
+
+
+@contextlib.contextmanager
+def shared_arrays(
+    arrays: dict[str, NDArray[Any]]
+) -> Iterator[dict[str, tuple[str, tuple[int, ...], str]]]:
+    """Copy ``arrays`` into shared memory; yields what ``_attach_tuning_arrays()`` takes."""
+    blocks: list[shared_memory.SharedMemory] = []
+    specs: dict[str, tuple[str, tuple[int, ...], str]] = {}
+    try:
+        for name, array in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            blocks.append(shm)
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+        yield specs
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+# Worker-process state for TrainingData.tune() and cross_validate().
+_tuning_memory: list[shared_memory.SharedMemory] = []
+_tuning_arrays: dict[str, NDArray[Any]] = {}
+_tuning_classes = 0
+
+
+def _attach_tuning_arrays(
+    specs: dict[str, tuple[str, tuple[int, ...], str]], classes: int
+) -> None:
+    global _tuning_classes
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _tuning_memory.append(shm)
+        _tuning_arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+    _tuning_classes = classes
+
+
+def _tuning_sweep(
+    task: tuple[Distance, list[int]]
+) -> tuple[NDArray[np.intp], list[float]]:
+    algorithm, ks = task
+    table = knn_table(
+        algorithm, max(ks), _tuning_arrays["features"], _tuning_arrays["testing"]
+    )
+    qualities = score_table(
+        table, _tuning_arrays["labels"], _tuning_arrays["expected"], _tuning_classes, ks
+    )
+    return table, qualities
+
+
+def _fold_sweep(task: tuple[int, int, Distance, list[int]]) -> list[float]:
+    repeat, fold, algorithm, ks = task
+    return fold_qualities(
+        algorithm,
+        ks,
+        _tuning_arrays["features"],
+        _tuning_arrays["labels"],
+        _tuning_arrays["folds"][repeat] == fold,
+        _tuning_classes,
+    )
+
+
+class TrainingKnownSample():
+    ...
+
+class BadSampleRow(ValueError):
+    pass
+
+
+class SampleChunk(NamedTuple):
+    """Up to ``chunk_size`` parsed rows of a sample file."""
+
+    features: NDArray[np.float64]
+    labels: NDArray[np.intp]
+    bad_rows: list[BadSampleRow]
+
+
+class SampleReader:
+    """See iris.names for attribute ordering in bezdekIris.data file"""
+
+    target_class = Sample
+    header = ["sepal_length", "sepal_width", "petal_length", "petal_width", "class"]
+
+    def __init__(self, source: Path) -> None:
+        self.source = source
+        self.species = SpeciesCodes()
+
+    def sample_iter(self) -> Iterator[Sample]:
+        target_class = self.target_class
+        with self.source.open(newline="") as source_file:
+            reader = csv.reader(source_file)
+            for row in reader:
+                if not row:
+                    continue
+                try:
+                    sample = target_class(*map(float, row[:4]))
+                except (TypeError, ValueError) as ex:
+                    raise BadSampleRow(
+                        f"Line {reader.line_num}: invalid {row!r}"
+                    ) from ex
+                yield sample
+
+    def chunk_iter(
+        self, chunk_size: int = 65_536, species: Optional[SpeciesCodes] = None
+    ) -> Iterator[SampleChunk]:
+        """Parse the file into feature and label arrays, ``chunk_size`` rows at a time.
+
+        Species names are coded with ``species`` (by default the reader's own
+        table), adding new names as they appear. A row that can't be parsed is
+        reported as a BadSampleRow in its chunk rather than ending the load.
+        """
+        species = self.species if species is None else species
+        with self.source.open(newline="") as source_file:
+            reader = csv.reader(source_file)
+            rows: list[list[str]] = []
+            lines: list[int] = []
+            for row in reader:
+                if row:
+                    rows.append(row)
+                    lines.append(reader.line_num)
+                if len(rows) == chunk_size:
+                    yield self._parse(rows, lines, species)
+                    rows, lines = [], []
+            if rows:
+                yield self._parse(rows, lines, species)
+
+    def _parse(
+        self, rows: list[list[str]], lines: list[int], species: SpeciesCodes
+    ) -> SampleChunk:
+        try:
+            # The whole chunk in one conversion, when every row is well formed.
+            features = np.array([row[:4] for row in rows], dtype=np.float64)
+            good = rows
+            if features.shape != (len(rows), 4) or any(len(row) != 5 for row in rows):
+                raise ValueError
+            bad_rows = []
+        except ValueError:
+            good, parsed, bad_rows = [], [], []
+            for row, line in zip(rows, lines):
+                try:
+                    if len(row) != 5:
+                        raise ValueError(f"expected 5 fields, found {len(row)}")
+                    parsed.append([float(value) for value in row[:4]])
+                    good.append(row)
+                except ValueError as ex:
+                    bad = BadSampleRow(f"Line {line}: invalid {row!r}")
+                    bad.__cause__ = ex
+                    bad_rows.append(bad)
+            features = np.array(parsed, dtype=np.float64).reshape(-1, 4)
+        labels = np.array(
+            [species.code(row[4]) for row in good], dtype=np.intp
+        )
+        return SampleChunk(features, labels, bad_rows)
+
+
+class TestingKnownSample():
+    ...
+    
+
+class SampleDict(TypedDict):
+    sepal_length: float
+    sepal_width: float
+    petal_length: float
+    petal_width: float
+    species: str
+
+class SamplePartition(List[SampleDict], abc.ABC): #추상클래스로 선언/ 리스트를 상속받음
+    @overload
+    def __init__(self, *, training_subsset: float = 0.80) -> None:   # *은 파티션 역할
+        ...
+
+    @overload
+    def __init__(
+            self, 
+            iterable: Optional[Iterable[SampleDict]] = None,
+            *,
+            training_subset: float = 0.80
+    )-> None:
+            ...
+
+    def __init__(
+            self, 
+            iterable: Optional[Iterable[SampleDict]] = None,
+            *,
+            training_subset: float = 0.80
+    ) -> None:
         self.training_subset = training_subset
         if iterable:
                 super().__init__(iterable)
@@ -530,7 +2667,328 @@ class CountingDealingPartition(DealingPartition):
     def testing(self) -> list[TestingKnownSample]:
         return self._testing
 
-    
+
+class KFoldPartition(SamplePartition):
+    """Repeated k-fold splits of the rows, as arrays of row numbers.
+
+    Row ``n`` of ``assignments`` is the fold of every row in repeat ``n``,
+    from ``fold_assignments()``, so the same ``seed`` gives the same folds.
+    ``training`` and ``testing`` are the samples of the fold picked with
+    ``select()``.
+    """
+
+    def __init__(
+        self,
+        iterable: Optional[Iterable[SampleDict]] = None,
+        *,
+        folds: int = 5,
+        repeats: int = 1,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(iterable)
+        self.folds = folds
+        self.repeats = repeats
+        self.seed = seed
+        self.current = (0, 0)
+        self._assignments: Optional[NDArray[np.intp]] = None
+
+    @property
+    def assignments(self) -> NDArray[np.intp]:
+        if self._assignments is None or self._assignments.shape[1] != len(self):
+            self._assignments = fold_assignments(
+                len(self), self.folds, self.repeats, self.seed
+            )
+        return self._assignments
+
+    def split(self, repeat: int, fold: int) -> tuple[NDArray[np.intp], NDArray[np.intp]]:
+        """The training rows and testing rows of one fold."""
+        testing = self.assignments[repeat] == fold
+        return np.flatnonzero(~testing), np.flatnonzero(testing)
+
+    def splits(self) -> Iterator[tuple[NDArray[np.intp], NDArray[np.intp]]]:
+        for repeat in range(self.repeats):
+            for fold in range(self.folds):
+                yield self.split(repeat, fold)
+
+    def select(self, repeat: int, fold: int) -> None:
+        self.current = (repeat, fold)
+
+    @property
+    def training(self) -> list[KnownSample]:  # type: ignore[override]
+        rows, _ = self.split(*self.current)
+        return [KnownSample(**self[row], purpose=Purpose.Training) for row in rows]
+
+    @property
+    def testing(self) -> list[KnownSample]:  # type: ignore[override]
+        _, rows = self.split(*self.current)
+        return [KnownSample(**self[row], purpose=Purpose.Testing) for row in rows]
+
+
+class CountingFoldPartition(DealingPartition):
+    """k folds dealt in arrival order: row n goes to fold ``n % folds``.
+
+    Like CountingDealingPartition, it takes rows one at a time, so it suits
+    data that's streamed in. ``assignments`` has the shape
+    ``KFoldPartition.assignments`` has for one repeat.
+    """
+
+    def __init__(
+        self,
+        items: Optional[Iterable[SampleDict]] = None,
+        *,
+        folds: int = 5,
+    ) -> None:
+        self.folds = folds
+        self.fold = 0
+        self.rows: list[SampleDict] = []
+        if items:
+            self.extend(items)
+
+    def extend(self, items: Iterable[SampleDict]) -> None:
+        for item in items:
+            self.append(item)
+
+    def append(self, item: SampleDict) -> None:
+        self.rows.append(item)
+
+    @property
+    def assignments(self) -> NDArray[np.intp]:
+        return (np.arange(len(self.rows)) % self.folds)[np.newaxis]
+
+    @property
+    def training(self) -> list[KnownSample]:  # type: ignore[override]
+        return [
+            KnownSample(**row, purpose=Purpose.Training)
+            for n, row in enumerate(self.rows)
+            if n % self.folds != self.fold
+        ]
+
+    @property
+    def testing(self) -> list[KnownSample]:  # type: ignore[override]
+        return [
+            KnownSample(**row, purpose=Purpose.Testing)
+            for n, row in enumerate(self.rows)
+            if n % self.folds == self.fold
+        ]
+
+
+class SampleStore:
+    """Samples in one SampleArrays with their species codes, for partitions to share."""
+
+    def __init__(
+        self,
+        rows: Optional[Iterable[SampleDict]] = None,
+        codes: Optional[SpeciesCodes] = None,
+    ) -> None:
+        self.arrays = SampleArrays()
+        self.codes = SpeciesCodes() if codes is None else codes
+        if rows:
+            self.extend(rows)
+
+    def __len__(self) -> int:
+        return len(self.arrays)
+
+    def extend(self, rows: Iterable[SampleDict]) -> None:
+        self.arrays.extend(*sample_dict_arrays(rows, self.codes))
+
+    def append(self, row: SampleDict) -> None:
+        self.extend([row])
+
+    def views(self, rows: NDArray[np.intp], purpose: Purpose) -> SampleViews:
+        return SampleViews(self.arrays, self.codes, purpose, rows)
+
+
+class IndexPartition(abc.ABC):
+    """A training/testing split of a SampleStore, kept as arrays of row numbers.
+
+    ``training`` and ``testing`` are SampleViews over the store: nothing is
+    copied, and no sample object exists until a row is looked at. The row
+    arrays are only recomputed when the store has grown.
+    """
+
+    def __init__(self, store: SampleStore) -> None:
+        self.store = store
+        self._rows: Optional[tuple[NDArray[np.intp], NDArray[np.intp]]] = None
+        self._size = -1
+
+    @abc.abstractmethod
+    def split(self, size: int) -> tuple[NDArray[np.intp], NDArray[np.intp]]:
+        """Training rows and testing rows among the first ``size`` of the store."""
+        ...
+
+    def rows(self) -> tuple[NDArray[np.intp], NDArray[np.intp]]:
+        if self._rows is None or self._size != len(self.store):
+            self._size = len(self.store)
+            self._rows = self.split(self._size)
+        return self._rows
+
+    @property
+    def training(self) -> SampleViews:
+        return self.store.views(self.rows()[0], Purpose.Training)
+
+    @property
+    def testing(self) -> SampleViews:
+        return self.store.views(self.rows()[1], Purpose.Testing)
+
+
+class ShufflingIndexPartition(IndexPartition):
+    """A random ``training_subset`` of the rows for training, the rest for testing.
+
+    ``shuffle()`` draws a new split: one O(N) permutation of row numbers.
+    """
+
+    def __init__(
+        self,
+        store: SampleStore,
+        *,
+        training_subset: float = 0.80,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__(store)
+        self.training_subset = training_subset
+        self.rng = np.random.default_rng(seed)
+
+    def split(self, size: int) -> tuple[NDArray[np.intp], NDArray[np.intp]]:
+        order = self.rng.permutation(size)
+        cut = int(size * self.training_subset)
+        return order[:cut], order[cut:]
+
+    def shuffle(self) -> None:
+        self._rows = None
+
+
+class DealingIndexPartition(IndexPartition):
+    """Rows dealt in arrival order: ``n`` of every ``d`` go to training.
+
+    ``append()`` and ``extend()`` add to the store, so this can be fed a
+    stream of rows like CountingDealingPartition.
+    """
+
+    def __init__(
+        self,
+        store: SampleStore,
+        *,
+        training_subset: Tuple[int, int] = (8, 10),
+    ) -> None:
+        super().__init__(store)
+        self.training_subset = training_subset
+
+    def split(self, size: int) -> tuple[NDArray[np.intp], NDArray[np.intp]]:
+        n, d = self.training_subset
+        training = np.arange(size) % d < n
+        return np.flatnonzero(training), np.flatnonzero(~training)
+
+    def extend(self, items: Iterable[SampleDict]) -> None:
+        self.store.extend(items)
+
+    def append(self, item: SampleDict) -> None:
+        self.store.append(item)
+
+
+class StratifiedPartitioner:
+    """Deals a stream of samples into training and testing, one species at a time.
+
+    Of every ``d`` rows of a species, the first ``n`` go to training
+    (``training_subset=(n, d)``), so both sides keep the feed's species
+    proportions to within a row per species. The state is a counter per
+    species, however long the feed.
+
+    With ``reservoir``, each side keeps at most that many rows of each
+    species: a uniform random sample of that species' rows so far
+    (Algorithm R), so an unbounded feed fits in bounded memory. ``seed``
+    makes the sample reproducible.
+    """
+
+    def __init__(
+        self,
+        training_subset: Tuple[int, int] = (8, 10),
+        reservoir: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.training_subset = training_subset
+        self.reservoir = reservoir
+        self.rng = np.random.default_rng(seed)
+        self.dealt: dict[int, int] = {}
+        # Per purpose and species code: rows offered so far, and the rows
+        # of the arrays that hold the reservoir.
+        self.seen: dict[Purpose, dict[int, int]] = {
+            Purpose.Training: {}, Purpose.Testing: {}
+        }
+        self.slots: dict[Purpose, dict[int, list[int]]] = {
+            Purpose.Training: {}, Purpose.Testing: {}
+        }
+
+    def _ordinals(self, labels: NDArray[np.intp], counts: dict[int, int]) -> NDArray[np.intp]:
+        """Each row's position among the rows of its species, advancing ``counts``."""
+        ordinals = np.empty(len(labels), dtype=np.intp)
+        for code in np.unique(labels).tolist():
+            rows = labels == code
+            first = counts.get(code, 0)
+            ordinals[rows] = np.arange(first, first + np.count_nonzero(rows))
+            counts[code] = first + np.count_nonzero(rows)
+        return ordinals
+
+    def deal(self, labels: NDArray[np.intp]) -> NDArray[np.bool_]:
+        """Which of the next rows, with these species codes, are for testing."""
+        n, d = self.training_subset
+        return self._ordinals(labels, self.dealt) % d >= n
+
+    def keep(
+        self,
+        features: NDArray[np.float64],
+        labels: NDArray[np.intp],
+        arrays: SampleArrays,
+        purpose: Purpose,
+    ) -> None:
+        """Add rows dealt to ``purpose`` to its arrays, or to its reservoir."""
+        if self.reservoir is None:
+            arrays.extend(features, labels)
+            return
+        ordinals = self._ordinals(labels, self.seen[purpose])
+        filling = ordinals < self.reservoir
+        for code in np.unique(labels[filling]).tolist():
+            rows = np.flatnonzero(filling & (labels == code))
+            first = len(arrays)
+            arrays.extend(features[rows], labels[rows])
+            self.slots[purpose].setdefault(code, []).extend(range(first, len(arrays)))
+        # Row i of a species, once the reservoir is full, replaces a random
+        # slot with probability reservoir / (i + 1).
+        later = np.flatnonzero(~filling)
+        picks = self.rng.integers(0, ordinals[later] + 1)
+        accepted = picks < self.reservoir
+        later, picks = later[accepted], picks[accepted]
+        for code in np.unique(labels[later]).tolist():
+            species = labels[later] == code
+            targets = np.array(self.slots[purpose][code])[picks[species]]
+            sources = later[species]
+            # When two rows pick the same slot, the later one wins, as it
+            # would one row at a time.
+            _, last = np.unique(targets[::-1], return_index=True)
+            chosen = len(targets) - 1 - last
+            arrays.features[targets[chosen]] = features[sources[chosen]]
+
+    def route(
+        self,
+        rows: Iterable[SampleDict],
+        training: SampleStore,
+        testing: SampleStore,
+        chunk_size: int = 65_536,
+    ) -> None:
+        """Read ``rows`` in chunks into two stores, which must share their codes."""
+        if training.codes is not testing.codes:
+            raise ValueError("The training and testing stores need the same SpeciesCodes")
+        iterator = iter(rows)
+        while chunk := list(itertools.islice(iterator, chunk_size)):
+            features, labels = sample_dict_arrays(chunk, training.codes)
+            testing_rows = self.deal(labels)
+            training_rows = ~testing_rows
+            self.keep(
+                features[training_rows], labels[training_rows], training.arrays, Purpose.Training
+            )
+            self.keep(
+                features[testing_rows], labels[testing_rows], testing.arrays, Purpose.Testing
+            )
+
 
 # Special case, we don't *often* test abstract superclasses.
 # In this example, however, we can create instances of the abstract class.
@@ -649,4 +3107,529 @@ test_TrainingData = """
 data='test', k=3, quality=0.0
 """
 
+test_TrainingData_arrays = """
+>>> td = TrainingData('test')
+>>> t1 = KnownSample(**{"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa", "purpose": 2})
+>>> t2 = KnownSample(**{"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor", "purpose": 2})
+>>> td.training = [t1, t2]
+>>> td.features
+array([[5.1, 3.5, 1.4, 0.2],
+       [7.9, 3.2, 4.7, 1.4]])
+>>> td.labels.tolist(), td.species_codes
+([0, 1], ['Iris-setosa', 'Iris-versicolor'])
+>>> u = UnknownSample(sepal_length=7.0, sepal_width=3.2, petal_length=4.7, petal_width=1.4)
+>>> for algorithm in Euclidean(), Manhattan(), Chebyshev(), Sorensen():
+...     h = Hyperparameter(k=1, algorithm=algorithm, training=td)
+...     scalar = [algorithm.distance(u, t) for t in td.training]
+...     vector = algorithm.array_distance(np.array(u.features), td.features)
+...     print(h.classify(u), all(isclose(a, b) for a, b in zip(scalar, vector)))
+Iris-versicolor True
+Iris-versicolor True
+Iris-versicolor True
+Iris-versicolor True
+"""
+
+test_distance_protocol = """
+>>> class Canberra(Distance):
+...     def distance(self, s1, s2):
+...         return sum(abs(a - b) / (abs(a) + abs(b)) for a, b in zip(s1.features, s2.features))
+>>> class Taxicab(Distance):
+...     def array_distance(self, query, reference):
+...         return np.abs(query - reference).sum(axis=-1)
+>>> queries = np.array([[5.0, 3.4, 1.5, 0.2], [6.9, 3.1, 5.1, 2.3]])
+>>> td = TrainingData('test')
+>>> td.training = [
+...     KnownSample(5.1, 3.5, 1.4, 0.2, purpose=Purpose.Training, species="Iris-setosa"),
+...     KnownSample(7.0, 3.2, 4.7, 1.4, purpose=Purpose.Training, species="Iris-versicolor"),
+...     KnownSample(6.3, 3.3, 6.0, 2.5, purpose=Purpose.Training, species="Iris-virginica"),
+... ]
+>>> Canberra().distances(queries, td.training).shape
+(2, 3)
+>>> Hyperparameter(1, Canberra(), td).classify_many(queries).tolist()
+['Iris-setosa', 'Iris-virginica']
+>>> round(Taxicab().distance(td.training[0], td.training[1]), 6)
+6.7
+>>> all(
+...     (algorithm.distances(queries, td.features)
+...      == [[algorithm.distance(UnknownSample(*q), t) for t in td.training] for q in queries]).all()
+...     for algorithm in (Euclidean(), Manhattan(), Chebyshev(), Sorensen())
+... )
+True
+"""
+
+test_k_smallest = """
+>>> d = np.array([3.0, 1.0, 2.0, 1.0, 0.5, 2.0])
+>>> k_smallest(d, 3).tolist()
+[4, 1, 3]
+>>> k_smallest(d, 4).tolist()
+[4, 1, 3, 2]
+>>> k_smallest(d, 10).tolist()
+[4, 1, 3, 2, 5, 0]
+"""
+
+test_classify_many = """
+>>> td = TrainingData('test')
+>>> t1 = KnownSample(**{"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa", "purpose": 2})
+>>> t2 = KnownSample(**{"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor", "purpose": 2})
+>>> t3 = KnownSample(**{"sepal_length": 7.7, "sepal_width": 3.0, "petal_length": 6.1, "petal_width": 2.3, "species": "Iris-virginica", "purpose": 2})
+>>> td.training = [t1, t2, t3]
+>>> h = Hyperparameter(k=1, algorithm=Euclidean(), training=td)
+>>> unknowns = [
+...     UnknownSample(sepal_length=5.0, sepal_width=3.4, petal_length=1.5, petal_width=0.2),
+...     UnknownSample(sepal_length=7.6, sepal_width=3.0, petal_length=6.6, petal_width=2.1),
+...     UnknownSample(sepal_length=7.0, sepal_width=3.2, petal_length=4.7, petal_width=1.4),
+... ]
+>>> td.classify_many(h, unknowns, block_size=2).tolist()
+['Iris-setosa', 'Iris-virginica', 'Iris-versicolor']
+>>> h.classify_many(np.array([u.features for u in unknowns])).tolist() == [h.classify(u) for u in unknowns]
+True
+>>> majority_vote(np.array([[2, 1, 1, 2], [0, 1, 2, 2]]), 3).tolist()
+[2, 2]
+>>> h.classify_many([]).tolist()
+[]
+>>> td.index_threshold = 2
+>>> h._use_index(td), h.classify_many([]).tolist(), h.classify_many(unknowns).tolist()
+(True, [], ['Iris-setosa', 'Iris-virginica', 'Iris-versicolor'])
+"""
+
+test_KDTree = """
+>>> rng = np.random.default_rng(42)
+>>> features = np.round(rng.normal(5.0, 1.5, (500, 4)), 1)
+>>> tree = KDTree(features, leaf_size=16)
+>>> len(tree.start) > 1
+True
+>>> query = np.array([5.0, 3.4, 1.5, 0.2])
+>>> for algorithm in Euclidean(), Manhattan(), Chebyshev():
+...     brute = k_smallest(algorithm.array_distance(query, features), 9)
+...     print(np.array_equal(tree.query(algorithm, query, 9), brute))
+True
+True
+True
+>>> Sorensen().monotone, Euclidean().monotone
+(False, True)
+"""
+
+test_TrainingData_tune = """
+>>> td = TrainingData('test')
+>>> raw_data = [
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 4.9, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.0, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 6.4, "sepal_width": 3.2, "petal_length": 4.5, "petal_width": 1.5, "species": "Iris-versicolor"},
+... {"sepal_length": 4.7, "sepal_width": 3.2, "petal_length": 1.3, "petal_width": 0.2, "species": "Iris-setosa"},
+... ]
+>>> td.load(raw_data)
+>>> td.tune([(1, Euclidean()), (4, Chebyshev()), (1, Sorensen())], workers=2)
+>>> [(h.k, type(h.algorithm).__name__, h.quality) for h in td.tuning]
+[(1, 'Euclidean', 1.0), (1, 'Sorensen', 1.0), (4, 'Chebyshev', 0.0)]
+
+Each parameterisation of one Distance class is scored with its own neighbors.
+
+>>> rng = np.random.default_rng(1)
+>>> noisy = TrainingData('noisy')
+>>> noisy.load([
+...     dict(zip(["sepal_length", "sepal_width", "petal_length", "petal_width"], rng.normal(size=4) + n % 3),
+...          species=["Iris-setosa", "Iris-versicolor", "Iris-virginica"][n % 3])
+...     for n in range(200)
+... ])
+>>> def minkowski(m):
+...     distance = Minkowski()
+...     distance.m = m
+...     return distance
+>>> noisy.tune([(5, minkowski(1)), (5, minkowski(8))], workers=1)
+>>> [(h.algorithm.m, h.quality) for h in noisy.tuning]
+[(1, 0.75), (8, 0.725)]
+"""
+
+test_neighbor_tables = """
+>>> td = TrainingData('test')
+>>> raw_data = [
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 4.9, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.0, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 6.4, "sepal_width": 3.2, "petal_length": 4.5, "petal_width": 1.5, "species": "Iris-versicolor"},
+... {"sepal_length": 4.7, "sepal_width": 3.2, "petal_length": 1.3, "petal_width": 0.2, "species": "Iris-setosa"},
+... ]
+>>> td.load(raw_data)
+>>> for k in 1, 2, 3:
+...     h = Hyperparameter(k=k, algorithm=Manhattan(), training=td)
+...     h.test()
+...     print(k, h.quality)
+1 1.0
+2 1.0
+3 0.0
+>>> td.neighbor_tables[Manhattan()].tolist()
+[[1, 3, 2, 0], [1, 3, 2, 0]]
+>>> td.neighbors(Manhattan(), 2).tolist()
+[[1, 3], [1, 3]]
+>>> class Weighted(Distance):
+...     def __init__(self, weights):
+...         self.weights = np.array(weights)
+...     def array_distance(self, query, reference):
+...         return (np.abs(query - reference) * self.weights).sum(axis=-1)
+>>> td.neighbors(Weighted([0.0, 0.0, 0.0, 1.0]), 4).tolist()
+[[1, 0, 2, 3], [1, 0, 2, 3]]
+>>> td.add_samples([KnownSample(5.0, 3.0, 1.4, 0.2, purpose=Purpose.Training, species="Iris-setosa")])
+>>> td.neighbor_tables[Weighted([0.0, 0.0, 0.0, 1.0])].tolist()
+[[1, 4, 0, 2], [1, 4, 0, 2]]
+
+Each parameterisation of a Distance class gets its own table.
+
+>>> Weighted([1.0, 0.0, 0.0, 0.0]) == Weighted([0.0, 0.0, 0.0, 1.0]), Manhattan() == Manhattan()
+(False, True)
+>>> td.neighbors(Weighted([1.0, 0.0, 0.0, 0.0]), 4).tolist()
+[[4, 1, 3, 2], [1, 4, 3, 2]]
+>>> len(td.neighbor_tables)
+3
+"""
+
+test_TrainingData_load_csv = """
+>>> import tempfile
+>>> with tempfile.TemporaryDirectory() as directory:
+...     source = Path(directory) / "bezdekIris.data"
+...     _ = source.write_text(
+...         "5.1,3.5,1.4,0.2,Iris-setosa\\n"
+...         "7.0,3.2,4.7,1.4,Iris-versicolor\\n"
+...         "6.3,three,6.0,2.5,Iris-virginica\\n"
+...         "\\n"
+...         "4.9,3.0,1.4,0.2,Iris-setosa\\n"
+...         "6.4,3.2,4.5,1.5\\n"
+...     )
+...     td = TrainingData('test')
+...     bad_rows = td.load_csv(source, chunk_size=2)
+...     more_bad_rows = td.load_csv(source)
+>>> for bad in bad_rows:
+...     print(bad)
+Line 3: invalid ['6.3', 'three', '6.0', '2.5', 'Iris-virginica']
+Line 6: invalid ['6.4', '3.2', '4.5', '1.5']
+>>> len(td.training), len(td.testing), td.species_codes
+(4, 2, ['Iris-setosa', 'Iris-versicolor'])
+>>> td.testing[0]
+SampleView(sepal_length=5.1, sepal_width=3.5, petal_length=1.4, petal_width=0.2, purpose=1, species='Iris-setosa')
+"""
+
+test_TrainingData_snapshot = """
+>>> import tempfile
+>>> td = TrainingData('test')
+>>> td.load([
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 7.7, "sepal_width": 3.0, "petal_length": 6.1, "petal_width": 2.3, "species": "Iris-virginica"},
+... ])
+>>> with tempfile.TemporaryDirectory() as directory:
+...     td.save(Path(directory))
+...     copy = TrainingData.from_snapshot(Path(directory))
+...     print(type(copy.features).__name__, copy.features.flags.writeable)
+...     print(copy.name, copy.uploaded == td.uploaded, copy.species_codes)
+...     print(copy.training[1])
+...     print(copy.testing)
+...     copy.training_arrays.extend(np.array([[6.3, 3.3, 6.0, 2.5]]), np.array([2]))
+...     print(len(copy.features), copy.features.flags.writeable)
+memmap False
+test True ['Iris-setosa', 'Iris-versicolor', 'Iris-virginica']
+SampleView(sepal_length=7.7, sepal_width=3.0, petal_length=6.1, petal_width=2.3, purpose=2, species='Iris-virginica')
+[SampleView(sepal_length=5.1, sepal_width=3.5, petal_length=1.4, petal_width=0.2, purpose=1, species='Iris-setosa')]
+3 True
+"""
+
+test_TrainingData_snapshot_index = """
+>>> import tempfile
+>>> rng = np.random.default_rng(1)
+>>> td = TrainingData('test')
+>>> td.load(
+...     dict(zip(["sepal_length", "sepal_width", "petal_length", "petal_width"], row), species="Iris-setosa")
+...     for row in rng.uniform(0, 8, (500, 4)).round(1).tolist()
+... )
+>>> query = np.array([4.0, 4.0, 4.0, 4.0])
+>>> with tempfile.TemporaryDirectory() as directory:
+...     td.save(Path(directory), index=True)
+...     copy = TrainingData.from_snapshot(Path(directory))
+...     print(copy.index_built, type(copy.index.points).__name__)
+...     print((copy.index.query(Euclidean(), query, 5) == td.index.query(Euclidean(), query, 5)).all())
+...     copy.remove_samples([int(copy.index.query(Euclidean(), query, 1)[0])])
+...     print(copy.index.query(Euclidean(), query, 4).tolist() == td.index.query(Euclidean(), query, 5)[1:].tolist())
+True memmap
+True
+True
+"""
+
+test_SampleView = """
+>>> td = TrainingData('test')
+>>> td.load([
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... ])
+>>> s = td.testing[0]
+>>> isinstance(s, KnownSample), s.sepal_length, s.species, s.classification
+(True, 5.1, 'Iris-setosa', None)
+>>> s.classification = "Iris-versicolor"
+>>> s.matches(), td.testing[0].classification, td.testing_arrays.classified.tolist()
+(False, 'Iris-versicolor', [1])
+>>> td.training[0].classification
+Traceback (most recent call last):
+...
+AttributeError: Training samples have no classification
+>>> hasattr(KnownSample(1, 2, 3, 4, purpose=2, species="x"), "__dict__")
+False
+"""
+
+test_prediction_cache = """
+>>> td = TrainingData('test')
+>>> td.load([
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 4.9, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.0, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 6.4, "sepal_width": 3.2, "petal_length": 4.5, "petal_width": 1.5, "species": "Iris-versicolor"},
+... {"sepal_length": 6.9, "sepal_width": 3.1, "petal_length": 4.9, "petal_width": 1.5, "species": "Iris-versicolor"},
+... ])
+>>> h = Hyperparameter(1, Euclidean(), td, cache_size=2)
+>>> u = UnknownSample(5.0, 3.4, 1.5, 0.2)
+>>> h.classify(u), h.classify(UnknownSample(5.0, 3.4, 1.5, 0.2))
+('Iris-setosa', 'Iris-setosa')
+>>> h.cache.info()
+CacheInfo(hits=1, misses=1, evictions=0, size=1, maxsize=2)
+>>> h.classify_many([u, UnknownSample(6.5, 3.0, 4.6, 1.5), UnknownSample(7.0, 3.2, 4.7, 1.4)]).tolist()
+['Iris-setosa', 'Iris-versicolor', 'Iris-versicolor']
+>>> h.cache.info()
+CacheInfo(hits=2, misses=3, evictions=1, size=2, maxsize=2)
+>>> td.training = [KnownSample(6.0, 3.0, 4.0, 1.0, purpose=Purpose.Training, species="Iris-versicolor")]
+>>> h.classify(u)
+'Iris-versicolor'
+>>> h.cache.info().size
+1
+"""
+
+test_weighted_and_radius_voting = """
+>>> td = TrainingData('test')
+>>> td.training = [
+...     KnownSample(5.0, 3.0, length, 0.0, purpose=Purpose.Training, species=species)
+...     for length, species in [
+...         (1.0, "Iris-setosa"), (1.2, "Iris-setosa"),
+...         (3.0, "Iris-versicolor"), (3.2, "Iris-versicolor"), (3.4, "Iris-versicolor"),
+...     ]
+... ]
+>>> u = UnknownSample(5.0, 3.0, 1.1, 0.0)
+>>> Hyperparameter(5, Euclidean(), td).classify(u)
+'Iris-versicolor'
+>>> Hyperparameter(5, Euclidean(), td, weights="distance").classify(u)
+'Iris-setosa'
+>>> p = Hyperparameter(5, Euclidean(), td, weights="distance").predict([u])
+>>> p.species.tolist(), p.classes, p.probabilities.round(3).tolist()
+(['Iris-setosa'], ['Iris-setosa', 'Iris-versicolor'], [[0.933, 0.067]])
+>>> h = Hyperparameter(5, Euclidean(), td, radius=1.0, outlier="Unknown")
+>>> p = h.predict([u, UnknownSample(5.0, 3.0, 3.1, 0.0), UnknownSample(9.0, 9.0, 9.0, 9.0)])
+>>> p.species.tolist()
+['Iris-setosa', 'Iris-versicolor', 'Unknown']
+>>> p.probabilities.tolist()
+[[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]]
+>>> Hyperparameter(5, Euclidean(), td, radius=1.0).classify(UnknownSample(9.0, 9.0, 9.0, 9.0))
+Traceback (most recent call last):
+...
+ValueError: No training samples within 1.0 of [9.0, 9.0, 9.0, 9.0]
+"""
+
+test_feature_scaling = """
+>>> rows = [
+... {"sepal_length": 0.0, "sepal_width": 0.0, "petal_length": 0.0, "petal_width": 0.0, "species": "Iris-setosa"},
+... {"sepal_length": 50.0, "sepal_width": 3.4, "petal_length": 1.5, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 60.0, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 51.0, "sepal_width": 2.9, "petal_length": 4.5, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 70.0, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 64.0, "sepal_width": 3.1, "petal_length": 4.6, "petal_width": 1.5, "species": "Iris-versicolor"},
+... ]
+>>> u = UnknownSample(59.0, 3.0, 4.4, 1.3)
+>>> raw = TrainingData('raw')
+>>> raw.load(rows)
+>>> Hyperparameter(1, Euclidean(), raw).classify(u)
+'Iris-setosa'
+>>> td = TrainingData('scaled', scaling="minmax")
+>>> td.load(rows)
+>>> td.scaler.offset.tolist(), td.scaler.scale.round(3).tolist()
+([50.0, 2.9, 1.4, 0.2], [20.0, 0.5, 3.3, 1.2])
+>>> td.training[0]
+SampleView(sepal_length=0.0, sepal_width=1.0, petal_length=0.030303030303030328, petal_width=0.0, purpose=2, species='Iris-setosa')
+>>> Hyperparameter(1, Euclidean(), td).classify(u)
+'Iris-versicolor'
+>>> td.scaler.inverse(td.features[:1]).round(1).tolist()
+[[50.0, 3.4, 1.5, 0.2]]
+"""
+
+test_cross_validation = """
+>>> rng = np.random.default_rng(3)
+>>> names = ["Iris-setosa", "Iris-versicolor", "Iris-virginica"]
+>>> rows = [
+...     dict(zip(["sepal_length", "sepal_width", "petal_length", "petal_width"],
+...              (rng.normal(size=4) + c).round(1).tolist()), species=names[c])
+...     for c in rng.integers(3, size=60).tolist()
+... ]
+>>> fold_assignments(6, 3, seed=1).tolist()
+[[1, 0, 2, 2, 0, 1]]
+>>> p = KFoldPartition(rows, folds=4, repeats=2, seed=1)
+>>> [(len(training), len(testing)) for training, testing in p.splits()][:2]
+[(45, 15), (45, 15)]
+>>> p.select(1, 2)
+>>> len(p.training), p.testing[0]
+(45, KnownSample(sepal_length=0.1, sepal_width=0.7, petal_length=-2.8, petal_width=1.0, purpose=1, species='Iris-setosa'))
+>>> td = TrainingData('cv')
+>>> td.load(rows)
+>>> grid = [(1, Euclidean()), (5, Euclidean()), (5, Manhattan())]
+>>> results = td.cross_validate(grid, folds=4, repeats=2, seed=1, workers=2)
+>>> [(r.parameter.k, type(r.parameter.algorithm).__name__, round(r.mean, 3), round(r.std, 3)) for r in results]
+[(1, 'Euclidean', 0.771, 0.13), (5, 'Euclidean', 0.76, 0.088), (5, 'Manhattan', 0.75, 0.138)]
+>>> again = td.cross_validate(grid, folds=4, repeats=2, seed=1, workers=1)
+>>> all((r.qualities == a.qualities).all() for r, a in zip(results, again))
+True
+>>> CountingFoldPartition(rows[:7], folds=3).assignments.tolist()
+[[0, 1, 2, 0, 1, 2, 0]]
+
+Two parameterisations of one Distance class are scored separately, whether
+they run in the pool or, without an array_distance(), in this process.
+
+>>> def minkowski(m):
+...     distance = Minkowski()
+...     distance.m = m
+...     return distance
+>>> class Axis(Distance):
+...     def __init__(self, feature):
+...         self.feature = feature
+...     def distance(self, s1, s2):
+...         return abs(s1.features[self.feature] - s2.features[self.feature])
+>>> grid = [(3, minkowski(1)), (3, minkowski(30)), (5, Axis(0)), (5, Axis(2))]
+>>> results = td.cross_validate(grid, folds=4, seed=1, workers=1)
+>>> sorted((type(r.parameter.algorithm).__name__, round(r.mean, 3)) for r in results)
+[('Axis', 0.5), ('Axis', 0.625), ('Minkowski', 0.646), ('Minkowski', 0.812)]
+"""
+
+test_index_partitions = """
+>>> store = SampleStore([
+...     {"sepal_length": float(n), "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2,
+...      "species": "Iris-setosa" if n < 5 else "Iris-versicolor"}
+...     for n in range(10)
+... ])
+>>> dealt = DealingIndexPartition(store)
+>>> [s.sepal_length for s in dealt.testing]
+[8.0, 9.0]
+>>> shuffled = ShufflingIndexPartition(store, seed=42)
+>>> training = shuffled.training
+>>> len(training), len(shuffled.testing), training.rows.tolist() == shuffled.training.rows.tolist()
+(8, 2, True)
+>>> sorted(training.rows.tolist() + shuffled.testing.rows.tolist()) == list(range(10))
+True
+>>> training.arrays is store.arrays
+True
+>>> dealt.append({"sepal_length": 10.0, "sepal_width": 3.0, "petal_length": 4.5, "petal_width": 1.5, "species": "Iris-virginica"})
+>>> len(dealt.training), dealt.training[-1]
+(9, SampleView(sepal_length=10.0, sepal_width=3.0, petal_length=4.5, petal_width=1.5, purpose=2, species='Iris-virginica'))
+>>> dealt.testing.features.tolist()
+[[8.0, 3.0, 1.4, 0.2], [9.0, 3.0, 1.4, 0.2]]
+"""
+
+test_stratified_streaming = """
+>>> def feed(count):
+...     for n in range(count):
+...         species = "Iris-setosa" if n % 4 else "Iris-virginica"
+...         yield {"sepal_length": str(n), "sepal_width": "3.0", "petal_length": "1.4",
+...                "petal_width": "0.2", "species": species}
+>>> td = TrainingData('stream')
+>>> td.load(feed(40), StratifiedPartitioner((4, 5)), chunk_size=7)
+>>> collections.Counter(s.species for s in td.testing)
+Counter({'Iris-setosa': 6, 'Iris-virginica': 2})
+>>> [s.sepal_length for s in td.testing if s.species == "Iris-virginica"]
+[16.0, 36.0]
+>>> sampled = TrainingData('sampled')
+>>> sampled.load(feed(10_000), StratifiedPartitioner((4, 5), reservoir=3, seed=1), chunk_size=999)
+>>> sorted(collections.Counter(s.species for s in sampled.training).items())
+[('Iris-setosa', 3), ('Iris-virginica', 3)]
+>>> len(sampled.testing)
+6
+>>> training = SampleStore()
+>>> testing = SampleStore(codes=training.codes)
+>>> StratifiedPartitioner((1, 2)).route(feed(8), training, testing)
+>>> training.arrays.features[:, 0].tolist(), testing.arrays.features[:, 0].tolist()
+([0.0, 1.0, 3.0, 6.0], [2.0, 4.0, 5.0, 7.0])
+"""
+
+test_approximate_search = """
+>>> rng = np.random.default_rng(7)
+>>> td = TrainingData('ivf')
+>>> td.ivf_lists = 8
+>>> td.training = [
+...     KnownSample(*(rng.normal(size=4) + n % 3), purpose=Purpose.Training,
+...                 species=["Iris-setosa", "Iris-versicolor", "Iris-virginica"][n % 3])
+...     for n in range(600)
+... ]
+>>> td.testing = [
+...     KnownSample(*(rng.normal(size=4) + n % 3), purpose=Purpose.Testing,
+...                 species=["Iris-setosa", "Iris-versicolor", "Iris-virginica"][n % 3])
+...     for n in range(60)
+... ]
+>>> td.ivf_index.table.shape[0], int(td.ivf_index.sizes.sum())
+(8, 600)
+>>> exact = Hyperparameter(5, Euclidean(), td)
+>>> approximate = Hyperparameter(5, Euclidean(), td, probes=8)
+>>> (approximate.classify_many(td.testing) == exact.classify_many(td.testing)).all()
+np.True_
+>>> one, every = td.evaluate_approximation(exact, [1, 8])
+>>> every.recall, every.agreement
+(1.0, 1.0)
+>>> one.recall < 1.0
+True
+
+On rounded data, with many samples at the same distance, ties go to the
+lowest rows as they do in an exact search, so probing every list agrees
+with it exactly.
+
+>>> grid = TrainingData('grid')
+>>> grid.ivf_lists = 8
+>>> grid.training = [
+...     KnownSample(*rng.integers(0, 3, size=4).astype(float), purpose=Purpose.Training,
+...                 species=["Iris-setosa", "Iris-versicolor", "Iris-virginica"][n % 3])
+...     for n in range(600)
+... ]
+>>> grid.testing = [
+...     KnownSample(*rng.integers(0, 3, size=4).astype(float), purpose=Purpose.Testing,
+...                 species=["Iris-setosa", "Iris-versicolor", "Iris-virginica"][n % 3])
+...     for n in range(60)
+... ]
+>>> queries = grid.testing_arrays.features
+>>> everything = Euclidean().array_distance(
+...     queries[:, np.newaxis, :], grid.training_arrays.features
+... )
+>>> found = grid.ivf_index.nearest_blocks(Euclidean(), queries, 5, 8, 16)
+>>> rows = np.concatenate([rows for _, rows, _ in found])
+>>> bool((rows == k_smallest_rows(everything, 5)).all())
+True
+>>> [every] = grid.evaluate_approximation(Hyperparameter(5, Euclidean(), grid), [8])
+>>> every.recall, every.agreement
+(1.0, 1.0)
+>>> Hyperparameter(5, Euclidean(), td, radius=1.0, probes=2)
+Traceback (most recent call last):
+...
+ValueError: An approximate search finds the k nearest; use radius=None
+"""
+
+test_incremental_updates = """
+>>> td = TrainingData('test')
+>>> td.training = [
+...     KnownSample(5.1, 3.5, 1.4, 0.2, purpose=Purpose.Training, species="Iris-setosa"),
+...     KnownSample(7.0, 3.2, 4.7, 1.4, purpose=Purpose.Training, species="Iris-versicolor"),
+...     KnownSample(6.3, 3.3, 6.0, 2.5, purpose=Purpose.Training, species="Iris-virginica"),
+... ]
+>>> td.index.query(Euclidean(), np.array([6.2, 3.3, 5.9, 2.4]), 2).tolist()
+[2, 1]
+>>> version = td.version
+>>> td.add_samples([KnownSample(6.2, 3.4, 5.4, 2.3, purpose=Purpose.Training, species="Iris-virginica")])
+>>> td.index.query(Euclidean(), np.array([6.2, 3.3, 5.9, 2.4]), 2).tolist()
+[2, 3]
+>>> td.remove_samples([0, 2])
+>>> [s.species for s in td.training]
+['Iris-virginica', 'Iris-versicolor']
+>>> td.index.query(Euclidean(), np.array([6.2, 3.3, 5.9, 2.4]), 2).tolist()
+[0, 1]
+>>> td.version - version, td.labels.tolist()
+(2, [2, 1])
+"""
+
 __test__ = {name: case for name, case in globals().items() if name.startswith("test_")}
@@ -1,9 +1,20 @@
 from __future__ import annotations
+import asyncio
 import base64
+import binascii
+import collections
+from concurrent.futures import Future
 import csv
 from enum import Enum, auto
 from functools import wraps
+import hashlib
+import hmac
 from pathlib import Path
+import queue
+import secrets
+import sqlite3
+import threading
+import time
 from typing import ( 
     cast,
     Optional,
@@ -16,9 +27,20 @@ from typing import (
     Union,
     Iterator,
 )
+import numpy as np
 import werkzeug.security
 from flask import Flask, current_app, jsonify, request, abort, g, Response
 
+from src.ch6_model import (
+    Chebyshev,
+    Distance,
+    Euclidean,
+    Hyperparameter,
+    Manhattan,
+    Sorensen,
+    TrainingData,
+)
+
 
 class Role(str, Enum):
     UNDEFINED = ""
@@ -69,9 +91,10 @@ class User:
         self.password = werkzeug.security.generate_password_hash(plain_text)
 
     def valid_password(self, plain_text: str) -> bool:
-        return werkzeug.security.check_password_hash(
-            self.password or "md5$$", plain_text
-        )
+        # Newer werkzeug rejects the old "md5$$" placeholder hash outright.
+        if not self.password:
+            return False
+        return werkzeug.security.check_password_hash(self.password, plain_text)
 
     def __repr__(self) -> str:
         return (
@@ -93,39 +116,197 @@ class User:
         }
 
 
+class CSVUserFile:
+    """Users in a CSV file. New users are appended; any other change rewrites it."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def read(self) -> dict[str, User]:
+        with self.path.open() as user_file:
+            row_iter = csv.DictReader(user_file)
+            user_iter = (User.from_dict(row) for row in row_iter if row)
+            return {user.username: user for user in user_iter}
+
+    def write(
+        self,
+        changed: list[dict[str, Optional[str]]],
+        rows: list[dict[str, Optional[str]]],
+        appended: bool,
+    ) -> None:
+        if appended and self.path.exists():
+            with self.path.open("a", newline="") as user_file:
+                csv.DictWriter(user_file, User.headers).writerows(changed)
+            return
+        with self.path.open("w", newline="") as user_file:
+            writer = csv.DictWriter(user_file, User.headers)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+class SQLiteUserFile:
+    """Users in a SQLite database, one row per user, keyed and indexed by username.
+
+    Saving only inserts or updates the rows that changed.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "username TEXT PRIMARY KEY, email TEXT, real_name TEXT, "
+                "role TEXT, password TEXT)"
+            )
+        connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def read(self) -> dict[str, User]:
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT * FROM users").fetchall()
+        finally:
+            connection.close()
+        return {row["username"]: User.from_dict(dict(row)) for row in rows}
+
+    def write(
+        self,
+        changed: list[dict[str, Optional[str]]],
+        rows: list[dict[str, Optional[str]]],
+        appended: bool,
+    ) -> None:
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO users VALUES "
+                    "(:username, :email, :real_name, :role, :password)",
+                    changed,
+                )
+        finally:
+            connection.close()
+
+
+UserFile = Union[CSVUserFile, SQLiteUserFile]
+
+
 class Users:
+    """The users allowed in, read from ``USER_FILE`` on first use.
+
+    A ``.db``, ``.sqlite`` or ``.sqlite3`` file is a SQLite database, anything
+    else is CSV. The file is read once, under a lock, and read again only when
+    its modification time or size changes, so edits made by another process
+    show up without a restart. The file is checked at most once every
+    ``USER_FILE_CHECK_SECONDS``; in between, lookups don't touch the lock or
+    the filesystem. ``save()`` writes only the users that changed.
+    """
+
+    sqlite_suffixes = {".db", ".sqlite", ".sqlite3"}
+
     def __init__(self, init: Optional[dict[str, User]] = None) -> None:
         self.users = init or {}
         self.anonymous = User("", "", "", Role.UNDEFINED)
         self.app: Optional[Flask] = None
+        self.from_file = init is None
+        self.lock = threading.Lock()
+        self.user_file: Optional[UserFile] = None
+        self.loaded: Optional[tuple[int, int]] = None
+        self.available = False
+        self.next_check = float("-inf")
+        self.saved: dict[str, dict[str, Optional[str]]] = {}
 
     def init_app(self, app: Flask) -> None:
         self.app = app
         self.app.config.setdefault("USER_FILE", Path("users.csv"))
+        self.app.config.setdefault("USER_FILE_CHECK_SECONDS", 1.0)
+
+    def file(self) -> UserFile:
+        if not self.app:
+            raise RuntimeError("Users not bound to an app")
+        path = Path(self.app.config["USER_FILE"])
+        if self.user_file is None or self.user_file.path != path:
+            if path.suffix in self.sqlite_suffixes:
+                self.user_file = SQLiteUserFile(path)
+            else:
+                self.user_file = CSVUserFile(path)
+            self.loaded = None
+            self.available = False
+        return self.user_file
+
+    @staticmethod
+    def stamp(path: Path) -> Optional[tuple[int, int]]:
+        """The file's modification time and size; None if there's no file yet."""
+        try:
+            status = path.stat()
+        except FileNotFoundError:
+            return None
+        return status.st_mtime_ns, status.st_size
+
+    def load(self) -> None:
+        """Read the user file, unless it hasn't changed since the last read."""
+        if not self.from_file:
+            return
+        if self.user_file is not None and time.monotonic() < self.next_check:
+            return
+        if not self.app:
+            raise RuntimeError("Users not bound to an app")
+        with self.lock:
+            user_file = self.file()
+            stamp = self.stamp(user_file.path)
+            self.next_check = (
+                time.monotonic() + self.app.config["USER_FILE_CHECK_SECONDS"]
+            )
+            if stamp == self.loaded:
+                self.available = True
+                return
+            users = user_file.read()
+            saved = {name: user.asdict() for name, user in users.items()}
+            # Users added here but not yet saved survive a reload.
+            for name, user in self.users.items():
+                if name not in self.saved:
+                    users.setdefault(name, user)
+            self.users, self.saved = users, saved
+            self.loaded = stamp
+            self.available = True
 
     def get_user(self, name: str, default: Optional[User] = None) -> User:
         if not self.app:
             raise RuntimeError("Users not bound to an app")
-        if not self.users:
-            # Load file when needed.
-            with self.app.config["USER_FILE"].open() as user_file:
-                row_iter = csv.DictReader(user_file)
-                user_iter = (User.from_dict(row) for row in row_iter if row)
-                self.users = {user.username: user for user in user_iter}
+        self.load()
         return self.users.get(name, default or self.anonymous)
 
     def add_user(self, user: User) -> None:
-        if user.username in self.users:
-            raise ValueError("Duplicate Username")
-        self.users[user.username] = user
+        with self.lock:
+            if user.username in self.users:
+                raise ValueError("Duplicate Username")
+            self.users[user.username] = user
 
     def save(self) -> None:
+        """Write the users added or changed since the file was last read."""
         if not self.app:
             raise RuntimeError("Users not bound to an app")
-        with self.app.config["USER_FILE"].open("w", newline="") as user_file:
-            writer = csv.DictWriter(user_file, User.headers)
-            writer.writeheader()
-            writer.writerows(u.asdict() for u in self.users.values())
+        with self.lock:
+            user_file = self.file()
+            rows = [u.asdict() for u in self.users.values()]
+            changed = [row for row in rows if self.saved.get(row["username"]) != row]
+            if not changed and user_file.path.exists():
+                return
+            appended = self.loaded is not None and all(
+                row["username"] not in self.saved for row in changed
+            )
+            user_file.write(changed, rows, appended)
+            self.saved = {row["username"]: row for row in rows}
+            self.loaded = self.stamp(user_file.path)
+            self.available = True
+
+    @property
+    def ready(self) -> bool:
+        """True once the user file has been read, so lookups won't block on it."""
+        return not self.from_file or self.available
 
     def __len__(self) -> int:
         return len(self.users)
@@ -155,28 +336,441 @@ class NotAuthorized(Exception):
         return rv
 
 
-def authenticate(view_function: Callable[..., Response]) -> Callable[..., Response]:
-    @wraps(view_function)
-    def decorated_function(*args: str) -> Response:
-        auth_body = request.headers.get("Authorization", "").split(" ")
-        auth_type, credentials = auth_body if len(auth_body) == 2 else ("", ":")
+class InvalidSample(Exception):
+    status_code = 400
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+        self.message = message
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"message": self.message}
+
+
+class VerifiedCredentials:
+    """Credentials that recently passed ``User.valid_password()``.
+
+    Looking one up skips the deliberately slow password hash. Keys are
+    HMAC-SHA256 digests under a per-process secret, so no password is kept.
+    Each entry expires after ``{prefix}_TTL`` seconds, and at most
+    ``{prefix}_SIZE`` are kept, least recently used evicted first. An entry
+    also records the user's password hash, so it stops matching as soon as
+    ``User.set_password()`` replaces that hash.
+    """
+
+    def __init__(self) -> None:
+        self.key = secrets.token_bytes(32)
+        self.entries: collections.OrderedDict[
+            bytes, tuple[str, Optional[str], float]
+        ] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.app: Optional[Flask] = None
+        self.hits = self.misses = 0
+
+    def init_app(
+        self, app: Flask, prefix: str, size: int = 1024, ttl: float = 60.0
+    ) -> None:
+        self.app = app
+        self.prefix = prefix
+        self.app.config.setdefault(f"{prefix}_SIZE", size)
+        self.app.config.setdefault(f"{prefix}_TTL", ttl)
+
+    @property
+    def ttl(self) -> float:
+        if not self.app:
+            raise RuntimeError("VerifiedCredentials not bound to an app")
+        return cast(float, self.app.config[f"{self.prefix}_TTL"])
+
+    def digest(self, credential: str) -> bytes:
+        return hmac.new(self.key, credential.encode("utf-8"), hashlib.sha256).digest()
+
+    def get(self, credential: str) -> Optional[User]:
+        """The user this credential was verified for, if it still holds."""
+        key = self.digest(credential)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            username, password, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        user = users.get_user(username)
+        if user.password != password:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user
+
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def add(self, credential: str, user: User) -> None:
+        if not self.app:
+            raise RuntimeError("VerifiedCredentials not bound to an app")
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            key = self.digest(credential)
+            self.entries[key] = (user.username, user.password, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.app.config[f"{self.prefix}_SIZE"]:
+                self.entries.popitem(last=False)
+
+    def issue(self, user: User) -> str:
+        """A new random token standing for ``user`` until it expires."""
+        token = secrets.token_urlsafe(32)
+        self.add(token, user)
+        return token
+
+
+def cached_user(authorization: str) -> Optional[User]:
+    """The user for an Authorization header value, if it was verified recently.
+
+    This never runs the password hash, so it's cheap enough for any caller.
+    """
+    auth_type, _, credentials = authorization.partition(" ")
+    if auth_type.upper() == "BEARER" and app.config["AUTH_TOKENS"]:
+        user = tokens.get(credentials)
+        if user is None:
+            raise NotAuthorized("Unknown Token")
+        return user
+    if auth_type.upper() == "BASIC":
+        return verified.get(credentials)
+    return None
+
+
+def authorized_user(authorization: str) -> User:
+    """The user for an Authorization header value; raises NotAuthorized if none."""
+    if user := cached_user(authorization):
+        return user
+    auth_body = authorization.split(" ")
+    auth_type, credentials = auth_body if len(auth_body) == 2 else ("", ":")
+    try:
         username, _, password = (
             base64.b64decode(credentials).decode("utf-8").partition(":")
         )
-        g.user = users.get_user(username)  # type: ignore[attr-defined]
-        conditions = [
-            auth_type.upper() == "BASIC",
-            g.user.valid_password(password),  # type: ignore[attr-defined]
-        ]
-        if not all(conditions):
-            raise NotAuthorized("Unknown User")
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise NotAuthorized("Unknown User") from error
+    user = users.get_user(username)
+    conditions = [
+        auth_type.upper() == "BASIC",
+        user.valid_password(password),
+    ]
+    if not all(conditions):
+        raise NotAuthorized("Unknown User")
+    verified.add(credentials, user)
+    return user
+
+
+def authenticate(view_function: Callable[..., Response]) -> Callable[..., Response]:
+    @wraps(view_function)
+    def decorated_function(*args: str) -> Response:
+        g.user = authorized_user(request.headers.get("Authorization", ""))  # type: ignore[attr-defined]
         return view_function(*args)
 
     return decorated_function
 
 
+BatchFuture = Union["Future[list[str]]", "asyncio.Future[list[str]]"]
+
+
+class Batch:
+    """Requests to classify in one call: (M, 4) feature matrices and their futures.
+
+    The batchers collect requests until ``full()``, classify ``features()``
+    and ``resolve()`` the futures with each request's share of the answer.
+    When the call fails, ``split()`` gives each request a batch of its own
+    to retry, so only a request that fails alone gets the error.
+    """
+
+    def __init__(self, first: tuple[np.ndarray, BatchFuture]) -> None:
+        self.pending = [first]
+        self.size = len(first[0])
+
+    def full(self, max_size: int) -> bool:
+        return self.size >= max_size
+
+    def add(self, item: tuple[np.ndarray, BatchFuture]) -> None:
+        self.pending.append(item)
+        self.size += len(item[0])
+
+    def features(self) -> np.ndarray:
+        return np.concatenate([features for features, _ in self.pending])
+
+    def resolve(self, species: list[str]) -> None:
+        start = 0
+        for features, future in self.pending:
+            # The client may have hung up and cancelled its future.
+            if not future.done():
+                future.set_result(species[start : start + len(features)])
+            start += len(features)
+
+    def split(self, error: Exception) -> list["Batch"]:
+        if len(self.pending) > 1:
+            return [Batch(item) for item in self.pending]
+        _, future = self.pending[0]
+        if not future.done():
+            future.set_exception(error)
+        return []
+
+
+class MicroBatcher:
+    """Coalesces concurrent requests into one vectorized ``classify`` call.
+
+    A worker thread takes the oldest waiting request, then keeps collecting
+    until ``max_size`` samples are waiting or ``max_wait_ms`` has passed since
+    that first request arrived. A request is never split across batches.
+    """
+
+    def __init__(
+        self,
+        classify: Callable[[np.ndarray], Iterable[str]],
+        max_wait_ms: float = 2.0,
+        max_size: int = 64,
+    ) -> None:
+        self.classify = classify
+        self.max_wait = max_wait_ms / 1000
+        self.max_size = max_size
+        self.queue: queue.Queue[tuple[np.ndarray, Future[list[str]]]] = queue.Queue()
+        self.batches = self.samples = 0
+        self.thread = threading.Thread(
+            target=self.run, name="micro-batcher", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, features: np.ndarray) -> Future[list[str]]:
+        """Queue an (M, 4) feature matrix; the future yields M species."""
+        future: Future[list[str]] = Future()
+        self.queue.put((features, future))
+        return future
+
+    def run(self) -> None:
+        while True:
+            batch = Batch(self.queue.get())
+            deadline = time.monotonic() + self.max_wait
+            while not batch.full(self.max_size):
+                timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    batch.add(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.dispatch(batch)
+
+    def dispatch(self, batch: Batch) -> None:
+        try:
+            species = list(self.classify(batch.features()))
+        except Exception as error:
+            for single in batch.split(error):
+                self.dispatch(single)
+            return
+        self.batches += 1
+        self.samples += len(species)
+        batch.resolve(species)
+
+
+# The settings Classifier.model() reads, for a server that loads the model
+# in another process and passes the config along.
+MODEL_CONFIG = (
+    "TRAINING_DATA",
+    "CLASSIFIER_K",
+    "CLASSIFIER_DISTANCE",
+    "CLASSIFIER_CACHE_SIZE",
+    "CLASSIFIER_WEIGHTS",
+    "CLASSIFIER_RADIUS",
+    "CLASSIFIER_OUTLIER",
+    "CLASSIFIER_PROBES",
+    "CLASSIFIER_SCALING",
+)
+
+
+class Classifier:
+    """The tuned Hyperparameter the ``/classify`` endpoint uses, loaded on first use."""
+
+    distances: dict[str, Type[Distance]] = {
+        d.__name__: d for d in (Euclidean, Manhattan, Chebyshev, Sorensen)
+    }
+
+    def __init__(self) -> None:
+        self.app: Optional[Flask] = None
+        self.lock = threading.Lock()
+        self.training_data: Optional[TrainingData] = None
+        self.hyperparameter: Optional[Hyperparameter] = None
+        self.batcher: Optional[MicroBatcher] = None
+        self.warming: Optional[threading.Thread] = None
+
+    def init_app(self, app: Flask) -> None:
+        self.app = app
+        self.app.config.setdefault("TRAINING_DATA", Path("data/bezdekIris.data"))
+        self.app.config.setdefault("CLASSIFIER_K", 5)
+        self.app.config.setdefault("CLASSIFIER_DISTANCE", "Euclidean")
+        self.app.config.setdefault("CLASSIFIER_CACHE_SIZE", 0)
+        self.app.config.setdefault("CLASSIFIER_WEIGHTS", "uniform")
+        self.app.config.setdefault("CLASSIFIER_RADIUS", None)
+        self.app.config.setdefault("CLASSIFIER_OUTLIER", None)
+        self.app.config.setdefault("CLASSIFIER_PROBES", None)
+        self.app.config.setdefault("CLASSIFIER_SCALING", None)
+        self.app.config.setdefault("BATCH_MAX_WAIT_MS", 2.0)
+        self.app.config.setdefault("BATCH_MAX_SIZE", 64)
+
+    @classmethod
+    def model(cls, config: Mapping[str, Any]) -> tuple[TrainingData, Hyperparameter]:
+        """Load ``TRAINING_DATA``, a CSV file or a snapshot directory.
+
+        ``CLASSIFIER_SCALING`` applies to a CSV file; a snapshot keeps the
+        scaling it was saved with. With ``CLASSIFIER_RADIUS``, a sample with
+        no training samples that close is ``CLASSIFIER_OUTLIER``, or
+        ``"Unknown"`` if that's None, rather than an error for the whole batch.
+
+        The Hyperparameter only holds a weak reference to the TrainingData,
+        so keep both.
+        """
+        source = Path(config["TRAINING_DATA"])
+        if source.is_dir():
+            training_data = TrainingData.from_snapshot(source)
+        else:
+            training_data = TrainingData(
+                source.name, scaling=config.get("CLASSIFIER_SCALING")
+            )
+            training_data.load_csv(source)
+        distance = cls.distances[config["CLASSIFIER_DISTANCE"]]
+        radius = config.get("CLASSIFIER_RADIUS")
+        outlier = config.get("CLASSIFIER_OUTLIER")
+        if radius is not None and outlier is None:
+            outlier = "Unknown"
+        hyperparameter = Hyperparameter(
+            config["CLASSIFIER_K"],
+            distance(),
+            training_data,
+            cache_size=config.get("CLASSIFIER_CACHE_SIZE", 0),
+            weights=config.get("CLASSIFIER_WEIGHTS", "uniform"),
+            radius=radius,
+            outlier=outlier,
+            probes=config.get("CLASSIFIER_PROBES"),
+        )
+        return training_data, hyperparameter
+
+    def load(self) -> MicroBatcher:
+        if not self.app:
+            raise RuntimeError("Classifier not bound to an app")
+        with self.lock:
+            if self.batcher is None:
+                config = self.app.config
+                self.training_data, self.hyperparameter = self.model(config)
+                self.batcher = MicroBatcher(
+                    self.hyperparameter.classify_many,
+                    config["BATCH_MAX_WAIT_MS"],
+                    config["BATCH_MAX_SIZE"],
+                )
+        return self.batcher
+
+    def warm_up(self) -> None:
+        """Start loading the users and the model in the background, once."""
+        with self.lock:
+            if self.warming is None:
+                self.warming = threading.Thread(
+                    target=self._warm_up, name="warm-up", daemon=True
+                )
+                self.warming.start()
+
+    def _warm_up(self) -> None:
+        try:
+            users.load()
+            self.load()
+        except Exception:
+            if self.app:
+                self.app.logger.exception("Warm-up failed")
+            with self.lock:
+                self.warming = None
+
+    def classify(self, features: np.ndarray) -> list[str]:
+        return self.load().submit(features).result()
+
+
+def health_status() -> dict[str, Any]:
+    """Liveness and readiness, from counters kept up to date as things happen.
+
+    Everything here is O(1) and none of it touches a file, so a load
+    balancer can poll it as often as it likes.
+    """
+    training_data = classifier.training_data
+    hyperparameter = classifier.hyperparameter
+    prediction_cache = hyperparameter.cache if hyperparameter else None
+    model_loaded = classifier.batcher is not None
+    return {
+        "status": "OK",
+        "ready": users.ready and model_loaded,
+        "user_count": len(users),
+        "model_loaded": model_loaded,
+        "training_version": training_data.version if training_data else None,
+        "index_built": training_data.index_built if training_data else False,
+        "credential_cache_hit_rate": verified.hit_rate(),
+        "prediction_cache_hit_rate": (
+            prediction_cache.hit_rate() if prediction_cache else None
+        ),
+    }
+
+
+def diagnostics() -> dict[str, Any]:
+    """``health_status()`` plus the details too costly to poll."""
+    response = health_status()
+    response["credential_cache"] = {
+        "size": len(verified.entries),
+        "hits": verified.hits,
+        "misses": verified.misses,
+    }
+    response["tokens"] = len(tokens.entries)
+    if classifier.training_data and classifier.hyperparameter:
+        training_data = classifier.training_data
+        response["model"] = {
+            "name": training_data.name,
+            "k": classifier.hyperparameter.k,
+            "distance": type(classifier.hyperparameter.algorithm).__name__,
+            "training": len(training_data.training),
+            "testing": len(training_data.testing),
+            "species": training_data.species_codes,
+        }
+        if classifier.hyperparameter.cache:
+            response["prediction_cache"] = (
+                classifier.hyperparameter.cache.info()._asdict()
+            )
+    if batcher := classifier.batcher:
+        response["batcher"] = {
+            "batches": batcher.batches,
+            "samples": batcher.samples,
+            "mean_batch": batcher.samples / batcher.batches if batcher.batches else None,
+            "waiting": batcher.queue.qsize(),
+        }
+    if app.config["TESTING"]:
+        response["users"] = [u.asdict() for u in users.values()]
+    return response
+
+
+FEATURES = ("sepal_length", "sepal_width", "petal_length", "petal_width")
+
+
+def sample_features(document: Any) -> np.ndarray:
+    """An (M, 4) matrix from one sample object or a list of them."""
+    samples = document if isinstance(document, list) else [document]
+    try:
+        features = np.array(
+            [[float(s[name]) for name in FEATURES] for s in samples],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+    except (KeyError, TypeError, ValueError) as error:
+        raise InvalidSample(f"Invalid sample: {error!r}") from error
+    if not len(features) or not np.isfinite(features).all():
+        raise InvalidSample("Samples must have finite measurements")
+    return features
+
+
 class Config:
     USER_FILE = Path("data/users.csv")
+    TRAINING_DATA = Path("data/bezdekIris.data")
+    AUTH_TOKENS = False
 
 
 class Demo(Config):
@@ -189,6 +783,12 @@ app = Flask(__name__)
 app.config.from_object(Demo)  # os.environ["CLASSIFIER_CONFIG"]
 users = Users()
 users.init_app(app)
+verified = VerifiedCredentials()
+verified.init_app(app, "AUTH_CACHE", size=1024, ttl=60.0)
+tokens = VerifiedCredentials()
+tokens.init_app(app, "AUTH_TOKEN", size=65_536, ttl=3600.0)
+classifier = Classifier()
+classifier.init_app(app)
 
 
 @app.errorhandler(NotAuthorized)  # type: ignore[misc]
@@ -198,13 +798,33 @@ def handle_unauthorized(error: NotAuthorized) -> Response:
     return response
 
 
+@app.errorhandler(InvalidSample)  # type: ignore[misc]
+def handle_invalid_sample(error: InvalidSample) -> Response:
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
 @app.route("/health")
-def user_list() -> Response:
-    users.get_user("")
-    response = {"status": "OK", "user_count": len(users)}
-    if app.config["TESTING"]:
-        response["users"] = [u.asdict() for u in users.values()]
-    return jsonify(response)
+def health() -> Response:
+    return jsonify(health_status())
+
+
+@app.route("/ready")
+def ready() -> Response:
+    """200 once users and model are loaded; 503 while they load in the background."""
+    status = health_status()
+    if not status["ready"]:
+        classifier.warm_up()
+    response = jsonify(status)
+    response.status_code = 200 if status["ready"] else 503
+    return response
+
+
+@app.route("/diagnostics")
+@authenticate
+def diagnostics_report() -> Response:
+    return jsonify(diagnostics())
 
 
 @app.route("/whoami")
@@ -219,5 +839,357 @@ def who_am_i() -> Response:
     )
 
 
+@app.route("/token", methods=["POST"])
+@authenticate
+def token() -> Response:
+    """Exchange Basic credentials for a Bearer token, when AUTH_TOKENS is on."""
+    if not app.config["AUTH_TOKENS"]:
+        abort(404)
+    return jsonify(
+        {
+            "status": "OK",
+            "token": tokens.issue(g.user),  # type: ignore[attr-defined]
+            "expires_in": tokens.ttl,
+        }
+    )
+
+
+@app.route("/classify", methods=["POST"])
+@authenticate
+def classify() -> Response:
+    """Classify one sample object, or a list of them, posted as JSON."""
+    if g.user.role not in (Role.BOTANIST, Role.RESEARCHER):  # type: ignore[attr-defined]
+        raise NotAuthorized("Not allowed to classify", status_code=403)
+    document = request.get_json(silent=True)
+    if document is None:
+        raise InvalidSample("Expected a JSON sample or list of samples")
+    species = classifier.classify(sample_features(document))
+    return jsonify(
+        {
+            "status": "OK",
+            "species": species if isinstance(document, list) else species[0],
+        }
+    )
+
+
+test_user_files = """
+>>> import tempfile
+>>> directory = tempfile.TemporaryDirectory()
+>>> user_app = Flask("users")
+>>> def bound(name):
+...     user_app.config["USER_FILE"] = Path(directory.name) / name
+...     store = Users()
+...     store.init_app(user_app)
+...     return store
+>>> user_app.config["USER_FILE_CHECK_SECONDS"] = 0.0
+
+Lookups aren't ready until the file has been read.
+
+>>> broken = bound("broken.csv")
+>>> _ = broken.app.config["USER_FILE"].write_text("username\\nalice\\n")
+>>> broken.ready
+False
+>>> broken.get_user("alice")
+Traceback (most recent call last):
+...
+KeyError: 'email'
+>>> broken.ready
+False
+
+A file written by hand, one user per line.
+
+>>> csv_path = Path(directory.name) / "users.csv"
+>>> _ = csv_path.write_text(
+...     "username,email,real_name,role,password\\n"
+...     "alice,alice@example.com,Alice,botanist,hash-a\\n"
+... )
+>>> original = csv_path.read_bytes()
+>>> store = bound("users.csv")
+>>> store.get_user("alice")
+User(username='alice', email='alice@example.com', real_name='Alice', role='botanist', password='hash-a')
+>>> store.ready
+True
+
+A new user is appended; the rows already there aren't rewritten.
+
+>>> store.add_user(User("bob", "bob@example.com", "Bob", Role.RESEARCHER, "hash-b"))
+>>> store.save()
+>>> text = csv_path.read_bytes()
+>>> text.startswith(original), text.count(b"username")
+(True, 1)
+
+Any other change rewrites the file.
+
+>>> store.get_user("alice").password = "hash-c"
+>>> store.save()
+>>> csv_path.read_bytes().startswith(original)
+False
+>>> reread = bound("users.csv")
+>>> [(u.username, u.password) for u in (reread.get_user("alice"), reread.get_user("bob"))]
+[('alice', 'hash-c'), ('bob', 'hash-b')]
+
+An edit made by another process shows up on the next lookup,
+but no sooner than ``USER_FILE_CHECK_SECONDS`` after the last check.
+
+>>> user_app.config["USER_FILE_CHECK_SECONDS"] = 60.0
+>>> reread.get_user("alice").username
+'alice'
+>>> with csv_path.open("a", newline="") as user_file:
+...     _ = csv.DictWriter(user_file, User.headers).writerow(
+...         User("carol", "carol@example.com", "Carol", Role.BOTANIST, "hash-d").asdict()
+...     )
+>>> reread.get_user("carol").username
+''
+>>> reread.next_check = float("-inf")
+>>> reread.get_user("carol").username
+'carol'
+>>> user_app.config["USER_FILE_CHECK_SECONDS"] = 0.0
+
+SQLite files round-trip the same way, and only the changed rows are written.
+
+>>> store = bound("users.db")
+>>> len(store), store.get_user("alice").username
+(0, '')
+>>> store.add_user(User("alice", "alice@example.com", "Alice", Role.BOTANIST, "hash-a"))
+>>> store.add_user(User("bob", "bob@example.com", "Bob", Role.RESEARCHER, "hash-b"))
+>>> store.save()
+>>> store.get_user("bob").password = "hash-e"
+>>> store.save()
+>>> reread = bound("users.db")
+>>> sorted((u.username, u.password) for u in (reread.get_user("alice"), reread.get_user("bob")))
+[('alice', 'hash-a'), ('bob', 'hash-e')]
+
+>>> directory.cleanup()
+"""
+
+test_verified_credentials = """
+>>> saved = users.users, users.from_file
+>>> users.users, users.from_file = {}, False
+>>> alice = User("alice", "alice@example.com", "Alice", Role.BOTANIST)
+>>> alice.set_password("secret")
+>>> users.add_user(alice)
+>>> def basic(username, password):
+...     return "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode()
+
+A wrong password is never cached, so it's checked in full every time.
+
+>>> verified.entries.clear()
+>>> authorized_user(basic("alice", "wrong"))  # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+NotAuthorized: Unknown User
+>>> cached_user(basic("alice", "wrong")) is None, len(verified.entries)
+(True, 0)
+
+Credentials that don't decode are refused the same way, not a server error;
+so is a token when tokens are off.
+
+>>> authorized_user("Basic not-base64!")  # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+NotAuthorized: Unknown User
+>>> authorized_user("Basic " + base64.b64encode(b"\\xff:secret").decode())  # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+NotAuthorized: Unknown User
+>>> app.config["AUTH_TOKENS"]
+False
+>>> authorized_user("Bearer some-token")  # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+NotAuthorized: Unknown User
+>>> response = app.test_client().get("/whoami", headers={"Authorization": "Bearer some-token"})
+>>> response.status_code, response.get_json()
+(401, {'message': 'Unknown User'})
+
+A correct one is, and the next lookup skips the hash.
+
+>>> authorized_user(basic("alice", "secret")).username
+'alice'
+>>> hits = verified.hits
+>>> cached_user(basic("alice", "secret")).username, verified.hits - hits
+('alice', 1)
+
+A new password hash invalidates the entry.
+
+>>> alice.set_password("changed")
+>>> cached_user(basic("alice", "secret")) is None
+True
+>>> authorized_user(basic("alice", "secret"))  # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+NotAuthorized: Unknown User
+
+Entries expire after the TTL, and the least recently used goes first.
+
+>>> cache = VerifiedCredentials()
+>>> cache.init_app(app, "TEST_CACHE", size=2, ttl=60.0)
+>>> cache.add("one", alice)
+>>> cache.add("two", alice)
+>>> cache.get("one").username
+'alice'
+>>> cache.add("three", alice)
+>>> cache.get("two") is None, cache.get("one") is not None, cache.get("three") is not None
+(True, True, True)
+>>> app.config["TEST_CACHE_TTL"] = -1.0
+>>> cache.add("four", alice)
+>>> cache.get("four") is None, list(cache.entries) == [cache.digest("three")]
+(True, True)
+
+>>> verified.entries.clear()
+>>> users.users, users.from_file = saved
+"""
+
+test_health_routes = """
+>>> import tempfile
+>>> directory = tempfile.TemporaryDirectory()
+>>> saved_config = {name: app.config[name] for name in ("TRAINING_DATA", "USER_FILE")}
+>>> saved_users = users.users, users.from_file
+>>> app.config["TRAINING_DATA"] = Path(directory.name) / "iris.data"
+>>> _ = app.config["TRAINING_DATA"].write_text(
+...     "5.1,3.5,1.4,0.2,Iris-setosa\\n"
+...     "7.0,3.2,4.7,1.4,Iris-versicolor\\n"
+...     "4.9,3.0,1.4,0.2,Iris-setosa\\n"
+...     "6.4,3.2,4.5,1.5,Iris-versicolor\\n"
+... )
+>>> app.config["USER_FILE"] = Path(directory.name) / "users.csv"
+>>> botanist = User("botanist", "botanist@example.com", "Botanist", Role.BOTANIST)
+>>> botanist.set_password("secret")
+>>> CSVUserFile(app.config["USER_FILE"]).write([], [botanist.asdict()], False)
+>>> users.users, users.from_file, users.user_file = {}, True, None
+>>> users.available = False
+>>> client = app.test_client()
+
+``/health`` answers at once, and loads nothing.
+
+>>> response = client.get("/health")
+>>> response.status_code, response.get_json()["model_loaded"], classifier.warming
+(200, False, None)
+
+``/ready`` is 503 until the users and the model are loaded; asking starts loading them.
+
+>>> response = client.get("/ready")
+>>> response.status_code, response.get_json()["ready"]
+(503, False)
+>>> classifier.warming.join()
+>>> response = client.get("/ready")
+>>> response.status_code, response.get_json()["user_count"], response.get_json()["model_loaded"]
+(200, 1, True)
+
+``/diagnostics`` needs a user, and reports the caches and the batcher.
+
+>>> client.get("/diagnostics").status_code
+401
+>>> authorization = "Basic " + base64.b64encode(b"botanist:secret").decode()
+>>> _ = classifier.classify(np.array([[5.0, 3.4, 1.5, 0.2]]))
+>>> report = client.get("/diagnostics", headers={"Authorization": authorization}).get_json()
+>>> sorted(report["credential_cache"]), report["batcher"]["batches"], report["batcher"]["samples"]
+(['hits', 'misses', 'size'], 1, 1)
+>>> report["model"]["k"], report["model"]["species"]
+(5, ['Iris-setosa', 'Iris-versicolor'])
+
+>>> classifier.training_data = classifier.hyperparameter = classifier.batcher = None
+>>> classifier.warming = None
+>>> app.config.update(saved_config)
+>>> users.users, users.from_file = saved_users
+>>> users.user_file = None
+>>> verified.entries.clear()
+>>> directory.cleanup()
+"""
+
+test_classify_route = """
+>>> import tempfile
+>>> directory = tempfile.TemporaryDirectory()
+>>> saved_config = {name: app.config[name] for name in ("TRAINING_DATA", "CLASSIFIER_K")}
+>>> saved_users = users.users, users.from_file
+>>> app.config["TRAINING_DATA"] = Path(directory.name) / "iris.data"
+>>> _ = app.config["TRAINING_DATA"].write_text(
+...     "5.1,3.5,1.4,0.2,Iris-setosa\\n"
+...     "7.0,3.2,4.7,1.4,Iris-versicolor\\n"
+...     "4.9,3.0,1.4,0.2,Iris-setosa\\n"
+...     "6.4,3.2,4.5,1.5,Iris-versicolor\\n"
+... )
+>>> app.config["CLASSIFIER_K"] = 1
+>>> users.users, users.from_file = {}, False
+>>> for name, role in ("botanist", Role.BOTANIST), ("guest", Role.UNDEFINED):
+...     user = User(name, f"{name}@example.com", name.title(), role)
+...     user.set_password("secret")
+...     users.add_user(user)
+>>> def post(document, username="botanist"):
+...     credentials = base64.b64encode(f"{username}:secret".encode()).decode()
+...     response = app.test_client().post(
+...         "/classify", json=document, headers={"Authorization": f"Basic {credentials}"}
+...     )
+...     return response.status_code, response.get_json()
+>>> setosa = dict(zip(FEATURES, [5.0, 3.4, 1.5, 0.2]))
+>>> versicolor = dict(zip(FEATURES, [6.6, 3.0, 4.6, 1.4]))
+
+One sample gets one species; a list gets a list.
+
+>>> post(setosa)
+(200, {'species': 'Iris-setosa', 'status': 'OK'})
+>>> post([setosa, versicolor])
+(200, {'species': ['Iris-setosa', 'Iris-versicolor'], 'status': 'OK'})
+
+Samples that aren't four finite measurements are refused.
+
+>>> post({**setosa, "petal_width": float("nan")})
+(400, {'message': 'Samples must have finite measurements'})
+>>> post([])
+(400, {'message': 'Samples must have finite measurements'})
+>>> post({"sepal_length": 5.0})
+(400, {'message': "Invalid sample: KeyError('sepal_width')"})
+>>> post([[5.0, 3.4, 1.5, 0.2]])
+(400, {'message': "Invalid sample: TypeError('list indices must be integers or slices, not str')"})
+>>> try:
+...     sample_features({**setosa, "sepal_length": "long"})
+... except InvalidSample as error:
+...     print(repr(error.__cause__))
+ValueError("could not convert string to float: 'long'")
+
+A user without a classifying role may not.
+
+>>> post(setosa, "guest")
+(403, {'message': 'Not allowed to classify'})
+
+>>> classifier.training_data = classifier.hyperparameter = classifier.batcher = None
+>>> app.config.update(saved_config)
+>>> users.users, users.from_file = saved_users
+>>> verified.entries.clear()
+>>> directory.cleanup()
+"""
+
+test_serving_failures = """
+A request that fails is retried alone, so the others in its batch still get answers.
+
+>>> def classify(features):
+...     if (features < 0).any():
+...         raise ValueError("negative")
+...     return ["ok"] * len(features)
+>>> batcher = MicroBatcher(classify, max_wait_ms=50.0)
+>>> good, bad = batcher.submit(np.ones((2, 4))), batcher.submit(-np.ones((1, 4)))
+>>> good.result(), bad.exception()
+(['ok', 'ok'], ValueError('negative'))
+
+With a radius, a sample far from everything is an outlier, not an error.
+
+>>> import tempfile
+>>> with tempfile.TemporaryDirectory() as directory:
+...     source = Path(directory) / "iris.data"
+...     _ = source.write_text(
+...         "5.1,3.5,1.4,0.2,Iris-setosa\\n"
+...         "7.0,3.2,4.7,1.4,Iris-versicolor\\n"
+...         "4.9,3.0,1.4,0.2,Iris-setosa\\n"
+...     )
+...     config = {**app.config, "TRAINING_DATA": source, "CLASSIFIER_RADIUS": 1.0}
+...     training_data, hyperparameter = Classifier.model(config)
+>>> hyperparameter.classify_many(np.array([[9.0, 9.0, 9.0, 9.0]])).tolist()
+['Unknown']
+"""
+
+__test__ = {name: case for name, case in globals().items() if name.startswith("test_")}
+
+
 if __name__ == "__main__":
+    classifier.warm_up()
     app.run(ssl_context="adhoc")
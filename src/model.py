@@ -3,6 +3,7 @@ Hypereparameter 클래스를 class 키워드가 아닌 dataclass 데코레이터
 
 from __future__ import annotations
 import collections
+import heapq
 from dataclasses import dataclass, asdict
 from typing import Optional, Counter, List
 import weakref
@@ -55,11 +56,14 @@ class Hyperparameter:
         """k-NN 알고리즘  """
         if not (training_data := self.data()):
             raise RuntimeError("No TrainingData object")
-        distances: list[tuple[float, TrainingKnownSample]] = sorted(
-            (self.algorithm.distance(sample, known), known)
-            for known in training_data.training
+        distances: list[tuple[float, int, TrainingKnownSample]] = heapq.nsmallest(
+            self.k,
+            (
+                (self.algorithm.distance(sample, known), n, known)
+                for n, known in enumerate(training_data.training)
+            ),
         )
-        k_nearest = (known.species for d, known in distances[: self.k])
+        k_nearest = (known.species for d, n, known in distances)
         frequency: Counter[str] = collections.Counter(k_nearest)
         best_fit, *others = frequency.most_common()
         species, votes = best_fit
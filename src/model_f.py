@@ -2,11 +2,14 @@
 
 from __future__ import annotations
 import collections
-from dataclasses import dataclass, asdict
-from typing import Optional, List, Counter
+import heapq
+from dataclasses import dataclass, asdict, field
+from typing import Any, Optional, List, Counter
 import weakref
 import sys
 
+from src.ch6_model import PredictionCache
+
 """데이터클래스의 일반적인 용도는 가변 객체 생성
    속성에 새로운 값을 할당해 객체의 상태를 변경"""
 
@@ -55,16 +58,45 @@ class Hyperparameter:
     k: int
     algorithm: Distance
     data: weakref.ReferenceType["TrainingData"]
+    cache_size: int = 0
+    cache: Optional[PredictionCache] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.cache = PredictionCache(self.cache_size) if self.cache_size else None
 
     def classify(self, unknown: Sample) -> str:
-        """The k-NN algorithm"""
+        """The k-NN algorithm, remembering up to ``cache_size`` answers"""
         if not (training_data := self.data()):
             raise RuntimeError("No TrainingData object")
-        distances: list[tuple[float, TrainingKnownSample]] = sorted(
-            (self.algorithm.distance(unknown, known.sample), known)
-            for known in training_data.training
+        if self.cache is None:
+            return self._classify(training_data, unknown)
+        # Samples are frozen, so their features can key the cache as they are.
+        key = (
+            (
+                unknown.sepal_length,
+                unknown.sepal_width,
+                unknown.petal_length,
+                unknown.petal_width,
+            ),
+            self.k,
+            type(self.algorithm),
         )
-        k_nearest = (known.sample.species for d, known in distances[: self.k])
+        self.cache.check(training_data.version)
+        species = self.cache.get(key)
+        if species is None:
+            species = self._classify(training_data, unknown)
+            self.cache.put(key, species)
+        return species
+
+    def _classify(self, training_data: "TrainingData", unknown: Sample) -> str:
+        distances: list[tuple[float, int, TrainingKnownSample]] = heapq.nsmallest(
+            self.k,
+            (
+                (self.algorithm.distance(unknown, known.sample), n, known)
+                for n, known in enumerate(training_data.training)
+            ),
+        )
+        k_nearest = (known.sample.species for d, n, known in distances)
         frequency: Counter[str] = collections.Counter(k_nearest)
         best_fit, *others = frequency.most_common()
         species, votes = best_fit
@@ -76,4 +108,14 @@ class TrainingData:
     testing: List[TestingKnownSample]
     training: List[TrainingKnownSample]
     tuning: List[Hyperparameter]
+    version: int = field(default=0, init=False, compare=False)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name == "training":
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """Call after changing ``training`` in place."""
+        super().__setattr__("version", getattr(self, "version", 0) + 1)
 
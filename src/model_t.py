@@ -1,6 +1,7 @@
 #KNN(k-nearest neighbors) 구현
 '''knn은 분류 알고리즘 중 하나로, 새로운 데이터의 클래스를 예측하기 위해 가장 가까운 k개의 데이터의 클래스를 참고'''
 import collections
+import heapq
 from typing import Optional, Counter, NamedTuple
 import weakref
 import sys
@@ -68,11 +69,14 @@ class Hyperparameter:
     def classify(self, unknown: Sample) -> str:
         if not (training_data := self.data()):
             raise RuntimeError("No TrainingData object")
-        distances: list[tuple[float, TrainingKnownSample]] = sorted(
-            (self.algorithm.distance(unknown, known.sample), known)
-            for known in training_data.training
+        distances: list[tuple[float, int, TrainingKnownSample]] = heapq.nsmallest(
+            self.k,
+            (
+                (self.algorithm.distance(unknown, known.sample), n, known)
+                for n, known in enumerate(training_data.training)
+            ),
         )
-        k_nearest = (known.sample.species for d, known in distances[: self.k])
+        k_nearest = (known.sample.species for d, n, known in distances)
         frequency: Counter[str] = collections.Counter(k_nearest)
         best_fit, *others = frequency.most_common()
         species, votes = best_fit
@@ -0,0 +1,296 @@
+"""A pre-fork server: one parent process, N workers sharing one copy of the model.
+
+The parent loads ``TRAINING_DATA`` and publishes it as a numbered snapshot
+in the model directory (``TrainingData.save()``, with the KDTree when the
+training set is big enough to use one). ``current`` is a symlink to the
+newest snapshot, replaced with ``os.replace()``, so a reader sees either the
+old version or the new one, never half of either.
+
+Each worker memory-maps the snapshot ``current`` points to, read-only. The
+pages live once in the OS page cache however many workers map them, so
+adding a worker adds its interpreter and not another copy of the model.
+Workers run the asyncio ``Server`` on the shared listening socket.
+
+``kill -HUP`` the parent to reload ``TRAINING_DATA`` and publish it; the
+workers open the new version and swap their model in a single assignment,
+so a batch is classified wholly by the old model or wholly by the new one.
+Workers also poll ``current``, so a snapshot published by another process
+(``publish()``) is picked up too.
+
+Run with ``python -m src.prefork [--host HOST] [--port PORT] [--workers N] [--model-dir DIR]``.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import concurrent.futures
+import os
+from pathlib import Path
+import shutil
+import signal
+import socket
+from typing import Any, Mapping, Optional
+
+from src import async_classifier
+from src.async_classifier import AsyncBatcher, Server, warm_up
+from src.ch6_model import TrainingData
+from src.classifier import MODEL_CONFIG, Classifier, app, users
+
+
+CURRENT = "current"
+
+
+def versions(model_dir: Path) -> list[int]:
+    return sorted(int(path.name) for path in model_dir.iterdir() if path.name.isdigit())
+
+
+def publish(training_data: TrainingData, model_dir: Path, keep: int = 2) -> Path:
+    """Save a new snapshot version and point ``current`` at it.
+
+    Only the newest ``keep`` versions are kept. Workers still mapping a
+    removed one keep its pages until they let go of it.
+    """
+    model_dir.mkdir(parents=True, exist_ok=True)
+    previous = versions(model_dir)
+    version = str((previous[-1] if previous else 0) + 1)
+    training_data.save(
+        model_dir / version,
+        index=len(training_data.training) >= training_data.index_threshold,
+    )
+    link = model_dir / f".{CURRENT}-{os.getpid()}"
+    link.unlink(missing_ok=True)
+    os.symlink(version, link)
+    os.replace(link, model_dir / CURRENT)
+    for old in previous[: max(0, len(previous) - keep + 1)]:
+        shutil.rmtree(model_dir / str(old), ignore_errors=True)
+    return model_dir / version
+
+
+class ModelWatcher:
+    """Keeps a worker's model at the version ``current`` points to."""
+
+    def __init__(self, model_dir: Path, config: Mapping[str, Any]) -> None:
+        self.model_dir = model_dir
+        self.config = config
+        self.version: Optional[str] = None
+        self.wake = asyncio.Event()
+
+    async def check(self) -> None:
+        version = os.readlink(self.model_dir / CURRENT)
+        if version != self.version:
+            # Open the numbered directory, not "current", which may move on.
+            config = {**self.config, "TRAINING_DATA": str(self.model_dir / version)}
+            await asyncio.get_running_loop().run_in_executor(
+                None, async_classifier._load_model, config
+            )
+            self.version = version
+            app.logger.info(f"Worker {os.getpid()} serving model version {version}")
+
+    async def run(self, poll_seconds: float) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.check()
+            except Exception:
+                app.logger.exception("Model reload failed; keeping the old one")
+
+
+class WorkerServer(Server):
+    def __init__(self, batcher: AsyncBatcher, watcher: ModelWatcher, keepalive: float) -> None:
+        super().__init__(batcher, keepalive)
+        self.watcher = watcher
+
+    async def health(self, headers: dict[str, str], body: bytes) -> dict[str, Any]:
+        response = await super().health(headers, body)
+        response["model_loaded"] = self.watcher.version is not None
+        response["ready"] = users.ready and response["model_loaded"]
+        response["model_version"] = self.watcher.version
+        response["worker"] = os.getpid()
+        return response
+
+
+async def serve_worker(listener: socket.socket, model_dir: Path) -> None:
+    config = app.config
+    # The snapshot supplies the training data and its scaling.
+    model_config = {
+        name: config[name]
+        for name in MODEL_CONFIG
+        if name not in ("TRAINING_DATA", "CLASSIFIER_SCALING")
+    }
+    loop = asyncio.get_running_loop()
+    # The worker is the process; one thread does its k-NN work.
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        batcher = AsyncBatcher(
+            pool,
+            1,
+            config["BATCH_MAX_WAIT_MS"],
+            config["BATCH_MAX_SIZE"],
+            config["ASYNC_MAX_PENDING"],
+        )
+        watcher = ModelWatcher(model_dir, model_config)
+        await watcher.check()
+        loop.add_signal_handler(signal.SIGHUP, watcher.wake.set)
+        server = WorkerServer(batcher, watcher, config["ASYNC_KEEPALIVE_SECONDS"])
+        # The loop only keeps a weak reference to the task.
+        warming = asyncio.create_task(warm_up(batcher))
+        listening = await asyncio.start_server(server.handle, sock=listener)
+        async with listening:
+            await asyncio.gather(
+                watcher.run(config["PREFORK_POLL_SECONDS"]),
+                listening.serve_forever(),
+            )
+
+
+class Prefork:
+    """The parent: publishes the model, then forks and supervises the workers."""
+
+    signals = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+
+    def __init__(self, listener: socket.socket, model_dir: Path, workers: int) -> None:
+        self.listener = listener
+        self.model_dir = model_dir
+        self.size = workers
+        self.workers: set[int] = set()
+
+    def reload(self) -> None:
+        """Load ``TRAINING_DATA`` and publish it for the workers."""
+        training_data, _ = Classifier.model(app.config)
+        path = publish(training_data, self.model_dir, app.config["PREFORK_KEEP_VERSIONS"])
+        app.logger.info(f"Published {app.config['TRAINING_DATA']} as {path}")
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+        status = 1
+        try:
+            # Ignore SIGHUP until the worker's own handler is in place.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            asyncio.run(serve_worker(self.listener, self.model_dir))
+            status = 0
+        except Exception:
+            app.logger.exception(f"Worker {os.getpid()} failed")
+        finally:
+            os._exit(status)
+
+    def reap(self) -> None:
+        while self.workers:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            self.workers.discard(pid)
+
+    def signal_workers(self, signum: int) -> None:
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        # Signals wait in a queue for sigtimedwait() rather than interrupting.
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+        self.reload()
+        try:
+            while True:
+                while len(self.workers) < self.size:
+                    self.spawn()
+                info = signal.sigtimedwait(self.signals, 1.0)
+                if info is None or info.si_signo == signal.SIGCHLD:
+                    self.reap()
+                elif info.si_signo == signal.SIGHUP:
+                    try:
+                        self.reload()
+                    except Exception:
+                        app.logger.exception("Reload failed; workers keep the old model")
+                    else:
+                        self.signal_workers(signal.SIGHUP)
+                else:
+                    break
+        finally:
+            self.signal_workers(signal.SIGTERM)
+            for pid in self.workers:
+                os.waitpid(pid, 0)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve the classifier from pre-forked workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--model-dir", type=Path, default=Path("models"))
+    args = parser.parse_args(argv)
+    config = app.config
+    config.setdefault("ASYNC_MAX_PENDING", 1024)
+    config.setdefault("ASYNC_KEEPALIVE_SECONDS", 75.0)
+    config.setdefault("PREFORK_POLL_SECONDS", 1.0)
+    config.setdefault("PREFORK_KEEP_VERSIONS", 2)
+    listener = socket.create_server((args.host, args.port), backlog=4096)
+    Prefork(listener, args.model_dir, args.workers).run()
+
+
+test_publish = """
+>>> import tempfile
+>>> from src.ch6_model import TrainingData
+>>> raw_data = [
+... {"sepal_length": 5.1, "sepal_width": 3.5, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.9, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 4.9, "sepal_width": 3.0, "petal_length": 1.4, "petal_width": 0.2, "species": "Iris-setosa"},
+... {"sepal_length": 7.0, "sepal_width": 3.2, "petal_length": 4.7, "petal_width": 1.4, "species": "Iris-versicolor"},
+... {"sepal_length": 6.4, "sepal_width": 3.2, "petal_length": 4.5, "petal_width": 1.5, "species": "Iris-versicolor"},
+... {"sepal_length": 4.7, "sepal_width": 3.2, "petal_length": 1.3, "petal_width": 0.2, "species": "Iris-setosa"},
+... ]
+>>> td = TrainingData("test")
+>>> td.load(raw_data[:3])
+>>> directory = tempfile.TemporaryDirectory()
+>>> model_dir = Path(directory.name) / "models"
+
+``current`` always names a complete version, and the temporary link is gone.
+
+>>> publish(td, model_dir) == model_dir / "1"
+True
+>>> os.readlink(model_dir / CURRENT), sorted(path.name for path in model_dir.iterdir())
+('1', ['1', 'current'])
+
+A worker's watcher opens the version ``current`` names.
+
+>>> watcher = ModelWatcher(model_dir, dict(app.config))
+>>> asyncio.run(watcher.check())
+>>> watcher.version, len(async_classifier._model[0].training)
+('1', 2)
+
+Only the newest ``keep`` versions stay.
+
+>>> td.load(raw_data[3:])
+>>> _ = publish(td, model_dir)
+>>> _ = publish(td, model_dir, keep=2)
+>>> versions(model_dir), os.readlink(model_dir / CURRENT)
+([2, 3], '3')
+
+The next check swaps the worker's model for the new one; unchanged, it's left alone.
+
+>>> first = async_classifier._model
+>>> asyncio.run(watcher.check())
+>>> watcher.version, len(async_classifier._model[0].training), async_classifier._model is first
+('3', 4, False)
+>>> second = async_classifier._model
+>>> asyncio.run(watcher.check())
+>>> async_classifier._model is second
+True
+
+>>> async_classifier._model = None
+>>> directory.cleanup()
+"""
+
+__test__ = {name: case for name, case in globals().items() if name.startswith("test_")}
+
+
+if __name__ == "__main__":
+    main()